@@ -277,6 +277,21 @@ class AddressTestCase(LoggedInTestCase):
         self.assertEqual(v1["version"], 1)
         self.assertEqual(v1["data"]["institution_name"], "Onion Institute Revised")
 
+    def test_admin_audit_history_page(self):
+        self._setup_audittrail()
+        address = Address.objects.get(institution_name="Onion Institute Revised")
+        response = self._client.get("/addresses/%d/history/?page=2&limit=1" % address.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["meta"]["count"], 2)
+        history = response.data["results"]
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history[0]["version"], 1)
+        self.assertEqual(history[0]["data"]["institution_name"], "Onion Institute Revised")
+        response = self._client.get("/addresses/%d/history/?user=%s" %
+                                    (address.id, self._joeBloggs.username))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 0)
+
     def test_admin_audit_compare(self):
         self._setup_audittrail()
         address = Address.objects.get(institution_name="Onion Institute Revised")
@@ -287,6 +302,25 @@ class AddressTestCase(LoggedInTestCase):
         self.assertEqual(changes["institution_name"]["version1"], "Leek Institute")
         self.assertEqual(changes["institution_name"]["version2"], "Onion Institute Revised")
 
+    def test_admin_audit_compare_consecutive(self):
+        self._setup_audittrail()
+        address = Address.objects.get(institution_name="Onion Institute Revised")
+        response = self._client.patch("/addresses/%d/" % address.id,
+                                      {"city": "Swansea"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self._client.get(
+            "/addresses/%d/compare/?version1=0&version2=-1&consecutive=True" % address.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        changes = response.data
+        self.assertEqual(len(changes), 2)
+        self.assertEqual(changes[0]["version1"], 0)
+        self.assertEqual(changes[0]["version2"], 1)
+        self.assertEqual(list(changes[0]["changes"].keys()), ["institution_name"])
+        self.assertEqual(changes[1]["changes"]["city"],
+                         {"version1": "Cardiff", "version2": "Swansea"})
+        response = self._client.get("/addresses/%d/compare/?version2=3" % address.id)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_admin_audit_revert(self):
         self._setup_audittrail()
         address = Address.objects.get(institution_name="Onion Institute Revised")
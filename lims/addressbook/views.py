@@ -4,6 +4,7 @@ from rest_framework.serializers import ValidationError
 from .models import Address
 from .serializers import AddressSerializer
 
+from lims.permissions.capabilities import get_capabilities
 from lims.permissions.permissions import IsAddressOwner, IsAddressOwnerFilter
 from lims.shared.mixins import AuditTrailViewMixin
 
@@ -24,7 +25,7 @@ class AddressViewSet(AuditTrailViewMixin, viewsets.ModelViewSet):
     def perform_create(self, serializer):
         # Allow an admin user to set the user
         # for instance is adding a new address
-        if self.request.user.groups.filter(name='admin').exists():
+        if get_capabilities(self.request.user).is_admin:
             serializer.save()
         else:
             # No. You are not admin, you cannot add user.
@@ -5,6 +5,7 @@ from rest_framework.exceptions import PermissionDenied
 
 import django_filters
 
+from lims.permissions.capabilities import get_capabilities
 from lims.permissions.permissions import IsInStaffGroupOrRO
 from lims.shared.mixins import AuditTrailViewMixin
 
@@ -47,21 +48,21 @@ class EquipmentReservationViewSet(AuditTrailViewMixin, viewsets.ModelViewSet):
     filter_class = EquipmentReservationFilter
 
     def perform_create(self, serializer):
-        if self.request.user.groups.filter(name='staff').exists():
+        if get_capabilities(self.request.user).is_staff:
             serializer.validated_data['is_confirmed'] = True
             serializer.validated_data['confirmed_by'] = self.request.user
         serializer.save(reserved_by=self.request.user)
 
     def perform_update(self, serializer):
         if (serializer.instance.reserved_by == self.request.user or
-                self.request.user.groups.filter(name='staff').exists()):
+                get_capabilities(self.request.user).is_staff):
             serializer.save()
         else:
             raise PermissionDenied()
 
     def destroy(self, request, pk=None):
         if (request.user == self.get_object().reserved_by or
-                request.user.groups.filter(name='staff').exists()):
+                get_capabilities(request.user).is_staff):
             return super(EquipmentReservationViewSet, self).destroy(request, self.get_object().id)
         else:
             return Response({'message': 'You must have permission to delete'}, status=403)
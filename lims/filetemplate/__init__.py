@@ -0,0 +1 @@
+default_app_config = 'lims.filetemplate.apps.FileTemplateConfig'
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class FileTemplateConfig(AppConfig):
+    name = 'lims.filetemplate'
+
+    def ready(self):
+        import lims.filetemplate.signals  # noqa
@@ -0,0 +1,119 @@
+import csv
+import itertools
+
+import numpy
+
+from django.utils.functional import cached_property
+
+
+# Keys ending with these are read as numbers. Anything else, such as
+# identifiers, barcodes and well coordinates, is kept as text even if it
+# looks like a number as e.g. "00123" is not the same barcode as "123".
+NUMERIC_KEYS = ('amount', 'concentration', 'volume')
+
+
+def is_numeric_key(key):
+    """
+    Check if the values of a key are numeric amounts rather than text
+    """
+    return key.split('.')[-1].lower().endswith(NUMERIC_KEYS)
+
+
+def _as_array(values, numeric=False):
+    """
+    A float array if numeric and every value present is a number, otherwise
+    an object array
+
+    Missing values are NaN in a float array and None otherwise.
+    """
+    if numeric:
+        try:
+            return numpy.array([numpy.nan if v is None else v for v in values], dtype=float)
+        except ValueError:
+            pass
+    return numpy.array(values, dtype=object)
+
+
+def _is_missing(value):
+    # NaN is the only value not equal to itself
+    return value is None or value != value
+
+
+class ColumnarFile():
+    """
+    The lines of a file read with a file template held as typed columns
+
+    Columns are keyed as FileTemplate.read keys lines, with properties
+    kept apart by name. Use line() to get a line as read would give it but
+    with numeric amounts as floats.
+    """
+
+    def __init__(self, identifiers, columns, properties):
+        # The frozenset of identifier values of each line
+        self.identifiers = identifiers
+        self.columns = columns
+        self.properties = properties
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def index(self):
+        """
+        Map each identifier value to the lines it identifies
+        """
+        index = {}
+        for i, identifier in enumerate(self.identifiers):
+            for value in identifier:
+                index.setdefault(value, []).append(i)
+        return index
+
+    @cached_property
+    def _lists(self):
+        # Reading items of lists is much quicker than of arrays
+        return ([(key, values.tolist()) for key, values in self.columns.items()],
+                [(name, values.tolist()) for name, values in self.properties.items()])
+
+    def line(self, i):
+        columns, properties = self._lists
+        line = {}
+        for key, values in columns:
+            if not _is_missing(values[i]):
+                line[key] = values[i]
+        for name, values in properties:
+            if not _is_missing(values[i]):
+                line.setdefault('properties', []).append({'name': name, 'value': values[i]})
+        return line
+
+
+def read_columns(input_file, plan):
+    """
+    Read a CSV file into a ColumnarFile using the read plan of a template
+
+    Returns False if the file is missing headers the plan requires.
+    """
+    reader = csv.reader(input_file)
+    header = next(reader, None)
+    if header is None or any(name not in header for name in plan.required):
+        return False
+    lines = [line for line in reader if any(v.strip() for v in line)]
+    # Transpose to columns, short lines are missing the values at the end
+    file_columns = list(itertools.zip_longest(*lines, fillvalue=''))
+    file_columns += [('',) * len(lines)] * (len(header) - len(file_columns))
+    positions = {name: i for i, name in enumerate(header)}
+
+    def values(name):
+        return [v if v.strip() else None for v in file_columns[positions[name]]]
+
+    identifier_columns = [values(name) for name in plan.identifiers]
+    identifiers = [frozenset(ids) for ids in zip(*identifier_columns)] \
+        if len(identifier_columns) > 0 else [frozenset()] * len(lines)
+    columns = {}
+    properties = {}
+    for name, key, is_property in plan.columns:
+        if name in positions:
+            column = _as_array(values(name), is_numeric_key(key))
+            if is_property:
+                properties[key] = column
+            else:
+                columns[key] = column
+    return ColumnarFile(identifiers, columns, properties)
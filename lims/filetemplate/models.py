@@ -1,8 +1,24 @@
 import csv
+import io
 
+from collections import namedtuple
+
+from django.core.cache import cache
 from django.db import models
 import reversion
-from django.core.exceptions import ObjectDoesNotExist
+
+from lims.shared.transactions import on_commit, pending
+from .columnar import read_columns
+
+
+READ_PLAN_KEY = 'filetemplate.read_plan.{}'
+# Seconds to cache a read plan for, in case a plan read from before a
+# change is cached by another process while the change is committed
+READ_PLAN_TIMEOUT = 60 * 60
+
+# The (header, key, is_property) of each column to read, and the headers of
+# the identifier and required fields
+ReadPlan = namedtuple('ReadPlan', ['columns', 'identifiers', 'required'])
 
 
 @reversion.register()
@@ -34,73 +50,148 @@ class FileTemplate(models.Model):
             return field.map_to
         return field.name
 
-    def _validate_headers(self, header_list):
+    def read_plan(self):
+        """
+        Get how to read the lines of a file with this template
+
+        Worked out once from the fields and cached, in the cache shared by
+        every process, until they change. While changes to the fields are
+        yet to be committed the plan is worked out without the cache.
+        """
+        key = READ_PLAN_KEY.format(self.id)
+        changed = pending(key)
+        plan = None if changed else cache.get(key)
+        if plan is None:
+            fields = list(self.fields.all())
+            identifiers = tuple(f.name for f in fields if f.is_identifier)
+            plan = ReadPlan(
+                # Identifier fields are not added to lines
+                columns=tuple((f.name, self._get_field_key(f), f.is_property)
+                              for f in fields if f.name not in identifiers),
+                identifiers=identifiers,
+                required=tuple(f.name for f in fields if f.required))
+            if not changed:
+                cache.set(key, plan, READ_PLAN_TIMEOUT)
+        return plan
+
+    def _validate_headers(self, header_list, plan):
         if header_list is None:
             return False
-        for field in self.fields.all():
-            if field.required and field.name not in header_list:
-                return False
-        return True
+        return all(name in header_list for name in plan.required)
+
+    def _read_lines(self, csv_file, plan):
+        for line in csv_file:
+            line = dict([(k, v) for k, v in line.items() if v.strip()])
+            if any(line):
+                # Get the identifier fields from the file
+                identifier = frozenset(line[name] for name in plan.identifiers)
+                generated_line = {}
+                # TODO: Currently we discard extra fields in CSV that are not in
+                # filetemplate. Change this?
+                for name, key, is_property in plan.columns:
+                    if name in line:
+                        # May map to different DB field
+                        if is_property:
+                            if 'properties' not in generated_line:
+                                generated_line['properties'] = []
+                            generated_line['properties'].append({
+                                'name': key,
+                                'value': line[name]
+                            })
+                        else:
+                            generated_line[key] = line[name]
+                yield identifier, generated_line
 
-    def read(self, input_file, as_list=False):
+    def iter_read(self, input_file):
+        """
+        Read a file a line at a time
+
+        Returns False if the file is missing required headers otherwise a
+        generator of (identifier, line) where identifier is the frozenset
+        of the values of the identifier fields.
+        """
         csv_file = csv.DictReader(input_file)
-        try:
-            identifier_fields = self.fields.filter(is_identifier=True)
-        except ObjectDoesNotExist:
+        plan = self.read_plan()
+        if not self._validate_headers(csv_file.fieldnames, plan):
             return False
-        else:
-            if as_list:
-                indexed = []
-            else:
-                indexed = {}
-            if self._validate_headers(csv_file.fieldnames):
-                for line in csv_file:
-                    line = dict([(k, v) for k, v in line.items() if v.strip()])
-                    if any(line):
-                        # Get the identifier fields from the file
-                        identifier = frozenset(line[n.name] for n in identifier_fields)
-                        # Get a list of identifiers and remove from line
-                        ifn = [i.name for i in identifier_fields]
-                        # We don't want to used identifiers if it's a list as they'll be
-                        # discarded.
-                        if as_list and len(ifn) > 0:
-                            return False
-
-                        generated_line = {}
-                        # TODO: Currently we discard extra fields in CSV that are not in
-                        # filetemplate. Change this?
-                        for field in self.fields.all():
-                            # Don't add identifier fields
-                            if field.name not in ifn and field.name in line:
-                                field_value = line[field.name]
-                                # May map to different DB field
-                                field_key = self._get_field_key(field)
-                                if field.is_property:
-                                    if 'properties' not in generated_line:
-                                        generated_line['properties'] = []
-                                    prop = {
-                                        'name': field_key,
-                                        'value': field_value
-                                    }
-                                    generated_line['properties'].append(prop)
-                                else:
-                                    generated_line[field_key] = field_value
-
-                        if as_list:
-                            indexed.append(generated_line)
-                        else:
-                            indexed[identifier] = generated_line
-                return indexed
-        return False
+        return self._read_lines(csv_file, plan)
+
+    def read(self, input_file, as_list=False):
+        # We don't want to used identifiers if it's a list as they'll be
+        # discarded.
+        if as_list and len(self.read_plan().identifiers) > 0:
+            return False
+        lines = self.iter_read(input_file)
+        if lines is False:
+            return False
+        if as_list:
+            return [line for identifier, line in lines]
+        return dict(lines)
+
+    def read_columns(self, input_file):
+        """
+        Read a file into typed columns rather than a dict for each line
+
+        Returns False if the file is missing required headers otherwise a
+        ColumnarFile.
+        """
+        return read_columns(input_file, self.read_plan())
+
+    def _read_chunks(self, lines, chunk_size):
+        chunk = []
+        for identifier, line in lines:
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def read_chunks(self, input_file, chunk_size=1000):
+        """
+        Read a file as a list in chunks rather than all at once
+
+        Returns False under the same conditions as read with as_list or
+        otherwise a generator of lists of at most chunk_size lines.
+        """
+        if len(self.read_plan().identifiers) > 0:
+            return False
+        lines = self.iter_read(input_file)
+        if lines is False:
+            return False
+        return self._read_chunks(lines, chunk_size)
+
+    def column_names(self, column_order='name'):
+        return [item.name for item in self.fields.all().order_by(column_order)]
+
+    def _writer(self, output_file, column_order):
+        return csv.DictWriter(output_file, fieldnames=self.column_names(column_order),
+                              extrasaction='ignore', lineterminator='\n')
 
     def write(self, output_file, data, column_order='name'):
-        fieldnames = [item.name for item in self.fields.all().order_by(column_order)]
-        csv_output = csv.DictWriter(output_file, fieldnames=fieldnames,
-                                    extrasaction='ignore', lineterminator='\n')
+        csv_output = self._writer(output_file, column_order)
         csv_output.writeheader()
         csv_output.writerows(data)
         return output_file
 
+    def write_chunks(self, data, column_order='name', chunk_size=500):
+        """
+        As write but yield the file as text a chunk of rows at a time
+
+        Data can be any iterable so rows need only be made as they are
+        written, e.g. for a StreamingHttpResponse.
+        """
+        with io.StringIO() as output_file:
+            csv_output = self._writer(output_file, column_order)
+            csv_output.writeheader()
+            for i, row in enumerate(data, 1):
+                csv_output.writerow(row)
+                if i % chunk_size == 0:
+                    yield output_file.getvalue()
+                    output_file.seek(0)
+                    output_file.truncate()
+            yield output_file.getvalue()
+
     def __str__(self):
         return self.name
 
@@ -129,5 +220,36 @@ class FileTemplateField(models.Model):
         key = self.get_key()
         return key.split('.')
 
+    def value_getter(self):
+        """
+        Get a function that follows the key path of this field into a dict
+
+        Missing keys give None.
+        """
+        path = self.key_to_path()
+        if len(path) == 1:
+            key = path[0]
+            return lambda data: data.get(key, None)
+
+        def get_value(data):
+            for key in path:
+                if data is None:
+                    return None
+                data = data.get(key, None)
+            return data
+        return get_value
+
     def __str__(self):
         return self.name
+
+
+def invalidate_read_plan(file_template_id):
+    """
+    Remove the cached read plan of a template from every process once the
+    change is committed
+
+    Until then read_plan bypasses the cache for the template, so a plan of
+    fields that might be rolled back is never cached.
+    """
+    key = READ_PLAN_KEY.format(file_template_id)
+    on_commit(key, lambda: cache.delete(key))
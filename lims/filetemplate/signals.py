@@ -0,0 +1,13 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import FileTemplateField, invalidate_read_plan
+
+
+@receiver(post_save, sender=FileTemplateField)
+@receiver(post_delete, sender=FileTemplateField)
+def file_template_field_changed(sender, instance, **kwargs):
+    """
+    Invalidate the cached read plan of the template a field is on
+    """
+    invalidate_read_plan(instance.template_id)
@@ -1,7 +1,8 @@
 import io
+from django.core.cache import cache
 from lims.shared.loggedintestcase import LoggedInTestCase
 from rest_framework import status
-from .models import FileTemplate, FileTemplateField
+from .models import FileTemplate, FileTemplateField, READ_PLAN_KEY
 
 
 class FileTemplateTestCase(LoggedInTestCase):
@@ -418,6 +419,60 @@ D,E""")
         file.close()
         self.assertIs(result, False)
 
+    def test_read_plan(self):
+        content = "ID1Field1,1Field1,1Field2,1Field3,1Field4\nA,B,C,D,E\nF,G,H,I,J"
+        self._commit()
+        self._input_template1.read(io.StringIO(content))
+        # The plan is cached so reading again needs no queries at all
+        with self.assertNumQueries(0):
+            result = self._input_template1.read(io.StringIO(content))
+        self.assertEqual(result[frozenset("A")]["MappingTest"], "D")
+        # Changing a field changes how the file is read
+        self._input_template1_field3.map_to = "Remapped"
+        self._input_template1_field3.save()
+        result = self._input_template1.read(io.StringIO(content))
+        self.assertEqual(result[frozenset("A")]["Remapped"], "D")
+        self.assertNotIn("MappingTest", result[frozenset("A")])
+        # Nor is the plan cached until the change is committed
+        self.assertIsNone(cache.get(READ_PLAN_KEY.format(self._input_template1.id)))
+        self._commit()
+        self._input_template1.read(io.StringIO(content))
+        self.assertIsNotNone(cache.get(READ_PLAN_KEY.format(self._input_template1.id)))
+
+    def test_read_columns(self):
+        file = io.StringIO("ID1Field1,1Field1,1Field2,1Field3,1Field4\nA,B,1.5,D,2\nF,G,,I,J")
+        result = self._input_template1.read_columns(file)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result.identifiers, [frozenset("A"), frozenset("F")])
+        self.assertEqual(result.columns["1Field2"].dtype.kind, "O")
+        self.assertEqual(result.line(0),
+                         {"1Field1": "B", "1Field2": "1.5", "MappingTest": "D",
+                          "properties": [{"name": "1Field4", "value": "2"}]})
+        # Missing values are left out as read does
+        self.assertEqual(result.line(1),
+                         {"1Field1": "G", "MappingTest": "I",
+                          "properties": [{"name": "1Field4", "value": "J"}]})
+        self.assertEqual(result.index(), {"A": [0], "F": [1]})
+        # Read a file with required fields missing
+        file = io.StringIO("ID1Field1,1Field1\nA,B")
+        self.assertIs(self._input_template1.read_columns(file), False)
+
+    def test_read_columns_numeric(self):
+        template = FileTemplate.objects.create(name="NumericTemplate", file_for="input")
+        FileTemplateField.objects.create(name="ID", is_identifier=True, template=template)
+        FileTemplateField.objects.create(name="Barcode", map_to="labware_barcode",
+                                         template=template)
+        FileTemplateField.objects.create(name="Well", map_to="labware_well", template=template)
+        FileTemplateField.objects.create(name="Amount", map_to="product_input_amount",
+                                         template=template)
+        file = io.StringIO("ID,Barcode,Well,Amount\nA,00123,1,2.5\nB,00456,2,")
+        result = template.read_columns(file)
+        self.assertEqual(result.columns["product_input_amount"].dtype.kind, "f")
+        # Barcodes and wells that look like numbers are kept as they are
+        self.assertEqual(result.line(0), {"labware_barcode": "00123", "labware_well": "1",
+                                          "product_input_amount": 2.5})
+        self.assertEqual(result.line(1), {"labware_barcode": "00456", "labware_well": "2"})
+
     def test_write_file(self):
         data1 = [{"ID1Field1": "a", "1Field1": "b", "1Field2": "c", "1Field3": "d", "1Field4": "e"},
                  {"ID1Field1": "f", "1Field1": "g", "1Field2": "h", "1Field3": "i", "1Field4": "j"}]
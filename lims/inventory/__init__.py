@@ -0,0 +1 @@
+default_app_config = 'lims.inventory.apps.InventoryConfig'
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class InventoryConfig(AppConfig):
+    name = 'lims.inventory'
+
+    def ready(self):
+        import lims.inventory.signals  # noqa
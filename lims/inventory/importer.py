@@ -0,0 +1,186 @@
+import json
+
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers as django_serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+from django.utils.encoding import smart_text
+from reversion.models import Revision, Version
+
+from rest_framework import serializers
+from rest_framework.validators import UniqueValidator
+
+from lims.permissions.permissions import ViewPermissionsMixin
+from lims.projects.models import Product
+from .models import Item, ItemProperty, ItemType, AmountMeasure, Location
+from .serializers import DetailedItemSerializer
+
+
+class LookupRelatedField(serializers.SlugRelatedField):
+    """
+    A SlugRelatedField that finds objects in a dict rather than the DB
+    """
+
+    def __init__(self, lookup, **kwargs):
+        self.lookup = lookup
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        try:
+            return self.lookup[data]
+        except KeyError:
+            self.fail('does_not_exist', slug_name=self.slug_field, value=smart_text(data))
+        except TypeError:
+            self.fail('invalid')
+
+
+class ImportItemSerializer(DetailedItemSerializer):
+    """
+    Validate imported items without querying the DB for each one
+
+    Related fields are looked up from the lookups given in the context and
+    barcodes are checked a chunk at a time by the importer. Permissions are
+    the same for every item so are not part of the data.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        fields.pop('assign_groups')
+        for name, lookup in self.context['lookups'].items():
+            field = fields[name]
+            fields[name] = LookupRelatedField(lookup,
+                                              queryset=field.queryset,
+                                              slug_field=field.slug_field,
+                                              required=field.required,
+                                              allow_null=field.allow_null)
+        fields['barcode'].validators = [v for v in fields['barcode'].validators
+                                        if not isinstance(v, UniqueValidator)]
+        return fields
+
+
+class ItemImporter():
+    """
+    Import items read from a file template a chunk at a time
+
+    Measures, item types and locations are loaded once for the whole file.
+    Each chunk is validated in memory then its items, properties, product
+    links, permissions and first versions are inserted together in a
+    transaction.
+    """
+    # Lines of a file to read and save at once
+    chunk_size = 1000
+
+    def __init__(self, user, permissions):
+        self.user = user
+        self.permissions = permissions
+        measures = {m.symbol: m for m in AmountMeasure.objects.all()}
+        self.serializer = ImportItemSerializer(context={'lookups': {
+            'amount_measure': measures,
+            'concentration_measure': measures,
+            'item_type': {t.name: t for t in ItemType.objects.all()},
+            'location': {location.code: location for location in
+                         Location.objects.exclude(code=None)},
+        }})
+
+    def _validate(self, chunk):
+        valid = []
+        for item_data in chunk:
+            item_data['assign_groups'] = self.permissions
+            if 'properties' not in item_data:
+                item_data['properties'] = []
+            try:
+                validated_data = self.serializer.run_validation(item_data)
+            except serializers.ValidationError as e:
+                item_data['errors'] = e.detail
+            else:
+                valid.append((item_data, validated_data))
+        # Barcodes must be unique against the DB and within the chunk
+        barcodes = [v['barcode'] for d, v in valid if v.get('barcode', None)]
+        seen = set(Item.objects.filter(barcode__in=barcodes)
+                   .values_list('barcode', flat=True)) if len(barcodes) > 0 else set()
+        unique = []
+        for item_data, validated_data in valid:
+            barcode = validated_data.get('barcode', None)
+            if barcode and barcode in seen:
+                item_data['errors'] = {'barcode': ['item with this barcode already exists.']}
+            else:
+                if barcode:
+                    seen.add(barcode)
+                unique.append((item_data, validated_data))
+        return unique
+
+    def import_chunk(self, chunk):
+        """
+        Validate and save a list of items as read from a file template
+
+        Returns (data, errors) for each item in order with errors as None
+        for those saved. Errors are also added to the data of the rejected.
+        """
+        valid = self._validate(chunk)
+        if len(valid) > 0:
+            self._save(valid)
+        return [(item_data, item_data.get('errors', None)) for item_data in chunk]
+
+    def _save(self, valid):
+        items = []
+        properties = []
+        tags = []
+        for item_data, validated_data in valid:
+            properties.append(validated_data.pop('properties'))
+            tags.append(validated_data.pop('tags', []))
+            item = Item(added_by=self.user, **validated_data)
+            # As Item.save does
+            if item.amount_available > 0:
+                item.in_inventory = True
+            items.append(item)
+        product_identifiers = [d['product'] for d, v in valid if 'product' in d]
+        products = {}
+        if len(product_identifiers) > 0:
+            products = {p.product_identifier: p for p in
+                        Product.objects.filter(product_identifier__in=product_identifiers)}
+        with transaction.atomic():
+            Item.objects.bulk_create(items)
+            item_properties = []
+            item_tags = []
+            linked = []
+            for (item_data, _), item, fields, item_tag in zip(valid, items, properties, tags):
+                for field in fields:
+                    # Just in case lets make sure an ID isn't sent along
+                    field.pop('id', None)
+                    item_properties.append(ItemProperty(item=item, **field))
+                for tag in item_tag:
+                    item_tags.append(Item.tags.through(item_id=item.id, tag_id=tag.id))
+                product = products.get(item_data.get('product', None), None)
+                if product is not None:
+                    linked.append(Product.linked_inventory.through(product_id=product.id,
+                                                                   item_id=item.id))
+            ItemProperty.objects.bulk_create(item_properties)
+            Item.tags.through.objects.bulk_create(item_tags)
+            Product.linked_inventory.through.objects.bulk_create(linked)
+            ViewPermissionsMixin().bulk_assign_permissions(items, self.permissions)
+            self._add_versions(items, tags)
+
+    def _add_versions(self, items, tags):
+        """
+        Save a revision with the first version of each item
+
+        As reversion would for items saved one at a time, which bulk_create
+        does not. New items are in no sets nor created from others.
+        """
+        fields = [f.name for f in Item._meta.concrete_fields]
+        revision = Revision.objects.create(date_created=timezone.now(), user=self.user)
+        content_type = ContentType.objects.get_for_model(Item)
+        versions = []
+        for item, data, item_tags in zip(items, django_serializers.serialize(
+                'python', items, fields=fields), tags):
+            data['fields'].update(tags=[tag.id for tag in item_tags], sets=[],
+                                  created_from=[])
+            versions.append(Version(revision=revision,
+                                    object_id=str(item.pk),
+                                    content_type=content_type,
+                                    db=Item.objects.db,
+                                    format='json',
+                                    serialized_data=json.dumps([data], cls=DjangoJSONEncoder),
+                                    object_repr=str(item)))
+        Version.objects.bulk_create(versions)
@@ -0,0 +1,110 @@
+import threading
+import uuid
+from collections import namedtuple
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+TREE_VERSION_KEY = 'inventory.itemtype_tree.version'
+
+# The ids and names of an item type and all of its descendants
+Descendants = namedtuple('Descendants', ['ids', 'names'])
+
+_tree = (None, None)
+_tree_lock = threading.Lock()
+
+
+def _build_tree():
+    """
+    Build the descendants of every item type from the MPTT fields
+
+    Returns a dict of item type id to Descendants and a dict of item type
+    name to id. Names are in tree order as get_descendants would give.
+    """
+    from .models import ItemType
+    nodes = ItemType.objects.order_by('tree_id', 'lft') \
+        .values_list('id', 'name', 'tree_id', 'rght')
+    descendants = {}
+    names = {}
+    ancestors = []
+    for type_id, name, tree_id, rght in nodes:
+        # Walking in tree order, ancestors are those still open on the stack
+        while len(ancestors) > 0 and (ancestors[-1][1] != tree_id or ancestors[-1][2] < rght):
+            ancestors.pop()
+        descendants[type_id] = ([type_id], [name])
+        names[name] = type_id
+        for ancestor_id, _, _ in ancestors:
+            descendants[ancestor_id][0].append(type_id)
+            descendants[ancestor_id][1].append(name)
+        ancestors.append((type_id, tree_id, rght))
+    descendants = {type_id: Descendants(frozenset(ids), tuple(type_names))
+                   for type_id, (ids, type_names) in descendants.items()}
+    return descendants, names
+
+
+def _get_tree(rebuild=False):
+    """
+    Get the item type tree for the current version, building it if needed
+
+    The version is kept in the shared cache and the tree in each process,
+    so each process queries the database once for each new version.
+    """
+    global _tree
+    version = cache.get(TREE_VERSION_KEY)
+    if version is None:
+        version = _new_version()
+    if _tree[0] == version and not rebuild:
+        return _tree[1]
+    with _tree_lock:
+        if _tree[0] != version or rebuild:
+            _tree = (version, _build_tree())
+    return _tree[1]
+
+
+def _new_version():
+    version = uuid.uuid4().hex
+    cache.set(TREE_VERSION_KEY, version, None)
+    return version
+
+
+def invalidate_itemtype_tree():
+    """
+    Mark the item type tree as out of date in every process
+
+    This process sees the change straight away, others once it is committed.
+    """
+    global _tree
+    with _tree_lock:
+        _tree = (None, None)
+    transaction.on_commit(_new_version)
+
+
+def get_descendants(item_type_id):
+    """
+    Get the ids and names of an item type and all of its descendants
+    """
+    descendants, names = _get_tree()
+    if item_type_id not in descendants:
+        # Might have been added by a transaction yet to commit when built
+        descendants, names = _get_tree(rebuild=True)
+    try:
+        return descendants[item_type_id]
+    except KeyError:
+        from .models import ItemType
+        raise ItemType.DoesNotExist('Item type {} does not exist'.format(item_type_id))
+
+
+def get_descendants_by_name(name):
+    """
+    As get_descendants but for the name of an item type
+    """
+    descendants, names = _get_tree()
+    if name not in names:
+        # Rebuilt for this process only, other processes are not affected
+        descendants, names = _get_tree(rebuild=True)
+    try:
+        return descendants[names[name]]
+    except KeyError:
+        from .models import ItemType
+        raise ItemType.DoesNotExist('Item type {} does not exist'.format(name))
@@ -4,7 +4,8 @@ import reversion
 from django.contrib.auth.models import User
 
 from mptt.models import MPTTModel, TreeForeignKey
-from pint import UnitRegistry, UndefinedUnitError
+
+from .units import as_measured_value, convert
 
 
 @reversion.register()
@@ -240,45 +241,30 @@ class ItemTransfer(models.Model):
                 self.linked_transfer = linked
         super(ItemTransfer, self).save(*args, **kwargs)
 
-    def _as_measured_value(self, amount, measure, ureg):
+    def _amount_in_item_measure(self, amount):
         """
-        Convert if possible to a value with units
+        Convert an amount in the transfer measure to the item measure
         """
-        try:
-            value = amount * ureg(measure)
-        except UndefinedUnitError:
-            value = amount * ureg.count
-        return value
+        return convert(amount, self.amount_measure.symbol, self.item.amount_measure.symbol)
 
     def check_transfer(self):
-        ureg = UnitRegistry()
-        existing = self._as_measured_value(self.item.amount_available,
-                                           self.item.amount_measure.symbol,
-                                           ureg)
-        to_take = self._as_measured_value(self.amount_taken,
-                                          self.amount_measure.symbol,
-                                          ureg)
+        existing = self.item.amount_available
+        to_take = self._amount_in_item_measure(self.amount_taken)
         if not self.is_addition and existing < to_take:
-            missing = ((existing - to_take) * -1)
+            missing = as_measured_value(to_take - existing, self.item.amount_measure.symbol)
             return (False, missing)
         return (True, 0)
 
-    def do_transfer(self, ureg=False):
+    def do_transfer(self):
         """
         Alter the item to reflect new amount
         """
-        if not ureg:
-            ureg = UnitRegistry()
         # Check if it is taking stuff from inventory or not
         # Note: if something has been taken you cannot put it
         # back
         if not self.has_taken:
-            existing = self._as_measured_value(self.item.amount_available,
-                                               self.item.amount_measure.symbol,
-                                               ureg)
-            to_take = self._as_measured_value(self.amount_taken,
-                                              self.amount_measure.symbol,
-                                              ureg)
+            existing = self.item.amount_available
+            to_take = self._amount_in_item_measure(self.amount_taken)
             if self.is_addition:
                 new_amount = existing + to_take
             else:
@@ -286,18 +272,14 @@ class ItemTransfer(models.Model):
                     new_amount = existing - to_take
                 else:
                     return False
-            self.item.amount_available = new_amount.magnitude
+            self.item.amount_available = new_amount
             self.item.save()
-            self.amount_available = self.amount_available - to_take.magnitude
+            self.amount_available = self.amount_available - self.amount_taken
         else:
             # We take from the transfer not the actual item since we've
             # already got it from the item
-            existing = self._as_measured_value(self.amount_available,
-                                               self.amount_measure.symbol,
-                                               ureg)
-            to_take = self._as_measured_value(self.amount_to_take,
-                                              self.amount_measure.symbol,
-                                              ureg)
+            existing = self.amount_available
+            to_take = self.amount_to_take
             if self.is_addition:
                 new_amount = existing + to_take
             else:
@@ -305,11 +287,11 @@ class ItemTransfer(models.Model):
                     new_amount = existing - to_take
                 else:
                     return False
-            self.amount_available = new_amount.magnitude
+            self.amount_available = new_amount
         self.save()
         return True
 
-    def do_complete(self, ureg=False):
+    def do_complete(self):
         """
         Check if there is anything left available, if not complete.
         """
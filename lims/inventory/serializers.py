@@ -184,3 +184,15 @@ class AmountMeasureSerializer(serializers.ModelSerializer):
     class Meta:
         model = AmountMeasure
         fields = '__all__'
+
+
+class ExportItemSerializer(DetailedItemSerializer):
+    """
+    Only serialize the given fields of items, e.g. those a file template names
+    """
+
+    def __init__(self, *args, **kwargs):
+        field_names = kwargs.pop('fields')
+        super().__init__(*args, **kwargs)
+        for name in set(self.fields.keys()) - set(field_names):
+            self.fields.pop(name)
@@ -0,0 +1,16 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from mptt.signals import node_moved
+
+from .models import ItemType
+from .itemtypes import invalidate_itemtype_tree
+
+
+@receiver(post_save, sender=ItemType)
+@receiver(post_delete, sender=ItemType)
+@receiver(node_moved, sender=ItemType)
+def itemtype_tree_changed(sender, **kwargs):
+    """
+    Invalidate the cached item type tree when any item type changes
+    """
+    invalidate_itemtype_tree()
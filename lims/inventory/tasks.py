@@ -0,0 +1,30 @@
+from celery import shared_task
+
+from lims.filetemplate.models import FileTemplate
+from lims.shared.models import ImportJob
+from .importer import ItemImporter
+
+
+@shared_task
+def import_items(job_id):
+    """
+    Import the items in the file of an ImportJob
+    """
+    job = ImportJob.objects.select_related('created_by').get(id=job_id)
+    encoding = job.options.get('encoding', 'utf-8')
+    try:
+        filetemplate = FileTemplate.objects.get(id=job.options['filetemplate'])
+        job.start(encoding)
+        chunks = filetemplate.read_chunks(job.lines(encoding), chunk_size=ItemImporter.chunk_size)
+        if chunks is False:
+            job.fail('File is format is incorrect')
+            return
+        importer = ItemImporter(job.created_by, job.options.get('permissions', {}))
+        for chunk in chunks:
+            rows = importer.import_chunk(chunk)
+            job.add_rows([({k: v for k, v in item_data.items() if k != 'errors'}, errors)
+                          for item_data, errors in rows])
+        job.finish()
+    except Exception as e:
+        job.fail(str(e))
+        raise
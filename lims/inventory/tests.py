@@ -4,9 +4,16 @@ from lims.filetemplate.models import FileTemplate, FileTemplateField
 from rest_framework import status
 from .models import Location, ItemType, AmountMeasure, Set, Item, Tag
 from django.contrib.auth.models import Permission, Group
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase
+from reversion.models import Version
 from .views import ViewPermissionsMixin
+from .importer import ItemImporter
 from lims.projects.models import Project, Product, ProductStatus
+from lims.shared.models import ImportJob
+from .units import get_unit_registry, conversion_factor, convert, as_measured_value
+from .itemtypes import TREE_VERSION_KEY, get_descendants, get_descendants_by_name
 import os
 
 
@@ -2115,6 +2122,162 @@ class ItemTestCase(LoggedInTestCase):
 
         self.assertEqual(prod.linked_inventory.count(), 1)
 
+    def test_importitems_stream(self):
+        self._asJoeBloggs()
+
+        proj = Project.objects.create(name="Test Project", primary_lab_contact=self._joeBloggs,
+                                      created_by=self._joeBloggs)
+        prod_status = ProductStatus.objects.create(name='Test')
+        prod = Product.objects.create(name="Test product", status=prod_status,
+                                      product_type=self._itemtype1, project=proj)
+
+        templ = FileTemplate.objects.create(name="ItemTemplate",
+                                            file_for="input")
+        for name in ['name', 'identifier', 'barcode', 'item_type', 'amount_available',
+                     'amount_measure', 'location', 'product']:
+            FileTemplateField.objects.create(name=name,
+                                             required=name not in ('barcode', 'product'),
+                                             is_identifier=False,
+                                             template=templ)
+        FileTemplateField.objects.create(name="joe",
+                                         is_property=True,
+                                         is_identifier=False,
+                                         template=templ)
+
+        filename = "test.csv"
+        file = open(filename, "w")
+        field_names = ['name', 'identifier', 'barcode', 'item_type', 'amount_available',
+                       'amount_measure', 'location', 'product', 'joe']
+        writer = csv.DictWriter(file, fieldnames=field_names)
+        writer.writeheader()
+        for i in range(5):
+            writer.writerow({
+                "name": "Item{}".format(i),
+                "identifier": "S{}".format(i),
+                "barcode": "BC{}".format(i),
+                "item_type": self._itemtype1.name,
+                "amount_available": i,
+                "amount_measure": self._measure.symbol,
+                "location": self._location.code,
+                "product": prod.product_identifier if i == 0 else "",
+                "joe": "bloggs",
+            })
+        writer.writerows([
+            # Duplicate barcode, no such item type
+            {"name": "Bad1", "identifier": "B1", "barcode": "BC1",
+             "item_type": self._itemtype1.name, "amount_available": 1,
+             "amount_measure": self._measure.symbol, "location": self._location.code},
+            {"name": "Bad2", "identifier": "B2", "item_type": "blobby",
+             "amount_available": 1, "amount_measure": self._measure.symbol,
+             "location": self._location.code},
+        ])
+        file.close()
+
+        ItemImporter.chunk_size = 2
+        try:
+            with open(filename, 'rb') as fp:
+                upl = SimpleUploadedFile('test.csv', fp.read())
+                response = self._client.post(
+                    "/inventory/importitems/", {"filetemplate": templ.id,
+                                                "items_file": upl,
+                                                "stream": "True",
+                                                "permissions":
+                                                    '{"joe_group": "rw", "jane_group": "r"}'},
+                    format='multipart')
+        finally:
+            ItemImporter.chunk_size = 1000
+            os.remove(filename)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([i["identifier"] for i in response.data["saved"]],
+                         ["S0", "S1", "S2", "S3", "S4"])
+        rejected = {i["identifier"]: i["errors"] for i in response.data["rejected"]}
+        self.assertEqual(set(rejected.keys()), {"B1", "B2"})
+        self.assertIn("barcode", rejected["B1"])
+        self.assertIn("item_type", rejected["B2"])
+
+        self.assertEqual(Item.objects.filter(identifier__startswith="S").count(), 5)
+        i = Item.objects.get(identifier="S3")
+        self.assertEqual(i.added_by, self._joeBloggs)
+        self.assertEqual(i.amount_available, 3)
+        self.assertIs(i.in_inventory, True)
+        self.assertIs(Item.objects.get(identifier="S0").in_inventory, False)
+        self.assertEqual(i.properties.get(name="joe").value, "bloggs")
+        self.assertEqual(
+            ViewPermissionsMixin().current_permissions(instance=i,
+                                                       group=Group.objects.get(
+                                                           name="jane_group")), "r")
+        self.assertEqual(list(prod.linked_inventory.values_list('identifier', flat=True)),
+                         ["S0"])
+        # Each item has a first version as if saved one at a time
+        version = Version.objects.get_for_object(i).get()
+        self.assertEqual(version.revision.user, self._joeBloggs)
+        self.assertEqual(version.field_dict["identifier"], "S3")
+        self.assertEqual(version.field_dict["amount_available"], 3)
+
+    def test_importitems_background(self):
+        self._asJoeBloggs()
+
+        templ = FileTemplate.objects.create(name="ItemTemplate",
+                                            file_for="input")
+        for name in ['name', 'identifier', 'item_type', 'amount_available',
+                     'amount_measure', 'location']:
+            FileTemplateField.objects.create(name=name,
+                                             required=True,
+                                             is_identifier=False,
+                                             template=templ)
+
+        filename = "test.csv"
+        file = open(filename, "w")
+        writer = csv.DictWriter(file, fieldnames=['name', 'identifier', 'item_type',
+                                                  'amount_available', 'amount_measure',
+                                                  'location'])
+        writer.writeheader()
+        writer.writerows([
+            {"name": "Item5", "identifier": "I5", "item_type": self._itemtype1.name,
+             "amount_available": 5, "amount_measure": self._measure.symbol,
+             "location": self._location.code},
+            {"name": "Item6", "identifier": "I6", "item_type": "blobby",
+             "amount_available": 5, "amount_measure": self._measure.symbol,
+             "location": self._location.code},
+        ])
+        file.close()
+        with open(filename, 'rb') as fp:
+            upl = SimpleUploadedFile('test.csv', fp.read())
+            response = self._client.post(
+                "/inventory/importitems/", {"filetemplate": templ.id,
+                                            "items_file": upl,
+                                            "background": "True",
+                                            "permissions": '{"jane_group": "r"}'},
+                format='multipart')
+        os.remove(filename)
+
+        # The job is returned as queued, but tests run tasks eagerly so it is
+        # done by the time it returns
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data["status"], ImportJob.PENDING)
+        job_id = response.data["id"]
+        response = self._client.get('/importjobs/{}/'.format(job_id))
+        self.assertEqual(response.data["status"], ImportJob.COMPLETE)
+        self.assertEqual(response.data["total"], 2)
+        self.assertEqual(response.data["saved"], 1)
+        self.assertEqual(response.data["rejected"], 1)
+        self.assertIs(Item.objects.filter(identifier="I5").exists(), True)
+        self.assertIs(Item.objects.filter(identifier="I6").exists(), False)
+
+        response = self._client.get('/importjobs/{}/rows/?saved=False'.format(job_id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = response.data["results"]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["line"], 2)
+        self.assertEqual(rows[0]["data"]["identifier"], "I6")
+        self.assertIn("item_type", rows[0]["errors"])
+
+        # Only whoever started the job can see it
+        self._asJaneDoe()
+        response = self._client.get('/importjobs/{}/'.format(job_id))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_export_selected_items(self):
         self._asJoeBloggs()
         templ = FileTemplate.objects.create(name="ExportItemTemplate",
@@ -2181,8 +2344,76 @@ class ItemTestCase(LoggedInTestCase):
         response = self._client.post(path, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_export_items_stream(self):
+        self._asJoeBloggs()
+        templ = FileTemplate.objects.create(name="ExportItemTemplate",
+                                            file_for="output")
+        for name in ['identifier', 'item_type', 'properties']:
+            FileTemplateField.objects.create(name=name,
+                                             required=True,
+                                             is_identifier=False,
+                                             template=templ)
+        selected = ",".join([str(self._item1.id), str(self._item2.id), str(self._item4.id)])
+        data = {"filetemplate": templ.id, "selected": selected, "stream": True}
+        response = self._client.post('/inventory/export_items/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "identifier,item_type,properties")
+        self.assertEqual([line.split(',')[:2] for line in lines[1:]],
+                         [["I4", self._itemtype3.name],
+                          ["I2", self._itemtype2.name],
+                          ["I1", self._itemtype1.name]])
+
     def test_item_get_tags(self):
         self.assertEqual(self._item1.get_tags(), "hello, world")
 
     def test_item_location_path(self):
         self.assertEqual(self._item1.location_path(), "On top of the cupboard > On a shelf")
+
+
+class UnitsTestCase(SimpleTestCase):
+
+    def test_shared_registry(self):
+        self.assertIs(get_unit_registry(), get_unit_registry())
+
+    def test_conversion(self):
+        self.assertEqual(conversion_factor('l', 'ml'), 1000)
+        self.assertEqual(convert(500, 'ml', 'l'), 0.5)
+        self.assertEqual(convert(3, 'item', 'item'), 3)
+
+    def test_unknown_symbol_is_count(self):
+        self.assertEqual('{}'.format(as_measured_value(2, 'item')), '2.0 count')
+
+
+class ItemTypeTreeTestCase(TestCase):
+
+    def setUp(self):
+        self._top = ItemType.objects.create(name="Top")
+        self._middle = ItemType.objects.create(name="Middle", parent=self._top)
+        self._bottom = ItemType.objects.create(name="Bottom", parent=self._middle)
+        self._other = ItemType.objects.create(name="Other")
+
+    def test_descendants(self):
+        top = get_descendants(self._top.id)
+        self.assertEqual(top.ids, {self._top.id, self._middle.id, self._bottom.id})
+        self.assertEqual(top.names, ("Top", "Middle", "Bottom"))
+        self.assertEqual(get_descendants_by_name("Middle").names, ("Middle", "Bottom"))
+        self.assertEqual(get_descendants_by_name("Other").ids, {self._other.id})
+
+    def test_descendants_invalid(self):
+        get_descendants_by_name("Top")
+        version = cache.get(TREE_VERSION_KEY)
+        with self.assertRaises(ItemType.DoesNotExist):
+            get_descendants_by_name("Missing")
+        self.assertEqual(cache.get(TREE_VERSION_KEY), version)
+
+    def test_descendants_after_change(self):
+        self.assertEqual(get_descendants_by_name("Top").names, ("Top", "Middle", "Bottom"))
+        self._bottom.move_to(self._other)
+        self.assertEqual(get_descendants_by_name("Top").names, ("Top", "Middle"))
+        self.assertEqual(get_descendants_by_name("Other").names, ("Other", "Bottom"))
+        ItemType.objects.create(name="New", parent=self._top)
+        self.assertEqual(get_descendants_by_name("Top").names, ("Top", "Middle", "New"))
+        self._middle.delete()
+        self.assertEqual(get_descendants_by_name("Top").names, ("Top", "New"))
@@ -0,0 +1,64 @@
+import threading
+from functools import lru_cache
+
+from pint import UnitRegistry, UndefinedUnitError
+
+
+_ureg = None
+_ureg_lock = threading.Lock()
+
+
+def get_unit_registry():
+    """
+    Get the UnitRegistry shared by the whole process
+
+    Creating a UnitRegistry loads and parses the full unit definition
+    file so it is only done once, on first use.
+    """
+    global _ureg
+    if _ureg is None:
+        with _ureg_lock:
+            if _ureg is None:
+                _ureg = UnitRegistry()
+    return _ureg
+
+
+@lru_cache(maxsize=None)
+def unit_for_symbol(symbol):
+    """
+    Get a quantity of one in the units of an AmountMeasure symbol
+
+    Symbols that are not known units (e.g. item) are treated as a count.
+    """
+    ureg = get_unit_registry()
+    try:
+        return ureg(symbol)
+    except UndefinedUnitError:
+        return 1 * ureg.count
+
+
+def as_measured_value(amount, symbol):
+    """
+    Convert an amount to a value with the units of the symbol
+    """
+    return float(amount) * unit_for_symbol(symbol)
+
+
+@lru_cache(maxsize=None)
+def conversion_factor(from_symbol, to_symbol):
+    """
+    Get the factor to convert an amount in one measure to another
+
+    Raises a DimensionalityError if the measures are not compatible.
+    """
+    if from_symbol == to_symbol:
+        return 1.0
+    to_units = unit_for_symbol(to_symbol).units
+    return unit_for_symbol(from_symbol).to(to_units).magnitude
+
+
+def convert(amount, from_symbol, to_symbol):
+    """
+    Convert an amount in one measure to the equivalent in another
+    """
+    return amount * conversion_factor(from_symbol, to_symbol)
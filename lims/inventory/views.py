@@ -2,8 +2,7 @@ import io
 import json
 
 from django.core.exceptions import ObjectDoesNotExist
-
-from pint import UnitRegistry
+from django.http import StreamingHttpResponse
 
 import django_filters
 
@@ -18,20 +17,21 @@ from rest_framework.filters import (OrderingFilter,
 
 from lims.permissions.permissions import (IsInAdminGroupOrRO,
                                           ViewPermissionsMixin, ExtendedObjectPermissions,
-                                          ExtendedObjectPermissionsFilter)
+                                          ExtendedObjectPermissionsFilter,
+                                          prefetch_group_permissions)
 from lims.shared.mixins import StatsViewMixin, AuditTrailViewMixin
+from lims.shared.models import ImportJob
+from lims.shared.serializers import ImportJobSerializer
+from lims.shared.tasks import delay_on_commit
 from lims.filetemplate.models import FileTemplate
 from lims.projects.models import Product
 from .models import Set, Item, ItemTransfer, ItemType, Location, AmountMeasure
 from .serializers import (AmountMeasureSerializer, ItemTypeSerializer, LocationSerializer,
                           ItemSerializer, DetailedItemSerializer, SetSerializer,
-                          ItemTransferSerializer)
+                          ItemTransferSerializer, ExportItemSerializer)
 from .providers import InventoryItemPluginProvider
-
-
-# Define as module level due to issues with file locking
-# when calling a function requiring it multiple times
-ureg = UnitRegistry()
+from .importer import ItemImporter
+from .tasks import import_items
 
 
 class LeveledMixin(AuditTrailViewMixin):
@@ -130,6 +130,25 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
     search_fields = ('name', 'identifier', 'item_type__name', 'location__name',
                      'location__parent__name')
     filter_class = InventoryFilterSet
+    # Items loaded and written at once when exporting
+    EXPORT_CHUNK_SIZE = 500
+    # Relations to load to export each column
+    EXPORT_SELECT = {
+        'item_type': 'item_type',
+        'amount_measure': 'amount_measure',
+        'concentration_measure': 'concentration_measure',
+        'location': 'location',
+        'location_name': 'location',
+        'location_path': 'location',
+        'added_by': 'added_by',
+    }
+    EXPORT_PREFETCH = {
+        'transfers': 'transfers__amount_measure',
+        'properties': 'properties',
+        'created_from': 'created_from__item_type',
+        'tags': 'tags',
+        'sets': 'sets',
+    }
 
     def get_serializer_class(self):
         if self.action == 'list':
@@ -157,6 +176,26 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
         for p in plugins:
             p.update()
 
+    def _stream_import(self, request, filetemplate, f, permissions):
+        chunks = filetemplate.read_chunks(f, chunk_size=ItemImporter.chunk_size)
+        if chunks is False:
+            return Response({'message': 'File is format is incorrect'}, status=400)
+        importer = ItemImporter(request.user, permissions)
+        saved = []
+        rejected = []
+        for chunk in chunks:
+            for item_data, errors in importer.import_chunk(chunk):
+                if errors is None:
+                    saved.append(item_data)
+                else:
+                    rejected.append(item_data)
+        if len(saved) + len(rejected) == 0:
+            return Response({'message': 'File is format is incorrect'}, status=400)
+        return Response({
+            'saved': saved,
+            'rejected': rejected
+        })
+
     @list_route(methods=['POST'], parser_classes=(FormParser, MultiPartParser,))
     def importitems(self, request):
         """
@@ -166,6 +205,10 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
         file_template: The ID of the file template to use to parse the file
         items_file: The CSV file to parse
         permissions: Standard permissions format ({"name": "rw"}) to give to all items
+        stream: (optional) True to import the file in chunks with each chunk
+                saved at once, for large files
+        background: (optional) True to import as stream does but on a worker.
+                    Returns the ImportJob to follow the progress of.
         """
         file_template_id = request.data.get('filetemplate', None)
         uploaded_file = request.data.get('items_file', None)
@@ -177,10 +220,25 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
             except FileTemplate.DoesNotExist:
                 return Response({'message': 'File template does not exist'}, status=404)
             encoding = 'utf-8' if request.encoding is None else request.encoding
+            if request.data.get('background', None) == 'True':
+                job = ImportJob.objects.create(kind='items',
+                                               file=uploaded_file,
+                                               options={
+                                                   'filetemplate': filetemplate.id,
+                                                   'permissions': json.loads(permissions),
+                                                   'encoding': encoding,
+                                               },
+                                               created_by=request.user)
+                delay_on_commit(import_items, job.id)
+                return Response(ImportJobSerializer(job).data, status=202)
             f = io.TextIOWrapper(uploaded_file.file, encoding=encoding)
+            if request.data.get('stream', None) == 'True':
+                return self._stream_import(request, filetemplate, f, json.loads(permissions))
             items_to_import = filetemplate.read(f, as_list=True)
             saved = []
             rejected = []
+            imported = []
+            parsed_permissions = {}
             if items_to_import:
                 for item_data in items_to_import:
                     item_data['assign_groups'] = json.loads(permissions)
@@ -198,7 +256,7 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
                         item, parsed_permissions = self.clean_serializer_of_permissions(item)
                         item.validated_data['added_by'] = request.user
                         instance = item.save()
-                        self.assign_permissions(instance, parsed_permissions)
+                        imported.append(instance)
                         if 'product' in item_data:
                             try:
                                 prod = item_data['product']
@@ -210,6 +268,8 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
                     else:
                         item_data['errors'] = item.errors
                         rejected.append(item_data)
+                # All items are given the same permissions so do them together
+                self.bulk_assign_permissions(imported, parsed_permissions)
             else:
                 return Response({'message': 'File is format is incorrect'}, status=400)
             response_data = {
@@ -220,6 +280,16 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
 
     @list_route(methods=['POST'])
     def export_items(self, request):
+        """
+        Export items to a CSV file
+
+        Expects:
+        filetemplate: The ID of the file template to write the file with
+        selected: (optional) Comma separated IDs of the items to export,
+                  otherwise items are filtered by the query params
+        stream: (optional) True to stream the file as it is written rather
+                than return it as a string
+        """
         # The ID of the file template
         file_template_id = request.data.get('filetemplate', None)
         # The ID's of items to get
@@ -232,17 +302,49 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
                 # The query used to get the results
                 # Query params in URL used NOT in .data
                 items = self.filter_queryset(self.get_queryset())
-            serializer = DetailedItemSerializer(items, many=True)
             try:
                 file_template = FileTemplate.objects.get(pk=file_template_id)
             except:
                 return Response({'message': 'File template does not exist'}, status=404)
-            with io.StringIO() as output_file:
-                output_file = file_template.write(output_file, serializer.data)
-                output_file.seek(0)
-                return Response(output_file.read(), content_type='text/csv')
+            rows = self._export_rows(items, file_template.column_names())
+            output = file_template.write_chunks(rows, chunk_size=self.EXPORT_CHUNK_SIZE)
+            if request.data.get('stream', None) in (True, 'True'):
+                response = StreamingHttpResponse(output, content_type='text/csv')
+                response['Content-Disposition'] = 'attachment; filename="items.csv"'
+                return response
+            return Response(''.join(output), content_type='text/csv')
         return Response({'Please supply a file template and data to export'}, status=400)
 
+    def _export_rows(self, items, columns):
+        """
+        Serialize the columns of items a chunk at a time
+
+        Only the relations the columns need are loaded, together for each
+        chunk rather than for every item.
+        """
+        serializer = ExportItemSerializer(fields=columns)
+        select = set(self.EXPORT_SELECT[c] for c in columns if c in self.EXPORT_SELECT)
+        prefetch = [self.EXPORT_PREFETCH[c] for c in columns if c in self.EXPORT_PREFETCH]
+        ids = []
+        for item_id in items.values_list('pk', flat=True).iterator():
+            ids.append(item_id)
+            if len(ids) == self.EXPORT_CHUNK_SIZE:
+                yield from self._export_chunk(serializer, ids, select, prefetch)
+                ids = []
+        yield from self._export_chunk(serializer, ids, select, prefetch)
+
+    def _export_chunk(self, serializer, ids, select, prefetch):
+        if len(ids) == 0:
+            return
+        chunk = Item.objects.filter(pk__in=ids).select_related(*select) \
+            .prefetch_related(*prefetch).in_bulk()
+        if 'permissions' in serializer.fields:
+            prefetch_group_permissions(chunk.values())
+        # Keep the order of the query
+        for item_id in ids:
+            if item_id in chunk:
+                yield serializer.to_representation(chunk[item_id])
+
     @detail_route(methods=['POST'])
     def transfer(self, request, pk=None):
         """
@@ -299,7 +401,7 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
             transfer_status = tfr.check_transfer()
             if transfer_status[0] is True:
                 tfr.save()
-                tfr.do_transfer(ureg)
+                tfr.do_transfer()
             else:
                 return Response(
                     {'message': 'Inventory item {} ({}) is short of amount by {}'.format(
@@ -320,7 +422,7 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
             except ObjectDoesNotExist:
                 return Response({'message': 'No item transfer exists with that ID'}, status=404)
             tfr.is_addition = True
-            tfr.do_transfer(ureg)
+            tfr.do_transfer()
             tfr.delete()
             return Response({'message': 'Transfer cancelled'})
         return Response({'message': 'You must provide a transfer ID'}, status=400)
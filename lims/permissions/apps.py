@@ -2,5 +2,7 @@ from django.apps import AppConfig
 
 
 class PermissionsConfig(AppConfig):
+    name = 'lims.permissions'
+
     def ready(self):
         import lims.permissions.signals  # noqa
@@ -0,0 +1,68 @@
+from django.utils.functional import cached_property
+
+from guardian.core import ObjectPermissionChecker
+
+
+class UserCapabilities():
+    """
+    What a user is able to do, worked out once per request
+
+    Group names are loaded in one query on first use and group
+    permissions are cached per object.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._group_perms = {}
+
+    @cached_property
+    def _groups(self):
+        if not self.user.is_authenticated():
+            return {}
+        return dict(self.user.groups.values_list('name', 'id'))
+
+    @property
+    def groups(self):
+        return frozenset(self._groups.keys())
+
+    @property
+    def group_ids(self):
+        return frozenset(self._groups.values())
+
+    def in_group(self, name):
+        return name in self.groups
+
+    @property
+    def is_admin(self):
+        return self.in_group('admin')
+
+    @property
+    def is_staff(self):
+        return self.in_group('staff')
+
+    @cached_property
+    def _checker(self):
+        return ObjectPermissionChecker(self.user)
+
+    def group_perms(self, obj):
+        """
+        Get the codenames of the permissions the user's groups have on obj
+        """
+        key = (obj._meta.label, obj.pk)
+        if key not in self._group_perms:
+            self._group_perms[key] = frozenset(self._checker.get_group_perms(obj))
+        return self._group_perms[key]
+
+
+def get_capabilities(user):
+    """
+    Get the capabilities of a user
+
+    The user is loaded afresh by authentication on every request so the
+    capabilities are cached on it for the length of the request.
+    """
+    capabilities = getattr(user, '_capabilities', None)
+    if capabilities is None:
+        capabilities = UserCapabilities(user)
+        user._capabilities = capabilities
+    return capabilities
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def index_group_permissions(apps, schema_editor):
+    """
+    Copy existing group object permissions into the index
+    """
+    GroupObjectPermission = apps.get_model('guardian', 'GroupObjectPermission')
+    GroupPermissionIndex = apps.get_model('permissions', 'GroupPermissionIndex')
+    permissions = GroupObjectPermission.objects.values_list(
+        'content_type_id', 'object_pk', 'group_id', 'permission_id')
+    GroupPermissionIndex.objects.bulk_create(
+        [GroupPermissionIndex(content_type_id=content_type_id, object_id=int(object_pk),
+                              group_id=group_id, permission_id=permission_id)
+         for content_type_id, object_pk, group_id, permission_id in permissions.iterator()
+         if object_pk.isdigit()],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0008_alter_user_username_max_length'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('guardian', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupPermissionIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.Group')),
+                ('permission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.Permission')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='grouppermissionindex',
+            unique_together=set([('group', 'permission', 'object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='grouppermissionindex',
+            index_together=set([('content_type', 'permission', 'group', 'object_id')]),
+        ),
+        migrations.RunPython(index_group_permissions, migrations.RunPython.noop),
+    ]
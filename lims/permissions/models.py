@@ -0,0 +1,24 @@
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+
+
+class GroupPermissionIndex(models.Model):
+    """
+    An integer keyed copy of guardian's group object permissions
+
+    GroupObjectPermission stores object IDs as text so filtering a list of
+    objects by permission cannot use an index. This is kept in step with it
+    so list views can join on integer keys instead.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    group = models.ForeignKey(Group)
+    permission = models.ForeignKey(Permission)
+
+    class Meta:
+        unique_together = ('group', 'permission', 'object_id')
+        index_together = ('content_type', 'permission', 'group', 'object_id')
+
+    def __str__(self):
+        return '{} {} {}'.format(self.group, self.permission.codename, self.object_id)
@@ -1,7 +1,10 @@
-from django.contrib.auth.models import Group
-from django.db.models import Model
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import Model, AutoField
 
-from guardian.shortcuts import (get_groups_with_perms, assign_perm, remove_perm,
+from guardian.models import GroupObjectPermission
+from guardian.shortcuts import (get_groups_with_perms, remove_perm,
                                 get_perms)
 
 from rest_framework import serializers
@@ -10,6 +13,8 @@ from rest_framework import filters
 from rest_framework.response import Response
 from rest_framework.decorators import detail_route
 
+from .capabilities import get_capabilities
+from .models import GroupPermissionIndex
 from .signals import permissions_removed, permissions_changed
 
 
@@ -39,7 +44,7 @@ class IsAddressOwner(permissions.BasePermission):
 
     def has_object_permission(self, request, view, obj):
         if request.user and request.user.is_authenticated():
-            has_group = request.user.groups.filter(name='admin').exists()
+            has_group = get_capabilities(request.user).is_admin
             if obj.user == request.user or has_group:
                 return True
         return False
@@ -51,7 +56,7 @@ class IsAddressOwnerFilter(filters.BaseFilterBackend):
     """
 
     def filter_queryset(self, request, queryset, view):
-        has_group = request.user.groups.filter(name='admin').exists()
+        has_group = get_capabilities(request.user).is_admin
         if has_group:
             return queryset
         else:
@@ -66,7 +71,7 @@ class IsInGroupOrRO(permissions.BasePermission):
 
     def has_permission(self, request, view):
         if request.user and request.user.is_authenticated():
-            has_group = request.user.groups.filter(name=self.group_name).exists()
+            has_group = get_capabilities(request.user).in_group(self.group_name)
             if request.method in permissions.SAFE_METHODS or has_group:
                 return True
         return False
@@ -94,14 +99,14 @@ class IsInAdminGroupOrTheUser(permissions.BasePermission):
     def has_permission(self, request, view):
         if request.user and request.user.is_authenticated():
             # Only admin users can post
-            if request.method == 'POST' and not request.user.groups.filter(name='admin').exists():
+            if request.method == 'POST' and not get_capabilities(request.user).is_admin:
                 return False
             return True
         return False
 
     def has_object_permission(self, request, view, obj):
         if request.user and request.user.is_authenticated():
-            has_group = request.user.groups.filter(name='admin').exists()
+            has_group = get_capabilities(request.user).is_admin
             if obj.id == request.user.id or has_group:
                 return True
         return False
@@ -110,15 +115,26 @@ class IsInAdminGroupOrTheUser(permissions.BasePermission):
 class ExtendedObjectPermissionsFilter(filters.DjangoObjectPermissionsFilter):
     """
     Allow admin group users full access to all items
+
+    Other users see the items their groups have view permissions for, using
+    the integer keyed GroupPermissionIndex rather than guardian's tables.
     """
 
     def filter_queryset(self, request, queryset, view):
         # If we're the admin group allow access otherwise test
         # for the correct permissions.
-        if request.user.groups.filter(name='admin').exists():
+        capabilities = get_capabilities(request.user)
+        if capabilities.is_admin or request.user.is_superuser:
             return queryset
-        return super(ExtendedObjectPermissionsFilter, self).filter_queryset(
-                request, queryset, view)
+        model = queryset.model
+        if not isinstance(model._meta.pk, AutoField):
+            return super(ExtendedObjectPermissionsFilter, self).filter_queryset(
+                    request, queryset, view)
+        permitted = GroupPermissionIndex.objects.filter(
+            content_type=ContentType.objects.get_for_model(model),
+            permission__codename='view_{}'.format(model._meta.model_name),
+            group_id__in=capabilities.group_ids).values('object_id')
+        return queryset.filter(pk__in=permitted)
 
 
 class ExtendedObjectPermissions(permissions.DjangoObjectPermissions):
@@ -140,7 +156,7 @@ class ExtendedObjectPermissions(permissions.DjangoObjectPermissions):
     def has_permission(self, request, view):
         # If we're the admin group allow access otherwise test
         # for the correct permissions.
-        if request.user.groups.filter(name='admin').exists():
+        if get_capabilities(request.user).is_admin:
             return True
         return super(ExtendedObjectPermissions, self).has_permission(
                 request, view)
@@ -148,12 +164,34 @@ class ExtendedObjectPermissions(permissions.DjangoObjectPermissions):
     def has_object_permission(self, request, view, obj):
         # If we're the admin group allow access otherwise test
         # for the correct permissions.
-        if request.user.groups.filter(name='admin').exists():
+        if get_capabilities(request.user).is_admin:
             return True
         return super(ExtendedObjectPermissions, self).has_object_permission(
                 request, view, obj)
 
 
+def prefetch_group_permissions(objects):
+    """
+    Load the group permissions of many objects of one model at once
+
+    SerializerPermissionsMixin uses these rather than querying per object.
+    """
+    objects = list(objects)
+    if len(objects) == 0:
+        return
+    content_type = ContentType.objects.get_for_model(objects[0])
+    by_pk = {}
+    for obj in objects:
+        obj._group_permissions = {}
+        by_pk.setdefault(str(obj.pk), []).append(obj)
+    object_permissions = GroupObjectPermission.objects.filter(
+        content_type=content_type,
+        object_pk__in=by_pk.keys()).select_related('group', 'permission')
+    for op in object_permissions:
+        for obj in by_pk[op.object_pk]:
+            obj._group_permissions.setdefault(op.group.name, []).append(op.permission.codename)
+
+
 class SerializerPermissionsMixin(serializers.Serializer):
     """
     Mixin to add fields to serializer for add/list of permissions
@@ -172,6 +210,8 @@ class SerializerPermissionsMixin(serializers.Serializer):
         # These are used for display/editing and are not
         # used to actually limit anything, that is done
         # in the view
+        if hasattr(obj, '_group_permissions'):
+            return obj._group_permissions
         perms = {}
         if isinstance(obj, Model):
             for grp, p in get_groups_with_perms(obj, attach_perms=True).items():
@@ -195,6 +235,13 @@ class ViewPermissionsMixin():
         'view_{}',
     )
 
+    @property
+    def capabilities(self):
+        """
+        The capabilities of the user making the request
+        """
+        return get_capabilities(self.request.user)
+
     def clean_serializer_of_permissions(self, serializer):
         """
         Remove assign_groups from serializer before it is saved
@@ -230,53 +277,136 @@ class ViewPermissionsMixin():
             remove_perm(perm.format(model_name), group, instance)
         return True
 
+    def _create_group_permissions(self, content_type, object_permissions):
+        """
+        Insert group object permissions that do not already exist
+
+        Inserts them and their GroupPermissionIndex rows in bulk as
+        bulk_create does not send the post_save that indexes them.
+        """
+        object_pks = set(op.object_pk for op in object_permissions)
+        existing = set(GroupObjectPermission.objects.filter(
+            content_type=content_type,
+            object_pk__in=object_pks).values_list('group_id', 'permission_id', 'object_pk'))
+        to_create = {}
+        for op in object_permissions:
+            key = (op.group_id, op.permission_id, op.object_pk)
+            if key not in existing:
+                to_create[key] = op
+        GroupObjectPermission.objects.bulk_create(to_create.values())
+        GroupPermissionIndex.objects.bulk_create([
+            GroupPermissionIndex(content_type=content_type, object_id=int(op.object_pk),
+                                 group_id=op.group_id, permission_id=op.permission_id)
+            for op in to_create.values() if op.object_pk.isdigit()])
+
+    def _delete_group_permissions(self, content_type, object_pks, groups, codenames):
+        """
+        Delete the named group object permissions from many objects
+
+        Deletes them and their GroupPermissionIndex rows together, in SQL
+        as delete would send a post_delete to remove each from the index.
+        """
+        permission_ids = list(GroupObjectPermission.objects.filter(
+            content_type=content_type, object_pk__in=object_pks,
+            group__in=groups, permission__codename__in=codenames).values_list('id', flat=True))
+        if len(permission_ids) == 0:
+            return
+        with transaction.atomic(savepoint=False):
+            GroupPermissionIndex.objects.filter(
+                content_type=content_type, object_id__in=[int(pk) for pk in object_pks
+                                                          if pk.isdigit()],
+                group__in=groups, permission__codename__in=codenames).delete()
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM {} WHERE id = ANY(%s)'.format(
+                    connection.ops.quote_name(GroupObjectPermission._meta.db_table)),
+                    [permission_ids])
+
+    def _by_model(self, instances):
+        """
+        Group instances by their model
+        """
+        by_model = {}
+        for instance in instances:
+            by_model.setdefault(instance._meta.model, []).append(instance)
+        return by_model.items()
+
+    def bulk_assign_permissions(self, instances, permissions):
+        """
+        Assign the relevant permissions to groups for many objects at once
+
+        Same as assign_permissions but computes the permission rows for all
+        objects and groups and inserts them together. Objects can be of
+        different models.
+        """
+        permissions = permissions or {}
+        if any(perm not in ('r', 'rw') for perm in permissions.values()):
+            raise serializers.ValidationError({'message': 'Permission must by r or rw'})
+        groups = {g.name: g for g in Group.objects.filter(name__in=permissions.keys())}
+        if len(groups) != len(permissions):
+            return False
+        read_only = [groups[g] for g, perm in permissions.items() if perm == 'r']
+        for model, objs in self._by_model(instances):
+            model_name = model._meta.model_name
+            content_type = ContentType.objects.get_for_model(model)
+            codenames = {p.codename: p for p in
+                         Permission.objects.filter(content_type=content_type)}
+            object_pks = [str(obj.pk) for obj in objs]
+            if len(read_only) > 0:
+                # Only give read permissions
+                self._delete_group_permissions(
+                    content_type, object_pks, read_only,
+                    [pt.format(model_name) for pt in self.PERM_TEMPLATE
+                     if not pt.startswith('view_')])
+            object_permissions = []
+            for name, perm in permissions.items():
+                # Give read and write permissions by building the
+                # permission codename from templates and the model name
+                templates = self.PERM_TEMPLATE if perm == 'rw' else ('view_{}',)
+                for pt in templates:
+                    for pk in object_pks:
+                        object_permissions.append(GroupObjectPermission(
+                            permission=codenames[pt.format(model_name)],
+                            content_type=content_type,
+                            object_pk=pk,
+                            group=groups[name]))
+            self._create_group_permissions(content_type, object_permissions)
+        for instance in instances:
+            permissions_changed.send(sender=instance.__class__,
+                                     id=instance.id,
+                                     permissions=permissions)
+        return True
+
     def assign_permissions(self, instance, permissions):
         """
         Assign the relevant permissions to a user for an object
 
         Can be used to change permissions from rw/r and vice versa
         """
-        model_name = instance._meta.model_name
-        for group, perm in permissions.items():
-            try:
-                grp = Group.objects.get(name=group)
-            except Group.DoesNotExist:
-                return False
-            current_permission = self.current_permissions(grp, instance)
-            if perm == 'rw':
-                # Give read and write permissions
-                # Iterate through templates and build the
-                # permission codename based on model name
-                for pt in self.PERM_TEMPLATE:
-                    assign_perm(pt.format(model_name), grp, instance)
-            elif perm == 'r':
-                # Only give read permissions
-                if current_permission == 'rw':
-                    self.remove_group_permissions(instance, grp)
-                assign_perm('view_%s' % model_name, grp, instance)
-            else:
-                raise serializers.ValidationError({'message': 'Permission must by r or rw'})
-        permissions_changed.send(sender=instance.__class__,
-                                 id=instance.id,
-                                 permissions=permissions)
+        return self.bulk_assign_permissions([instance], permissions)
+
+    def bulk_unassign_permissions(self, instances, groups):
+        """
+        Remove entire groups from accessing many objects at once
+        """
+        group_objs = list(Group.objects.filter(name__in=groups))
+        if len(group_objs) != len(set(groups)):
+            return False
+        for model, objs in self._by_model(instances):
+            model_name = model._meta.model_name
+            self._delete_group_permissions(ContentType.objects.get_for_model(model),
+                                           [str(obj.pk) for obj in objs], group_objs,
+                                           [pt.format(model_name) for pt in self.PERM_TEMPLATE])
+        for instance in instances:
+            permissions_removed.send(sender=instance.__class__,
+                                     id=instance.id,
+                                     groups=groups)
         return True
 
     def unassign_permissions(self, instance, groups):
         """
         Remove entire groups from accessing a given object
         """
-        model_name = instance._meta.model_name
-        for g in groups:
-            try:
-                group = Group.objects.get(name=g)
-            except Group.DoesNotExist:
-                return False
-            for perm in self.PERM_TEMPLATE:
-                remove_perm(perm.format(model_name), group, instance)
-        permissions_removed.send(sender=instance.__class__,
-                                 id=instance.id,
-                                 groups=groups)
-        return True
+        return self.bulk_unassign_permissions([instance], groups)
 
     def clone_group_permissions(self, clone_from, clone_to):
         """
@@ -286,13 +416,38 @@ class ViewPermissionsMixin():
         a Project to that of its child Products
         """
         # NEED TO CHECK IF MEMBER OF AT LEAST ONE GROUP BEFORE CLONE!!!!
-        permissions = get_groups_with_perms(clone_from, attach_perms=True)
-        model_name = clone_to._meta.model_name
-        for group, perms in permissions.items():
-            for p in perms:
+        self.bulk_clone_group_permissions([(clone_from, clone_to)])
+
+    def bulk_clone_group_permissions(self, clone_pairs):
+        """
+        Clone group permissions for many (clone_from, clone_to) pairs at once
+
+        Same as clone_group_permissions but with one lookup per distinct
+        object cloned from and a single insert of all the permissions.
+        All objects cloned to must be of the same model.
+        """
+        if len(clone_pairs) == 0:
+            return
+        clone_model = clone_pairs[0][1]._meta.model
+        content_type = ContentType.objects.get_for_model(clone_model)
+        codenames = {p.codename: p for p in
+                     Permission.objects.filter(content_type=content_type)}
+        from_perms = {}
+        object_permissions = []
+        for clone_from, clone_to in clone_pairs:
+            if clone_from not in from_perms:
+                from_perms[clone_from] = get_groups_with_perms(clone_from, attach_perms=True)
+            for group, perms in from_perms[clone_from].items():
                 # Split permission to get operator e.g. change
-                operator = p.split('_')[0]
-                assign_perm('{}_{}'.format(operator, model_name), group, clone_to)
+                operators = set(p.split('_')[0] for p in perms)
+                for operator in operators:
+                    codename = '{}_{}'.format(operator, clone_model._meta.model_name)
+                    object_permissions.append(GroupObjectPermission(
+                        permission=codenames[codename],
+                        content_type=content_type,
+                        object_pk=str(clone_to.pk),
+                        group=group))
+        self._create_group_permissions(content_type, object_permissions)
 
     def perform_create(self, serializer):
         """
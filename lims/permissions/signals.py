@@ -1,5 +1,33 @@
 from django import dispatch
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from guardian.models import GroupObjectPermission
+
+from .models import GroupPermissionIndex
 
 
 permissions_changed = dispatch.Signal(providing_args=['id', 'permissions'])
 permissions_removed = dispatch.Signal(providing_args=['id', 'groups'])
+
+
+@receiver(post_save, sender=GroupObjectPermission)
+def index_group_permission(sender, instance, **kwargs):
+    """
+    Add a group object permission to the integer keyed index
+    """
+    if instance.object_pk.isdigit():
+        GroupPermissionIndex.objects.get_or_create(content_type_id=instance.content_type_id,
+                                                   object_id=int(instance.object_pk),
+                                                   group_id=instance.group_id,
+                                                   permission_id=instance.permission_id)
+
+
+@receiver(post_delete, sender=GroupObjectPermission)
+def unindex_group_permission(sender, instance, **kwargs):
+    """
+    Remove a group object permission from the integer keyed index
+    """
+    if instance.object_pk.isdigit():
+        GroupPermissionIndex.objects.filter(object_id=int(instance.object_pk),
+                                            group_id=instance.group_id,
+                                            permission_id=instance.permission_id).delete()
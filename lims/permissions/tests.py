@@ -1,6 +1,13 @@
 from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Group
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from guardian.shortcuts import get_perms
 from lims.shared.loggedintestcase import LoggedInTestCase
+from lims.projects.models import Project
+from .models import GroupPermissionIndex
+from .permissions import ViewPermissionsMixin
 from rest_framework import status
 
 
@@ -100,3 +107,73 @@ class PermissionTestCase(LoggedInTestCase):
         response = self._client.delete("/permissions/%d/" % self._changeEquipPermission.id)
         self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
         self.assertIs(Permission.objects.filter(name="Can change equipment").exists(), True)
+
+    def test_group_query_once_per_request(self):
+        # The admin group check is made by the permission class, filter and
+        # view but the user's groups are only loaded once
+        self._janeDoe.user_permissions.add(Permission.objects.get(codename="view_project"))
+        for login in (self._asJaneDoe, self._asAdmin):
+            login()
+            with CaptureQueriesContext(connection) as queries:
+                response = self._client.get('/projects/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            group_queries = [q for q in queries
+                             if 'FROM "auth_group" INNER JOIN "auth_user_groups"' in q['sql']]
+            self.assertLessEqual(len(group_queries), 1)
+
+    def test_group_permission_index(self):
+        project = Project.objects.create(name="Joe's Project",
+                                         created_by=self._joeBloggs,
+                                         primary_lab_contact=self._staffUser)
+        other = Project.objects.create(name="Jane's Project",
+                                       created_by=self._janeDoe,
+                                       primary_lab_contact=self._staffUser)
+        ViewPermissionsMixin().assign_permissions(instance=project,
+                                                  permissions={"joe_group": "rw",
+                                                               "jane_group": "r"})
+        ViewPermissionsMixin().assign_permissions(instance=other,
+                                                  permissions={"jane_group": "rw"})
+        index = GroupPermissionIndex.objects.filter(object_id=project.id,
+                                                    permission__codename='view_project')
+        self.assertEqual(set(index.values_list('group__name', flat=True)),
+                         {"joe_group", "jane_group"})
+
+        self._joeBloggs.user_permissions.add(Permission.objects.get(codename="view_project"))
+        self._asJoeBloggs()
+        response = self._client.get('/projects/')
+        self.assertEqual([p["id"] for p in response.data["results"]], [project.id])
+
+        ViewPermissionsMixin().unassign_permissions(instance=project, groups=["joe_group"])
+        self.assertEqual(set(index.values_list('group__name', flat=True)), {"jane_group"})
+        response = self._client.get('/projects/')
+        self.assertEqual(len(response.data["results"]), 0)
+
+    def test_bulk_assign_permissions(self):
+        projects = [Project.objects.create(name="Project {}".format(i),
+                                           created_by=self._joeBloggs,
+                                           primary_lab_contact=self._staffUser)
+                    for i in range(3)]
+        joe_group = Group.objects.get(name="joe_group")
+        jane_group = Group.objects.get(name="jane_group")
+        mixin = ViewPermissionsMixin()
+        # The number of queries does not depend on the number of objects
+        ContentType.objects.get_for_model(Project)
+        query_counts = []
+        for objects in (projects[:1], projects):
+            with CaptureQueriesContext(connection) as queries:
+                mixin.bulk_assign_permissions(objects, {"joe_group": "rw", "jane_group": "r"})
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+        for project in projects:
+            self.assertEqual(set(get_perms(joe_group, project)),
+                             {"add_project", "change_project", "delete_project", "view_project"})
+            self.assertEqual(get_perms(jane_group, project), ["view_project"])
+        mixin.bulk_assign_permissions(projects, {"joe_group": "r"})
+        self.assertEqual(get_perms(joe_group, projects[0]), ["view_project"])
+        self.assertEqual(GroupPermissionIndex.objects.filter(group=joe_group).count(), 3)
+        # Find the groups and permissions then delete from the index and the permissions
+        with self.assertNumQueries(4):
+            mixin.bulk_unassign_permissions(projects, ["joe_group", "jane_group"])
+        self.assertEqual(get_perms(jane_group, projects[0]), [])
+        self.assertEqual(GroupPermissionIndex.objects.filter(group=joe_group).count(), 0)
+        self.assertFalse(mixin.bulk_assign_permissions(projects, {"no_group": "r"}))
@@ -0,0 +1,46 @@
+import zipfile
+
+from .serializers import ProductSerializer
+from .parsers import DesignFileParser
+
+
+def read_designs(designs_file):
+    """
+    Read a zip of design files into a dict of filename to contents
+    """
+    designs = {}
+    if designs_file:
+        with zipfile.ZipFile(designs_file, 'r') as dzip:
+            for file_path in dzip.namelist():
+                filename = file_path.split('/')[-1]
+                with dzip.open(file_path, 'rU') as d:
+                    designs[filename] = d.read()
+    return designs
+
+
+def import_product(project_id, product_data, designs, user):
+    """
+    Create a product from a line of a products file
+
+    Returns None if the product was created otherwise the errors. Any
+    design is replaced with its contents from designs.
+    """
+    # Replace the name of the design file with the actual contents
+    if product_data.get('design', None):
+        if product_data['design'] not in designs:
+            return {'design': ['Design file {} not found'.format(product_data['design'])]}
+        product_data['design'] = designs[product_data['design']].decode('utf-8-sig')
+    product_data['project'] = project_id
+    serializer = ProductSerializer(data=product_data)
+    if not serializer.is_valid():
+        return serializer.errors
+    instance = serializer.save(created_by=user)
+    items = []
+    parser = DesignFileParser(instance.design)
+    if instance.design_format == 'csv':
+        items, sbol = parser.parse_csv()
+    elif instance.design_format == 'gb':
+        items, sbol = parser.parse_gb()
+    for i in items:
+        instance.linked_inventory.add(i)
+    return None
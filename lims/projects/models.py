@@ -211,9 +211,8 @@ class Product(models.Model):
         return '{}-{}'.format(self.project.project_identifier, self.identifier)
 
     def on_run(self):
-        if self.runs.filter(is_active=True).count() > 0:
-            return True
-        return False
+        # Use all() so that prefetched runs are used if available
+        return any(r.is_active for r in self.runs.all())
 
     def save(self, force_insert=False, force_update=False, **kwargs):
         if self.identifier == 0:
@@ -69,7 +69,7 @@ class SimpleProductSerializer(SerializerReadOnlyPermissionsMixin, serializers.Mo
     class Meta:
         model = Product
         fields = ['id', 'product_identifier', 'runs', 'on_run', 'product_type', 'name',
-                  'linked_inventory', 'product_locaton']
+                  'linked_inventory', 'location']
 
 
 class ProductSerializer(SerializerReadOnlyPermissionsMixin, serializers.ModelSerializer):
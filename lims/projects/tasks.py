@@ -1,6 +1,14 @@
+import csv
+
 from celery import shared_task
 
+from lims.shared.models import ImportJob
 from .models import Project
+from .importer import read_designs, import_product
+
+
+# Products to import between each update of progress
+IMPORT_CHUNK_SIZE = 100
 
 
 @shared_task
@@ -13,3 +21,26 @@ def process_deadlines():
         elif p.warn_deadline() and p.deadline_status != 'Warn':
             p.deadline_status = 'Warn'
             p.save()
+
+
+@shared_task
+def import_products(job_id):
+    """
+    Import the products in the file of an ImportJob
+    """
+    job = ImportJob.objects.select_related('created_by').get(id=job_id)
+    try:
+        job.start('utf-8-sig')
+        designs = read_designs(job.extra_file.path if job.extra_file else None)
+        rows = []
+        for p in csv.DictReader(job.lines('utf-8-sig'), skipinitialspace=True):
+            rows.append((p, import_product(job.options['project'], p, designs,
+                                           job.created_by)))
+            if len(rows) == IMPORT_CHUNK_SIZE:
+                job.add_rows(rows)
+                rows = []
+        job.add_rows(rows)
+        job.finish()
+    except Exception as e:
+        job.fail(str(e))
+        raise
@@ -1,5 +1,4 @@
 import csv
-import zipfile
 import codecs
 
 import django_filters
@@ -13,7 +12,6 @@ from rest_framework.filters import (OrderingFilter,
                                     SearchFilter,
                                     DjangoFilterBackend)
 
-from guardian.shortcuts import get_group_perms
 
 from lims.shared.filters import ListFilter
 from lims.permissions.permissions import (IsInAdminGroupOrRO,
@@ -22,12 +20,16 @@ from lims.permissions.permissions import (IsInAdminGroupOrRO,
                                           ExtendedObjectPermissionsFilter)
 
 from lims.shared.mixins import StatsViewMixin, AuditTrailViewMixin
+from lims.shared.models import ImportJob
+from lims.shared.serializers import ImportJobSerializer
+from lims.shared.tasks import delay_on_commit
 from lims.datastore.serializers import AttachmentSerializer
 from .models import (Product, ProductStatus, Project, ProjectStatus, DeadlineExtension)
 from .serializers import (ProjectSerializer, ProductSerializer,
                           DetailedProductSerializer, ProductStatusSerializer,
                           ProjectStatusSerializer, FullProductSerializer)
-from .parsers import DesignFileParser
+from .importer import read_designs, import_product
+from . import tasks
 
 from .providers import ProductPluginProvider, ProjectPluginProvider
 
@@ -97,6 +99,9 @@ class ProjectViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin,
     def import_products(self, request, pk=None):
         """
         Create products on a project using CSV and ZIP files.
+
+        Post background=True to import on a worker, returning the ImportJob
+        to follow the progress of.
         """
         # Two files to import: CSV and ZIP of products
         # Parse CSV
@@ -111,6 +116,14 @@ class ProjectViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin,
         completed = []
 
         if products_file:
+            if request.data.get('background', None) == 'True':
+                job = ImportJob.objects.create(kind='products',
+                                               file=products_file,
+                                               extra_file=designs_file,
+                                               options={'project': self.get_object().id},
+                                               created_by=request.user)
+                delay_on_commit(tasks.import_products, job.id)
+                return Response(ImportJobSerializer(job).data, status=202)
             # Read the CSV file of products into a list
             decoded_file = codecs.iterdecode(products_file, 'utf-8-sig')
             try:
@@ -119,33 +132,15 @@ class ProjectViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin,
                 return Response({'message': 'Please supply file in UTF-8 CSV format.'},
                                 status=400)
             # Open the zip file for reading, assign the files within to a dict with filenames
-            designs = {}
-            if designs_file:
-                with zipfile.ZipFile(designs_file, 'r') as dzip:
-                    for file_path in dzip.namelist():
-                        filename = file_path.split('/')[-1]
-                        with dzip.open(file_path, 'rU') as d:
-                            designs[filename] = d.read()
+            designs = read_designs(designs_file)
             # Iteratre through products creating them and linking design
+            project_id = self.get_object().id
             for p in products:
-                # Replace the name of the design file with the actual contents
-                if p.get('design', None):
-                    p['design'] = designs[p['design']].decode('utf-8-sig')
-                p['project'] = self.get_object().id
-                serializer = ProductSerializer(data=p)
-                if serializer.is_valid():
-                    instance = serializer.save(created_by=request.user)
-                    items = []
-                    parser = DesignFileParser(instance.design)
-                    if instance.design_format == 'csv':
-                        items, sbol = parser.parse_csv()
-                    elif instance.design_format == 'gb':
-                        items, sbol = parser.parse_gb()
-                    for i in items:
-                        instance.linked_inventory.add(i)
+                errors = import_product(project_id, p, designs, request.user)
+                if errors is None:
                     completed.append(p)
                 else:
-                    p['reason'] = serializer.errors
+                    p['reason'] = errors
                     rejected.append(p)
             return Response({'message': 'Import completed',
                              'completed': completed,
@@ -217,8 +212,8 @@ class ProductViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin,
         # Ensure the user has the correct permissions on the Project
         # to add a product to it.
         project = serializer.validated_data['project']
-        if ('change_project' in get_group_perms(self.request.user, project)
-                or self.request.user.groups.filter(name='admin').exists()):
+        if ('change_project' in self.capabilities.group_perms(project)
+                or self.capabilities.is_admin):
             instance = serializer.save(created_by=self.request.user)
             self.clone_group_permissions(instance.project, instance)
         else:
@@ -57,6 +57,7 @@ INSTALLED_APPS = (
     'guardian',
     'django_celery_beat',
     'lims.shared',
+    'lims.permissions',
     'lims.users',
     'lims.addressbook',
     'lims.pricebook',
@@ -168,6 +169,14 @@ EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
 EMAIL_USE_SSL = os.environ.get('EMAIL_USE_SSL', True)
 EMAIL_FROM = os.environ.get('EMAIL_FROM', 'Leaf LIMS')
+# Set to django.core.mail.backends.filebased.EmailBackend to write emails to
+# EMAIL_FILE_PATH rather than send them, tests always keep them in memory
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_FILE_PATH = os.environ.get('EMAIL_FILE_PATH', BASE_DIR + '/emails/')
+# Emails waiting to be sent are taken EMAIL_BATCH_SIZE at a time and sent
+# together, retrying EMAIL_SEND_RETRIES times if the connection fails
+EMAIL_BATCH_SIZE = int(os.environ.get('EMAIL_BATCH_SIZE', 100))
+EMAIL_SEND_RETRIES = int(os.environ.get('EMAIL_SEND_RETRIES', 3))
 
 #
 # Async/queue settings
@@ -182,6 +191,29 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Run Celery tasks in process rather than on a worker, e.g. for tests. The
+# channel layer is kept in memory to match as there is no worker to use it.
+CELERY_TASK_ALWAYS_EAGER = TESTMODE or literal_eval(os.environ.get('CELERY_ALWAYS_EAGER',
+                                                                   'False'))
+if CELERY_TASK_ALWAYS_EAGER:
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'asgiref.inmemory.ChannelLayer',
+        'ROUTING': 'lims.urls.channel_routing',
+    }
+
+# The cache is shared by every process, through Redis, as cached values are
+# invalidated by whichever process changes them
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379') + '/1',
+    }
+}
+if TESTMODE:
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+
 #
 # Logging
 #
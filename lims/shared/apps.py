@@ -1,14 +1,20 @@
 import sys
 
 from django.apps import AppConfig
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save
 
 
 class SharedConfig(AppConfig):
     name = 'lims.shared'
 
     def ready(self):
+        import lims.shared.signals  # noqa
         if ('runserver' in sys.argv or '/usr/local/bin/daphne' in sys.argv
                 or 'runworker' in sys.argv):
             from lims.shared.models import TriggerSet
+            from lims.shared.signals import updated_in_bulk
+            pre_save.connect(TriggerSet()._snapshot_triggersets,
+                             dispatch_uid='Snapshot Trigger Sets')
             post_save.connect(TriggerSet()._fire_triggersets, dispatch_uid='Fire Trigger Sets')
+            updated_in_bulk.connect(TriggerSet()._fire_updated_triggersets,
+                                    dispatch_uid='Fire Updated Trigger Sets')
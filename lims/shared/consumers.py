@@ -1,16 +1,93 @@
-from django.core.mail import send_mail
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from django.contrib.auth.models import AnonymousUser
 from django.conf import settings
 
-import mistune
+from channels.auth import channel_session_user_from_http
+from rest_framework.serializers import ValidationError
+from rest_framework_jwt.serializers import VerifyJSONWebTokenSerializer
+
+from lims.permissions.capabilities import get_capabilities
+from .models import ImportJob
+from .tasks import send_emails
+
+
+def _collect_emails(message):
+    """
+    Gather messages already waiting on the channel of a message to send with it
+    """
+    messages = [message.content]
+    while len(messages) < settings.EMAIL_BATCH_SIZE:
+        channel, content = message.channel_layer.receive([message.channel.name], block=False)
+        if channel is None:
+            break
+        messages.append(content)
+    return messages
+
+
+def _digests(messages):
+    """
+    Combine the messages to each recipient into a single email
+
+    Recipients of exactly the same messages share an email.
+    """
+    recipient_messages = OrderedDict()
+    for i, message in enumerate(messages):
+        for recipient in message['recipients']:
+            recipient_messages.setdefault(recipient, []).append(i)
+    batches = OrderedDict()
+    for recipient, indexes in recipient_messages.items():
+        batches.setdefault(tuple(indexes), []).append(recipient)
+    emails = []
+    for indexes, recipients in batches.items():
+        batch = [messages[i] for i in indexes]
+        if len(batch) == 1:
+            title = batch[0]['title']
+        else:
+            title = '{} notifications from Leaf LIMS'.format(len(batch))
+        emails.append({
+            'title': title,
+            'content': '\n\n'.join(message['content'] for message in batch),
+            'recipients': recipients,
+        })
+    return emails
 
 
 def send_email(message):
-    html_message = mistune.markdown(message['content'], hard_wrap=True)
-    send_mail(
-        message['title'],
-        message['content'],
-        settings.EMAIL_HOST_USER,
-        message['recipients'],
-        fail_silently=True,
-        html_message=html_message,
-    )
+    # Sending can be slow or need retrying so is left to a worker
+    send_emails.delay(_digests(_collect_emails(message)))
+
+
+def _websocket_user(message):
+    """
+    The user of a websocket, from a JWT in the query string or the session
+    """
+    query_string = message.content.get('query_string', '')
+    if isinstance(query_string, bytes):
+        query_string = query_string.decode('utf-8')
+    token = parse_qs(query_string).get('token', None)
+    if token is not None:
+        try:
+            return VerifyJSONWebTokenSerializer().validate({'token': token[0]})['user']
+        except ValidationError:
+            return AnonymousUser()
+    return message.user
+
+
+@channel_session_user_from_http
+def import_job_connect(message, pk):
+    # Only whoever started the job or an admin can follow it, as in the API
+    user = _websocket_user(message)
+    allowed = user.is_authenticated and (
+        user.is_superuser or get_capabilities(user).is_admin or
+        ImportJob.objects.filter(id=pk, created_by=user).exists())
+    if not allowed:
+        message.reply_channel.send({'close': True})
+        return
+    message.reply_channel.send({'accept': True})
+    ImportJob.channel_group(pk).add(message.reply_channel)
+
+
+def import_job_disconnect(message, pk):
+    ImportJob.channel_group(pk).discard(message.reply_channel)
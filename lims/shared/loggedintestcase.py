@@ -1,3 +1,4 @@
+from django.db import transaction
 from django.test import TestCase
 from django.contrib.auth.models import User, Group
 from rest_framework.test import APIClient
@@ -48,6 +49,14 @@ class LoggedInTestCase(TestCase):
     def _asAnonymous(self):
         self._client.logout()
 
+    # Utility function to run what would run once committed, as the
+    # transaction of a test never is
+    def _commit(self):
+        connection = transaction.get_connection()
+        run_on_commit, connection.run_on_commit = connection.run_on_commit, []
+        for sids, func in run_on_commit:
+            func()
+
     # Utility function to switch user
     def _asInvalid(self):
         self._client.logout()
@@ -1,3 +1,4 @@
+from django.core.cache import cache
 from django.db.models import Count
 from reversion.models import Version
 from django.core.exceptions import FieldError
@@ -10,6 +11,8 @@ from rest_framework.decorators import list_route, detail_route
 from rest_framework.serializers import ValidationError
 from rest_framework.exceptions import PermissionDenied
 
+from lims.permissions.capabilities import get_capabilities
+
 
 class StatsViewMixin(viewsets.ViewSet):
     """
@@ -38,70 +41,131 @@ class StatsViewMixin(viewsets.ViewSet):
         raise ValidationError({'message': 'You must supply a field for stats'})
 
 
+VERSION_DATA_KEY = 'shared.version_data.{}'
+
+
+def version_data(version_ids):
+    """
+    The deserialized fields of versions, by version ID
+
+    Versions never change so their fields are cached forever.
+    """
+    keys = {VERSION_DATA_KEY.format(version_id): version_id for version_id in version_ids}
+    data = {keys[key]: fields for key, fields in cache.get_many(keys.keys()).items()}
+    missing = [version_id for version_id in version_ids if version_id not in data]
+    if len(missing) > 0:
+        loaded = {version.pk: version.field_dict
+                  for version in Version.objects.filter(pk__in=missing)}
+        cache.set_many({VERSION_DATA_KEY.format(version_id): fields
+                        for version_id, fields in loaded.items()}, None)
+        data.update(loaded)
+    return data
+
+
+def _changes(fields1, fields2):
+    # Return a list of fields that differ between the two versions. Omitted fields are equal.
+    # Each field has a 'version1' and 'version2' entry to show before/after effect.
+    # Fields present in only one version are marked ##MISSING## in the other.
+    changes = {}
+    # First check all fields in v1. Only record those that differ.
+    for field, v1_value in fields1.items():
+        if field in fields2:
+            if fields2[field] != v1_value:
+                changes[field] = {'version1': v1_value, 'version2': fields2[field]}
+        else:
+            changes[field] = {'version1': v1_value, 'version2': '##MISSING##'}
+    # Now add in any fields in v2 that were not in v1
+    for field, v2_value in fields2.items():
+        if field not in fields1:
+            changes[field] = {'version1': '##MISSING##', 'version2': v2_value}
+    return changes
+
+
 class AuditTrailViewMixin(viewsets.ViewSet):
     """
     Provide API endpoints for audit trails. Permissions should be inherited from the views.
     """
 
+    def _history(self, versions, numbers):
+        versions = list(versions)
+        data = version_data([version.pk for version in versions])
+        history = []
+        for version in versions:
+            user = version.revision.user
+            history.append({'version': numbers[version.pk],
+                            'created': version.revision.date_created.strftime('%Y-%m-%d %H:%M:%S'),
+                            'user': user.username if user is not None else None,
+                            'data': data[version.pk]})
+        return history
+
     @detail_route(methods=['GET'])
     def history(self, request, pk=None):
+        """
+        Versions of an object, oldest first, paginated if a page is given
+        """
         instance = self.get_object()
+        versions = Version.objects.get_for_object(instance)
+        # Versions are numbered from the first whatever the filters
+        numbers = {version_id: v for v, version_id in
+                   enumerate(versions.order_by('pk').values_list('pk', flat=True))}
         user = request.query_params.get('user', None)  # Default to all users
+        if user is not None:
+            versions = versions.filter(revision__user__username=user)
         start = request.query_params.get('start', None)  # In YYYY-MM-DD format
         if start:
             start = datetime.datetime.strptime(start, '%Y-%m-%d')
-        else:
-            start = datetime.datetime.min
-        start = timezone.make_aware(start, timezone.get_default_timezone())
+            versions = versions.filter(revision__date_created__gte=timezone.make_aware(
+                start, timezone.get_default_timezone()))
         end = request.query_params.get('end', None)  # In YYYY-MM-DD format
         if end:
-            end = datetime.datetime.strptime(start, '%Y-%m-%d')
-        else:
-            end = datetime.datetime.today()
-        end = timezone.make_aware(end, timezone.get_default_timezone())
-        history = []
-        for v, version in enumerate(Version.objects.get_for_object(instance).reverse()):
-            if (user is not None and version.revision.user.username != user) \
-                    or version.revision.date_created < start \
-                    or version.revision.date_created > end:
-                continue
-            history.append({'version': v,
-                            'created': version.revision.date_created.strftime('%Y-%m-%d %H:%M:%S'),
-                            'user': version.revision.user.username,
-                            'data': version.field_dict})
-        return Response(history, status=200)
+            end = datetime.datetime.strptime(end, '%Y-%m-%d')
+            versions = versions.filter(revision__date_created__lte=timezone.make_aware(
+                end, timezone.get_default_timezone()))
+        # Only the versions returned have their data loaded
+        versions = versions.select_related('revision__user').defer('serialized_data') \
+            .order_by('pk')
+        if 'page' in request.query_params:
+            page = self.paginate_queryset(versions)
+            return self.get_paginated_response(self._history(page, numbers))
+        return Response(self._history(versions, numbers), status=200)
 
     @detail_route(methods=['GET'])
     def compare(self, request, pk=None):
+        """
+        Fields that differ between two versions
+
+        With consecutive=True gives the changes between each pair of
+        consecutive versions from the first to the last of the two.
+        """
         instance = self.get_object()
         version1 = request.query_params.get('version1', -1)  # 0-index, current is last in list
         version2 = request.query_params.get('version2', None)  # 0-index, fail if not provided
         if version2 is None:
             return Response({'message': 'Must provide value for version2'}, status=400)
-        versions = Version.objects.get_for_object(instance).reverse()
-        v1 = versions[int(version1)]
-        v2 = versions[int(version2)]
-        # Return a list of fields that differ between the two versions. Omitted fields are equal.
-        # Each field has a 'version1' and 'version2' entry to show before/after effect.
-        # Fields present in only one version are marked ##MISSING## in the other.
-        changes = {}
-        # First check all fields in v1. Only record those that differ.
-        for field, v1_value in v1.field_dict.items():
-            if field in v2.field_dict:
-                if v2.field_dict[field] != v1_value:
-                    changes[field] = {'version1': v1_value, 'version2': v2.field_dict[field]}
-            else:
-                changes[field] = {'version1': v1_value, 'version2': '##MISSING##'}
-        # Now add in any fields in v2 that were not in v1
-        for field, v2_value in v2.field_dict.items():
-            if field not in v1.field_dict:
-                changes[field] = {'version1': '##MISSING##', 'version2': v2_value}
-        return Response(changes, status=200)
+        version_ids = list(Version.objects.get_for_object(instance).order_by('pk')
+                           .values_list('pk', flat=True))
+        try:
+            # Indexing a range also makes negative positions positive
+            v1 = range(len(version_ids))[int(version1)]
+            v2 = range(len(version_ids))[int(version2)]
+        except (IndexError, ValueError):
+            return Response({'message': 'Versions must be positions of existing versions'},
+                            status=400)
+        if request.query_params.get('consecutive', None) == 'True':
+            numbers = list(range(min(v1, v2), max(v1, v2) + 1))
+            data = version_data([version_ids[v] for v in numbers])
+            changes = [{'version1': a,
+                        'version2': b,
+                        'changes': _changes(data[version_ids[a]], data[version_ids[b]])}
+                       for a, b in zip(numbers, numbers[1:])]
+            return Response(changes, status=200)
+        data = version_data([version_ids[v1], version_ids[v2]])
+        return Response(_changes(data[version_ids[v1]], data[version_ids[v2]]), status=200)
 
     @detail_route(methods=['POST'])
     def revert(self, request, pk=None):
         # Admin only
-        if not self.request.user.groups.filter(name='admin').exists():
+        if not get_capabilities(self.request.user).is_admin:
             raise PermissionDenied()
         instance = self.get_object()
         version = request.query_params.get('version', None)  # 0-index, fail if not provided
@@ -1,9 +1,17 @@
+import codecs
+import csv
+import json
+
 from django.db import models
 import reversion
-import six
 from django.contrib.auth.models import User
+from django.contrib.postgres.fields import JSONField
 from django.db.models.signals import post_save  # noqa
-from channels import Channel
+from django.utils import timezone
+from channels import Channel, Group
+
+from .triggers import (compile_trigger, fired_triggersets, has_triggersets, snapshot,
+                       watched_fields, watches)
 
 
 @reversion.register()
@@ -62,41 +70,118 @@ class TriggerSet(models.Model):
         ordering = ['-id']
 
     @staticmethod
-    def _fire_triggersets(sender, instance=None, created=False, raw=False, **kwargs):
+    def _snapshot_triggersets(sender, instance=None, raw=False, update_fields=None, **kwargs):
+        if raw or not instance or not watches(sender, update_fields):
+            return
+        # Keep the saved values of watched fields to see what the save changes
+        instance._trigger_snapshot = snapshot(sender, instance)
+
+    @staticmethod
+    def _fire_triggersets(sender, instance=None, created=False, raw=False, update_fields=None,
+                          **kwargs):
         if raw:
             return  # We do not want to fire on loading raw data
-        model = sender.__name__
-        for triggerset in TriggerSet.objects.filter(model=model):
-            if triggerset.all_triggers_fire(instance, created):
-                email_recipients = []
-                alert = TriggerAlert.objects.create(triggerset=triggerset, instance_id=instance.id)
-                for subscription in triggerset.subscriptions.all():
-                    alert.statuses.create(user=subscription.user,
-                                          status=TriggerAlertStatus.ACTIVE,
-                                          last_updated_by=subscription.user)
-                    # Check if subscribed OR use email from linked user
-                    if subscription.email:
-                        email_recipients.append(subscription.user.email)
-                # This uses a string, traversal by __ is supported.
-                if triggerset.alert_linked_user:
-                    alerted_user = triggerset.value_from_path(instance,
-                                                              triggerset.alert_user_field)
-                    alert.statuses.create(user=alerted_user,
-                                          status=TriggerAlertStatus.ACTIVE,
-                                          last_updated_by=alerted_user)
-                    try:
-                        email_recipients.append(alerted_user.email)
-                    except:
-                        pass
-                alert.save()
-                if len(email_recipients) > 0:
-                    content = triggerset._complete_email_template(instance, alert.fired)
-                    message = {
-                        'title': triggerset.email_title,
-                        'content': content,
-                        'recipients': email_recipients,
-                    }
-                    Channel('send-email').send(message)
+        if not instance or not (created or watches(sender, update_fields)):
+            return
+        old = instance.__dict__.pop('_trigger_snapshot', None)
+        TriggerSet._queue_alerts(sender, instance,
+                                 fired_triggersets(sender.__name__, instance, created, old))
+
+    @staticmethod
+    def _fire_updated_triggersets(sender, old=None, **kwargs):
+        """
+        Fire trigger sets on instances changed by an update, which skips save
+
+        old maps the ID of each instance to its values of the fields changed.
+        """
+        if not old or not has_triggersets(sender.__name__):
+            return
+        fields = watched_fields(sender)
+        for instance in sender.objects.filter(pk__in=old.keys()):
+            before = {field: getattr(instance, field) for field in fields}
+            before.update(old[instance.pk])
+            TriggerSet._queue_alerts(sender, instance,
+                                     fired_triggersets(sender.__name__, instance, False, before))
+
+    @staticmethod
+    def _queue_alerts(sender, instance, triggersets):
+        if len(triggersets) == 0:
+            return
+        # Alerts are created by a worker once the save is committed
+        from .tasks import alert_triggersets, delay_on_commit
+        delay_on_commit(alert_triggersets, sender._meta.app_label, sender._meta.model_name,
+                        instance.pk, [triggerset.id for triggerset in triggersets])
+
+    @staticmethod
+    def fire(instance, created=False):
+        """
+        Create alerts for the trigger sets an instance fires and email them
+
+        Returns the alerts created.
+        """
+        return TriggerSet.alert(
+            instance, fired_triggersets(instance.__class__.__name__, instance, created))
+
+    @staticmethod
+    def alert(instance, triggersets):
+        """
+        Create alerts for trigger sets fired by an instance and email them
+
+        Returns the alerts created.
+        """
+        triggersets = list(triggersets)
+        if len(triggersets) == 0:
+            return []
+        alerts = TriggerAlert.objects.bulk_create(
+            [TriggerAlert(triggerset=triggerset, instance_id=instance.id)
+             for triggerset in triggersets])
+        subscriptions = {}
+        for subscription in TriggerSubscription.objects.filter(triggerset__in=triggersets) \
+                .select_related('user'):
+            subscriptions.setdefault(subscription.triggerset_id, []).append(subscription)
+        statuses = []
+        emails = {}
+        for triggerset, alert in zip(triggersets, alerts):
+            users = [(s.user, s.email) for s in subscriptions.get(triggerset.id, [])]
+            # This uses a string, traversal by __ is supported.
+            if triggerset.alert_linked_user:
+                alerted_user = triggerset.value_from_path(instance,
+                                                          triggerset.alert_user_field)
+                if isinstance(alerted_user, User):
+                    users.append((alerted_user, True))
+            for user, email in users:
+                statuses.append(TriggerAlertStatus(triggeralert=alert,
+                                                   user=user,
+                                                   status=TriggerAlertStatus.ACTIVE,
+                                                   last_updated_by=user))
+                if email and user.email:
+                    emails.setdefault(user.email, []).append((triggerset, alert))
+        TriggerAlertStatus.objects.bulk_create(statuses)
+        TriggerSet._send_emails(instance, emails)
+        return alerts
+
+    @staticmethod
+    def _send_emails(instance, emails):
+        # Recipients of the same alerts share a single email
+        batches = {}
+        for recipient, fired in emails.items():
+            batches.setdefault(tuple(fired), []).append(recipient)
+        contents = {}
+        for fired, recipients in batches.items():
+            for triggerset, alert in fired:
+                if alert.id not in contents:
+                    contents[alert.id] = triggerset._complete_email_template(instance,
+                                                                             alert.fired)
+            if len(fired) == 1:
+                title = fired[0][0].email_title
+            else:
+                title = '{} alerts from Leaf LIMS'.format(len(fired))
+            message = {
+                'title': title,
+                'content': '\n\n'.join(contents[alert.id] for _, alert in fired),
+                'recipients': recipients,
+            }
+            Channel('send-email').send(message)
 
     def value_from_path(self, model, path):
         value = model
@@ -165,31 +250,8 @@ class Trigger(models.Model):
     def trigger_fires(self, instance=None, created=False):
         if not instance:
             return False
-        # Don't fire if created but you don't want to know that happened
-        # Looking for changes and this is all new
-        if created and not self.fire_on_create:
-            return False
-        if not hasattr(instance, self.field):
-            return False
-        # If you've not created it but you want to know when created
-        # ignore if any other conditions are true
-        if not created and self.fire_on_create:
-            return False
-        # Else return true no matter what other conditions are set
-        if created and self.fire_on_create:
-            return True
-        test_value = self.value
-        instance_value = getattr(instance, self.field)
-        if isinstance(instance_value, object):
-            instance_value = str(instance_value)
-        if isinstance(instance_value, six.string_types):
-            # Wrap only strings in quotes
-            instance_value = "r'%s'" % instance_value
-        if isinstance(test_value, six.string_types):
-            test_value = "r'%s'" % self.value
-        expr = '%s %s %s' % (instance_value, self.operator, test_value)
-        # TODO: Replace eval with something less worrying
-        return eval(expr, {"__builtins__": {}})
+        fires = compile_trigger(self.field, self.operator, self.value, self.fire_on_create)
+        return fires(instance, created)
 
 
 @reversion.register()
@@ -232,3 +294,131 @@ class TriggerSubscription(models.Model):
 
     class Meta:
         ordering = ['-id']
+
+
+class ImportJob(models.Model):
+    """
+    A file being imported in the background
+
+    Progress is saved as each chunk of rows is processed and pushed to
+    the job's channel group for anyone watching.
+    """
+    PENDING = 'P'
+    RUNNING = 'R'
+    COMPLETE = 'C'
+    FAILED = 'F'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending',),
+        (RUNNING, 'Running',),
+        (COMPLETE, 'Complete',),
+        (FAILED, 'Failed',),
+    )
+    # What is being imported e.g. items
+    kind = models.CharField(max_length=20)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING)
+    file = models.FileField(upload_to='imports/')
+    # Any second file needed for the import e.g. a zip of designs
+    extra_file = models.FileField(upload_to='imports/', blank=True, null=True)
+    # Whatever else the import needs e.g. the file template to use
+    options = JSONField(default=dict)
+
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    saved = models.IntegerField(default=0)
+    rejected = models.IntegerField(default=0)
+    message = models.TextField(blank=True, null=True)
+
+    created_by = models.ForeignKey(User, related_name='import_jobs')
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-id']
+
+    @staticmethod
+    def channel_group(job_id):
+        return Group('import-job-{}'.format(job_id))
+
+    def progress(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.processed,
+            'saved': self.saved,
+            'rejected': self.rejected,
+            'message': self.message,
+        }
+
+    def _update(self, *fields):
+        self.save(update_fields=fields)
+        self.channel_group(self.id).send({'text': json.dumps(self.progress())})
+
+    def lines(self, encoding='utf-8'):
+        """
+        Iterate over the decoded lines of the uploaded file
+        """
+        self.file.open('rb')
+        try:
+            for line in codecs.iterdecode(self.file, encoding):
+                yield line
+        finally:
+            self.file.close()
+
+    def start(self, encoding='utf-8'):
+        """
+        Mark the job as running with the number of lines to process
+        """
+        self.status = ImportJob.RUNNING
+        # Excluding the header, blank lines may be skipped by the import
+        self.total = max(sum(1 for _ in csv.reader(self.lines(encoding))) - 1, 0)
+        self._update('status', 'total')
+
+    def add_rows(self, rows):
+        """
+        Record the results of a chunk of rows
+
+        Takes a list of (data, errors) in file order with errors as
+        None for saved rows.
+        """
+        ImportJobRow.objects.bulk_create([
+            ImportJobRow(job=self, line=self.processed + i + 1,
+                         saved=errors is None, data=data, errors=errors)
+            for i, (data, errors) in enumerate(rows)])
+        saved = sum(1 for _, errors in rows if errors is None)
+        self.processed += len(rows)
+        self.saved += saved
+        self.rejected += len(rows) - saved
+        self._update('processed', 'saved', 'rejected')
+
+    def _end(self, status, message=None):
+        self.status = status
+        self.message = message
+        self.finished = timezone.now()
+        # The results are all in the rows so the uploads aren't needed
+        self.file.delete(save=False)
+        if self.extra_file:
+            self.extra_file.delete(save=False)
+        self._update('status', 'message', 'finished', 'file', 'extra_file', 'total')
+
+    def finish(self):
+        # Blank lines are counted in the total but never processed
+        self.total = self.processed
+        self._end(ImportJob.COMPLETE)
+
+    def fail(self, message):
+        self._end(ImportJob.FAILED, message)
+
+
+class ImportJobRow(models.Model):
+    """
+    The result of importing one row of an ImportJob's file
+    """
+    job = models.ForeignKey(ImportJob, related_name='rows')
+    line = models.IntegerField()
+    saved = models.BooleanField(default=False)
+    data = JSONField(default=dict)
+    errors = JSONField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['line']
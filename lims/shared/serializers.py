@@ -3,7 +3,7 @@ from django.contrib.auth.models import User
 from rest_framework import serializers
 
 from .models import Organism, Trigger, TriggerSet, TriggerAlert, TriggerAlertStatus, \
-    TriggerSubscription
+    TriggerSubscription, ImportJob, ImportJobRow
 
 
 class OrganismSerializer(serializers.ModelSerializer):
@@ -64,3 +64,18 @@ class TriggerAlertStatusSerializer(serializers.ModelSerializer):
     class Meta:
         model = TriggerAlertStatus
         fields = '__all__'
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    created_by = serializers.SlugRelatedField(read_only=True, slug_field='username')
+
+    class Meta:
+        model = ImportJob
+        exclude = ('file', 'extra_file', 'options',)
+
+
+class ImportJobRowSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ImportJobRow
+        exclude = ('job',)
@@ -0,0 +1,21 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
+
+from .models import Trigger, TriggerSet
+from .triggers import invalidate_triggers
+
+
+# Sent after a queryset update that changes instances without saving them,
+# with old mapping the ID of each instance to its values of fields changed
+updated_in_bulk = Signal(providing_args=['old'])
+
+
+@receiver(post_save, sender=TriggerSet)
+@receiver(post_delete, sender=TriggerSet)
+@receiver(post_save, sender=Trigger)
+@receiver(post_delete, sender=Trigger)
+def trigger_changed(sender, instance, **kwargs):
+    """
+    Recompile the triggers when any trigger set or trigger changes
+    """
+    invalidate_triggers()
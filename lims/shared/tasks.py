@@ -0,0 +1,83 @@
+import logging
+import smtplib
+
+from celery import shared_task
+
+from django.apps import apps
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+
+import mistune
+
+from .models import TriggerSet
+
+
+logger = logging.getLogger(__name__)
+
+
+def delay_on_commit(task, *args):
+    """
+    Queue a task once the current transaction commits
+
+    Tasks that are run eagerly run straight away, as on_commit callbacks
+    never run in tests.
+    """
+    if settings.CELERY_TASK_ALWAYS_EAGER:
+        task.delay(*args)
+    else:
+        transaction.on_commit(lambda: task.delay(*args))
+
+
+@shared_task
+def alert_triggersets(app_label, model_name, pk, triggerset_ids):
+    """
+    Alert the subscribers of trigger sets fired by saving an instance
+    """
+    model = apps.get_model(app_label, model_name)
+    instance = model.objects.filter(pk=pk).first()
+    if instance is not None:
+        TriggerSet.alert(instance, TriggerSet.objects.filter(id__in=triggerset_ids))
+
+
+def _is_refused(error):
+    # Refused recipients or a permanent (5xx) reply will fail again on retry
+    return isinstance(error, smtplib.SMTPRecipientsRefused) or \
+        getattr(error, 'smtp_code', 0) >= 500
+
+
+def _email_message(email):
+    message = EmailMultiAlternatives(email['title'], email['content'],
+                                     settings.EMAIL_HOST_USER, email['recipients'])
+    message.attach_alternative(mistune.markdown(email['content'], hard_wrap=True), 'text/html')
+    return message
+
+
+@shared_task(bind=True)
+def send_emails(self, emails):
+    """
+    Send emails, as dicts of title, content and recipients, over one connection
+
+    Emails the server refuses are logged and skipped. If the connection
+    fails those not yet sent are retried with backoff.
+    """
+    pending = list(emails)
+    try:
+        with get_connection() as connection:
+            while len(pending) > 0:
+                try:
+                    connection.send_messages([_email_message(pending[0])])
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                        smtplib.SMTPDataError) as e:
+                    if not _is_refused(e):
+                        raise
+                    logger.error('Email "%s" to %s refused: %s', pending[0]['title'],
+                                 ', '.join(pending[0]['recipients']), e)
+                pending.pop(0)
+    except (smtplib.SMTPException, OSError) as e:
+        if len(pending) == 0:
+            return
+        if self.request.retries >= settings.EMAIL_SEND_RETRIES:
+            logger.error('Gave up sending %d emails: %s', len(pending), e)
+            return
+        raise self.retry(args=[pending], countdown=2 ** self.request.retries, exc=e)
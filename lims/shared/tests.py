@@ -1,9 +1,18 @@
 from lims.shared.loggedintestcase import LoggedInTestCase
 from rest_framework import status
+from .consumers import send_email
+from .tasks import send_emails
+from .signals import updated_in_bulk
 from .models import Organism, Trigger, TriggerAlertStatus, TriggerSet, TriggerSubscription
 from lims.addressbook.models import Address
-from django.db.models.signals import post_save
+from django.core import mail
+from django.db.models.signals import post_save, pre_save
+from django.test import TestCase
+from channels import Channel, DEFAULT_CHANNEL_LAYER, channel_layers
+from channels.message import Message
 import datetime
+import smtplib
+from unittest import mock
 
 
 class OrganismTestCase(LoggedInTestCase):
@@ -703,3 +712,126 @@ class TriggerTestCase(LoggedInTestCase):
         self._asJaneDoe()
         self._fire_alerts()
         self.assertEqual(self._janeDoeTriggerSet.alerts.count(), 2)
+
+    def test_trigger_compares_numbers(self):
+        trigger = Trigger(field="id", operator=Trigger.LT, value="10")
+        self.assertIs(trigger.trigger_fires(Address(id=9)), True)
+        self.assertIs(trigger.trigger_fires(Address(id=10)), False)
+        self.assertIs(trigger.trigger_fires(Address(id=9), created=True), False)
+        trigger = Trigger(field="city", operator=Trigger.LT, value="10")
+        self.assertIs(trigger.trigger_fires(Address(city="9")), False)
+
+    def test_trigger_change_recompiles(self):
+        TriggerSet._fire_triggersets(sender=Address, instance=self._joeBloggsAddress)
+        self.assertEqual(self._janeDoeTriggerSet.alerts.count(), 0)
+        self._janeDoeTrigger.value = "UK"
+        self._janeDoeTrigger.save()
+        TriggerSet._fire_triggersets(sender=Address, instance=self._joeBloggsAddress)
+        self.assertEqual(self._janeDoeTriggerSet.alerts.count(), 1)
+        TriggerSet._fire_triggersets(sender=Organism, instance=Organism(name="Human"))
+        self.assertEqual(self._janeDoeTriggerSet.alerts.count(), 1)
+
+    def test_fire_batches_emails(self):
+        TriggerSubscription.objects.filter(user=self._janeDoe).update(email=True)
+        self._janeDoeAddress.city = "London"
+        self._janeDoeAddress.country = "England"
+        self._janeDoeAddress.save()
+        with mock.patch('lims.shared.models.Channel') as channel:
+            alerts = TriggerSet.fire(self._janeDoeAddress)
+        self.assertEqual(len(alerts), 2)
+        self.assertEqual(TriggerAlertStatus.objects.filter(triggeralert__in=alerts).count(), 3)
+        channel.return_value.send.assert_called_once()
+        message = channel.return_value.send.call_args[0][0]
+        self.assertEqual(message['title'], '2 alerts from Leaf LIMS')
+        self.assertEqual(message['recipients'], ['jane@example.test'])
+
+    def test_triggers_fire_on_change(self):
+        pre_save.connect(receiver=TriggerSet._snapshot_triggersets,
+                         dispatch_uid='Snapshot Trigger Sets')
+        post_save.connect(receiver=TriggerSet._fire_triggersets, dispatch_uid='Fire Trigger Sets')
+        try:
+            for city in ["London", "London", "Norwich", "London"]:
+                self._janeDoeAddress.city = city
+                self._janeDoeAddress.save()
+        finally:
+            pre_save.disconnect(receiver=TriggerSet._snapshot_triggersets,
+                                dispatch_uid='Snapshot Trigger Sets')
+            post_save.disconnect(receiver=TriggerSet._fire_triggersets,
+                                 dispatch_uid='Fire Trigger Sets')
+        # Only moving to London fires, not staying there or leaving
+        self.assertEqual(self._joeBloggsTriggerSet.alerts.count(), 2)
+        self.assertEqual(self._janeDoeTriggerSet.alerts.count(), 0)
+
+    def test_triggers_update_fields(self):
+        pre_save.connect(receiver=TriggerSet._snapshot_triggersets,
+                         dispatch_uid='Snapshot Trigger Sets')
+        post_save.connect(receiver=TriggerSet._fire_triggersets, dispatch_uid='Fire Trigger Sets')
+        self._commit()
+        try:
+            self._janeDoeAddress.city = "London"
+            # Compile the triggers
+            self._janeDoeAddress.save(update_fields=["postcode"])
+            # Saving fields no trigger watches needs no snapshot at all
+            with self.assertNumQueries(1):
+                self._janeDoeAddress.save(update_fields=["postcode"])
+            self._janeDoeAddress.save(update_fields=["city"])
+        finally:
+            pre_save.disconnect(receiver=TriggerSet._snapshot_triggersets,
+                                dispatch_uid='Snapshot Trigger Sets')
+            post_save.disconnect(receiver=TriggerSet._fire_triggersets,
+                                 dispatch_uid='Fire Trigger Sets')
+        self.assertEqual(self._joeBloggsTriggerSet.alerts.count(), 1)
+
+    def test_triggers_fire_on_bulk_update(self):
+        updated_in_bulk.connect(receiver=TriggerSet._fire_updated_triggersets,
+                                dispatch_uid='Fire Updated Trigger Sets')
+        try:
+            for city in ["London", "London"]:
+                old = {address.id: {'city': address.city} for address in
+                       Address.objects.filter(id=self._janeDoeAddress.id)}
+                Address.objects.filter(id=self._janeDoeAddress.id).update(city=city)
+                updated_in_bulk.send(sender=Address, old=old)
+        finally:
+            updated_in_bulk.disconnect(receiver=TriggerSet._fire_updated_triggersets,
+                                       dispatch_uid='Fire Updated Trigger Sets')
+        self.assertEqual(self._joeBloggsTriggerSet.alerts.count(), 1)
+        self.assertEqual(self._joeBloggsTriggerSet.alerts.get().instance_id,
+                         self._janeDoeAddress.id)
+
+
+class SendEmailTestCase(TestCase):
+    def _message(self, title, recipients):
+        return {'title': title, 'content': 'About {}'.format(title), 'recipients': recipients}
+
+    def test_send_email_digest(self):
+        Channel('send-email').send(self._message('Second', ['joe@example.test']))
+        Channel('send-email').send(self._message('Third', ['jane@example.test']))
+        first = Message(self._message('First', ['joe@example.test', 'jane@example.test']),
+                        'send-email', channel_layers[DEFAULT_CHANNEL_LAYER])
+        send_email(first)
+        self.assertEqual(len(mail.outbox), 2)
+        titles = {email.to[0]: email.subject for email in mail.outbox}
+        self.assertEqual(titles, {'joe@example.test': '2 notifications from Leaf LIMS',
+                                  'jane@example.test': '2 notifications from Leaf LIMS'})
+        self.assertEqual(mail.outbox[0].body, 'About First\n\nAbout Second')
+
+    def test_send_email_shared(self):
+        message = Message(self._message('Alert', ['joe@example.test', 'jane@example.test']),
+                          'send-email', channel_layers[DEFAULT_CHANNEL_LAYER])
+        send_email(message)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, 'Alert')
+        self.assertEqual(mail.outbox[0].to, ['joe@example.test', 'jane@example.test'])
+
+    def test_send_emails_refused(self):
+        emails = [self._message('First', ['nobody@example.test']),
+                  self._message('Second', ['joe@example.test'])]
+        connection = mock.MagicMock()
+        connection.__enter__.return_value = connection
+        connection.send_messages.side_effect = [
+            smtplib.SMTPRecipientsRefused({'nobody@example.test': (550, b'No such user')}), 1]
+        with mock.patch('lims.shared.tasks.get_connection', return_value=connection):
+            send_emails(emails)
+        # The refused email is skipped and the rest still sent, only once
+        self.assertEqual(connection.send_messages.call_count, 2)
+        self.assertEqual(connection.send_messages.call_args[0][0][0].to, ['joe@example.test'])
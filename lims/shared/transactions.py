@@ -0,0 +1,29 @@
+from django.db import transaction
+
+
+def on_commit(key, func):
+    """
+    Run a function once the current transaction commits, under a key
+
+    As transaction.on_commit, but pending can tell the function is yet
+    to run.
+    """
+    def run():
+        func()
+    run.on_commit_key = key
+    transaction.on_commit(run)
+
+
+def pending(key):
+    """
+    Check if a function is yet to run under a key once the current
+    transaction commits
+
+    Functions are dropped when their transaction rolls back so are only
+    pending for changes that might still be committed.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return False
+    return any(getattr(func, 'on_commit_key', None) == key
+               for sids, func in connection.run_on_commit)
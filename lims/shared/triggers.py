@@ -0,0 +1,207 @@
+import operator
+import threading
+import uuid
+from collections import namedtuple
+from decimal import Decimal
+
+from django.core.cache import cache
+
+from .transactions import on_commit, pending
+
+
+TRIGGERS_VERSION_KEY = 'shared.triggers.version'
+
+OPERATORS = {
+    '==': operator.eq,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '>': operator.gt,
+    '!=': operator.ne,
+}
+
+# The trigger sets on a model and the fields their triggers watch for changes
+ModelTriggers = namedtuple('ModelTriggers', ['triggersets', 'fields'])
+
+_engine = (None, None)
+_engine_lock = threading.Lock()
+
+
+def compile_trigger(field, op, value, fire_on_create):
+    """
+    Compile the condition of a trigger to a function of (instance, created)
+
+    A value that is a number is compared as one to numeric fields, anything
+    else is compared as a string to the field as a string.
+    """
+    compare = OPERATORS[op]
+    try:
+        number = Decimal(value)
+    except ArithmeticError:
+        number = None
+
+    def fires(instance, created):
+        # Triggers either fire when created or on changes, never both
+        if fire_on_create:
+            return created and hasattr(instance, field)
+        if created or not hasattr(instance, field):
+            return False
+        instance_value = getattr(instance, field)
+        if number is not None and isinstance(instance_value, (int, float, Decimal)) \
+                and not isinstance(instance_value, bool):
+            return compare(Decimal(instance_value), number)
+        return compare(str(instance_value), value)
+    return fires
+
+
+def _build_engine():
+    """
+    Compile the trigger sets of every model
+
+    Returns a dict of model name to ModelTriggers, with the trigger sets as
+    a list of (trigger set, fields, conditions).
+    """
+    from .models import TriggerSet
+    engine = {}
+    for triggerset in TriggerSet.objects.prefetch_related('triggers'):
+        triggers = triggerset.triggers.all()
+        conditions = [compile_trigger(t.field, t.operator, t.value, t.fire_on_create)
+                      for t in triggers]
+        fields = frozenset(t.field for t in triggers if not t.fire_on_create)
+        engine.setdefault(triggerset.model, []).append((triggerset, fields, conditions))
+    return {model: ModelTriggers(triggersets, frozenset().union(*(f for _, f, _ in triggersets)))
+            for model, triggersets in engine.items()}
+
+
+def _get_engine():
+    """
+    Get the compiled triggers for the current version, compiling if needed
+
+    The version is kept in the cache shared by every process and the
+    compiled triggers in each process. While changes to the triggers are
+    yet to be committed they are compiled for this transaction alone.
+    """
+    global _engine
+    if pending(TRIGGERS_VERSION_KEY):
+        return _build_engine()
+    version = cache.get(TRIGGERS_VERSION_KEY)
+    if version is None:
+        version = _new_version()
+    if _engine[0] == version:
+        return _engine[1]
+    with _engine_lock:
+        if _engine[0] != version:
+            _engine = (version, _build_engine())
+    return _engine[1]
+
+
+def _new_version():
+    version = uuid.uuid4().hex
+    cache.set(TRIGGERS_VERSION_KEY, version, None)
+    return version
+
+
+def invalidate_triggers():
+    """
+    Mark the compiled triggers as out of date in every process once the
+    change is committed
+
+    Until then _get_engine compiles the triggers afresh for this
+    transaction, so triggers that might be rolled back are never shared.
+    """
+    on_commit(TRIGGERS_VERSION_KEY, _new_version)
+
+
+def has_triggersets(model):
+    """
+    Check if there are any trigger sets on a model
+    """
+    return model in _get_engine()
+
+
+def watched_fields(model):
+    """
+    The fields stored on a model that its triggers watch for changes
+    """
+    model_triggers = _get_engine().get(model.__name__, None)
+    if model_triggers is None:
+        return []
+    concrete = {f.name for f in model._meta.concrete_fields}
+    return [f for f in model_triggers.fields if f in concrete]
+
+
+def watches(model, update_fields):
+    """
+    Check if saving only update_fields could fire trigger sets on a model
+
+    Trigger sets fire on changes to fields they watch, so a save of only
+    other fields cannot fire any.
+    """
+    model_triggers = _get_engine().get(model.__name__, None)
+    if model_triggers is None:
+        return False
+    if update_fields is None:
+        return True
+    # Attributes that are not fields might depend on any of them
+    return len(model_triggers.fields & set(update_fields)) > 0 or \
+        len(watched_fields(model)) < len(model_triggers.fields)
+
+
+def snapshot(model, instance):
+    """
+    Get the saved values of the fields triggers watch on an instance
+
+    Only fields stored on the model can be snapshot. Returns None for
+    instances not yet saved.
+    """
+    if instance.pk is None or not has_triggersets(model.__name__):
+        return None
+    fields = watched_fields(model)
+    if len(fields) == 0:
+        return {}
+    saved = model._base_manager.filter(pk=instance.pk).only(*fields).first()
+    if saved is None:
+        return None
+    return {f: getattr(saved, f) for f in fields}
+
+
+class _Snapshot():
+    """
+    An instance as it was before it was saved
+    """
+
+    def __init__(self, instance, old):
+        self._instance = instance
+        self._old = old
+
+    def __getattr__(self, name):
+        if name in self._old:
+            return self._old[name]
+        return getattr(self._instance, name)
+
+
+def fired_triggersets(model, instance, created, old=None):
+    """
+    Get the trigger sets on a model whose triggers all fire for an instance
+
+    Given the old values of an instance from snapshot, trigger sets fire on
+    an edge: only when a watched field changed and the triggers all fire now
+    but did not before. Trigger sets watching fields that were not snapshot
+    fire whenever their triggers do.
+    """
+    model_triggers = _get_engine().get(model, None)
+    if model_triggers is None:
+        return []
+    if created or old is None:
+        return [triggerset for triggerset, fields, conditions in model_triggers.triggersets
+                if all(fires(instance, created) for fires in conditions)]
+    changed = {f for f, value in old.items() if getattr(instance, f, None) != value}
+    before = _Snapshot(instance, old)
+    fired = []
+    for triggerset, fields, conditions in model_triggers.triggersets:
+        if fields <= old.keys():
+            if len(fields & changed) == 0 or all(fires(before, False) for fires in conditions):
+                continue
+        if all(fires(instance, False) for fires in conditions):
+            fired.append(triggerset)
+    return fired
@@ -1,17 +1,19 @@
 from rest_framework import viewsets, mixins
 from rest_framework.decorators import detail_route
-from django.contrib.auth.models import Group
 from rest_framework.response import Response
 from rest_framework.filters import DjangoFilterBackend
 from rest_framework.serializers import ValidationError
 import datetime
 
+from lims.permissions.capabilities import get_capabilities
 from lims.permissions.permissions import IsInAdminGroupOrRO
 from lims.shared.mixins import AuditTrailViewMixin
 
-from .models import Organism, TriggerSet, Trigger, TriggerAlertStatus, TriggerSubscription
+from .models import (Organism, TriggerSet, Trigger, TriggerAlertStatus, TriggerSubscription,
+                     ImportJob)
 from .serializers import OrganismSerializer, TriggerSerializer, TriggerSubscriptionSerializer, \
-    TriggerAlertStatusSerializer, TriggerSetSerializer
+    TriggerAlertStatusSerializer, TriggerSetSerializer, ImportJobSerializer, \
+    ImportJobRowSerializer
 
 
 class OrganismViewSet(AuditTrailViewMixin, viewsets.ModelViewSet):
@@ -52,14 +54,14 @@ class TriggerSubscriptionViewSet(AuditTrailViewMixin, viewsets.ModelViewSet):
 
     def get_queryset(self):
         if self.request.user.is_superuser or \
-                        Group.objects.get(name="admin") in self.request.user.groups.all():
+                        get_capabilities(self.request.user).is_admin:
             return TriggerSubscription.objects.all()
         else:
             return TriggerSubscription.objects.filter(user=self.request.user)
 
     def perform_create(self, serializer):
         # Allow an admin user to set the user but otherwise can only create own subscriptions
-        if self.request.user.groups.filter(name='admin').exists() or self.request.user == \
+        if get_capabilities(self.request.user).is_admin or self.request.user == \
                 serializer.validated_data['user']:
             serializer.save()
         else:
@@ -74,7 +76,7 @@ class TriggerAlertStatusViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin
 
     def get_queryset(self):
         if self.request.user.is_superuser or \
-                        Group.objects.get(name="admin") in self.request.user.groups.all():
+                        get_capabilities(self.request.user).is_admin:
             return TriggerAlertStatus.objects.all()
         else:
             return TriggerAlertStatus.objects.filter(user=self.request.user)
@@ -87,7 +89,7 @@ class TriggerAlertStatusViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin
             return Response(status=404)
         if not alertstatus.user == self.request.user and \
                 not self.request.user.is_superuser and \
-                not Group.objects.get(name="admin") in self.request.user.groups.all():
+                not get_capabilities(self.request.user).is_admin:
             return Response(status=403)
         # Silence for this user only
         alertstatus.status = TriggerAlertStatus.SILENCED
@@ -103,7 +105,7 @@ class TriggerAlertStatusViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin
             return Response(status=404)
         if not alertstatus.user == self.request.user and \
                 not self.request.user.is_superuser and \
-                not Group.objects.get(name="admin") in self.request.user.groups.all():
+                not get_capabilities(self.request.user).is_admin:
             return Response(status=403)
         # Dismiss for all users that have not already silenced this alert
         for related_alert in alertstatus.triggeralert.statuses.all():
@@ -113,3 +115,37 @@ class TriggerAlertStatusViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin
                 related_alert.last_updated = datetime.datetime.now()
                 related_alert.save()
         return Response(status=204)
+
+
+class ImportJobViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin,
+                       viewsets.GenericViewSet):
+    """
+    Status and results of background imports
+
+    Progress is also pushed over a websocket at /importjobs/<id>/
+    """
+    serializer_class = ImportJobSerializer
+    filter_fields = ('kind', 'status',)
+    filter_backends = (DjangoFilterBackend,)
+
+    def get_queryset(self):
+        if self.request.user.is_superuser or \
+                get_capabilities(self.request.user).is_admin:
+            return ImportJob.objects.all()
+        return ImportJob.objects.filter(created_by=self.request.user)
+
+    @detail_route()
+    def rows(self, request, pk=None):
+        """
+        The result of each row, optionally only those saved or rejected
+        """
+        job = self.get_object()
+        rows = job.rows.all()
+        saved = request.query_params.get('saved', None)
+        if saved == 'True':
+            rows = rows.filter(saved=True)
+        elif saved == 'False':
+            rows = rows.filter(saved=False)
+        page = self.paginate_queryset(rows)
+        serializer = ImportJobRowSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
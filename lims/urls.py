@@ -13,8 +13,8 @@ from lims.users.views import UserViewSet, GroupViewSet
 from lims.permissions.views import PermissionViewSet
 
 from lims.shared.views import OrganismViewSet, TriggerAlertStatusViewSet, TriggerSetViewSet, \
-    TriggerViewSet, TriggerSubscriptionViewSet
-from lims.shared.consumers import send_email
+    TriggerViewSet, TriggerSubscriptionViewSet, ImportJobViewSet
+from lims.shared.consumers import send_email, import_job_connect, import_job_disconnect
 
 from lims.addressbook.views import AddressViewSet
 from lims.pricebook.views import PriceBookViewSet
@@ -71,6 +71,7 @@ router.register(r'triggers', TriggerViewSet, base_name='triggers')
 router.register(r'triggersets', TriggerSetViewSet, base_name='triggersets')
 router.register(r'subscriptions', TriggerSubscriptionViewSet, base_name='subscriptions')
 router.register(r'alerts', TriggerAlertStatusViewSet, base_name='alerts')
+router.register(r'importjobs', ImportJobViewSet, base_name='importjobs')
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
@@ -87,5 +88,7 @@ urlpatterns = [
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
 channel_routing = [
-    route('send-email', send_email)
+    route('send-email', send_email),
+    route('websocket.connect', import_job_connect, path=r'^/importjobs/(?P<pk>[0-9]+)/$'),
+    route('websocket.disconnect', import_job_disconnect, path=r'^/importjobs/(?P<pk>[0-9]+)/$'),
 ]
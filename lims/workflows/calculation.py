@@ -1,8 +1,12 @@
 from __future__ import division
+from functools import lru_cache
 from pyparsing import (Literal, CaselessLiteral, Word, Combine, Group, Optional,
-                       ZeroOrMore, Forward, nums, alphas, oneOf)
+                       ZeroOrMore, Forward, Regex, nums, alphas, oneOf, ParseException)
 import math
 import operator
+import threading
+
+import numpy
 
 __author__ = 'Paul McGuire'
 __version__ = '$Revision: 0.0 $'
@@ -16,6 +20,17 @@ more easily in other places.
 '''
 
 
+# The number of distinct compiled calculations to keep in memory
+CALCULATION_CACHE_SIZE = 512
+
+
+class Variable(str):
+    """
+    A named {field} placeholder within a calculation
+    """
+    pass
+
+
 class NumericStringParser(object):
     '''
     Most of this code comes from the fourFn.py pyparsing example
@@ -46,6 +61,9 @@ class NumericStringParser(object):
                           Optional(point + Optional(Word(nums))) +
                           Optional(e + Word("+-" + nums, nums)))
         ident = Word(alphas, alphas + nums + "_$")
+        # A {field name} that is looked up when the calculation is evaluated
+        variable = Regex(r'\{[^}]+\}')
+        variable.setParseAction(lambda toks: Variable(toks[0][1:-1]))
         plus = Literal("+")
         minus = Literal("-")
         mult = Literal("*")
@@ -57,8 +75,8 @@ class NumericStringParser(object):
         expop = Literal("^")
         pi = CaselessLiteral("PI")
         expr = Forward()
-        atom = ((Optional(oneOf("- +")) +
-                 (pi | e | fnumber | ident + lpar + expr + rpar).setParseAction(self.pushFirst))
+        operand = pi | e | fnumber | variable | ident + lpar + expr + rpar
+        atom = ((Optional(oneOf("- +")) + operand.setParseAction(self.pushFirst))
                 | Optional(oneOf("- +")) + Group(lpar + expr + rpar)
                 ).setParseAction(self.pushUMinus)
         # by defining exponentiation as "atom [ ^ factor ]..." instead of
@@ -89,6 +107,8 @@ class NumericStringParser(object):
 
     def evaluateStack(self, s):
         op = s.pop()
+        if isinstance(op, Variable):
+            return 0
         if op == 'unary -':
             return -self.evaluateStack(s)
         if op in "+-*/^":
@@ -111,3 +131,301 @@ class NumericStringParser(object):
         self.bnf.parseString(num_string, parseAll)
         val = self.evaluateStack(self.exprStack[:])
         return val
+
+    def _compileStack(self, s, fn, variable):
+        """
+        Turn the parsed expression stack into a tree of closures
+
+        fn maps function names to implementations and variable returns
+        a closure that loads a named value.
+        """
+        op = s.pop()
+        if isinstance(op, Variable):
+            return variable(str(op))
+        if op == 'unary -':
+            operand = self._compileStack(s, fn, variable)
+            return lambda values: -operand(values)
+        if op in "+-*/^":
+            opn = self.opn[op]
+            op2 = self._compileStack(s, fn, variable)
+            op1 = self._compileStack(s, fn, variable)
+            return lambda values: opn(op1(values), op2(values))
+        elif op == "PI":
+            return lambda values: math.pi
+        elif op == "E":
+            return lambda values: math.e
+        elif op in fn:
+            func = fn[op]
+            operand = self._compileStack(s, fn, variable)
+            return lambda values: func(operand(values))
+        elif op[0].isalpha():
+            # Unknown functions evaluate to 0 but still consume their argument
+            self._compileStack(s, fn, variable)
+            return lambda values: 0
+        else:
+            number = float(op)
+            return lambda values: number
+
+    def compile(self, num_string):
+        """
+        Parse a calculation once so it can be evaluated many times
+        """
+        self.exprStack = []
+        self.bnf.parseString(num_string, True)
+        variables = frozenset(op for op in self.exprStack if isinstance(op, Variable))
+        evaluator = self._compileStack(self.exprStack[:], self.fn, _scalar_variable)
+        vector_evaluator = self._compileStack(self.exprStack[:], VECTOR_FUNCTIONS,
+                                              _vector_variable)
+        return CompiledCalculation(num_string, evaluator, vector_evaluator, variables)
+
+
+def _scalar_variable(name):
+    return lambda values: float(values.get(name, 0))
+
+
+def _vector_variable(name):
+    return lambda columns: columns.get(name, 0.0)
+
+
+# NumPy equivalents of NumericStringParser.fn for evaluating whole columns
+VECTOR_FUNCTIONS = {
+    "sin": numpy.sin,
+    "cos": numpy.cos,
+    "tan": numpy.tan,
+    "abs": numpy.abs,
+    "trunc": numpy.trunc,
+    "round": numpy.round,
+    "sgn": lambda a: numpy.where(numpy.abs(a) > 1e-12, numpy.sign(a), 0),
+}
+
+
+class CompiledCalculation(object):
+    """
+    A parsed calculation that can be evaluated against a dict of values
+
+    Any {field} that is not in the values is treated as 0.
+    """
+
+    def __init__(self, calculation, evaluator, vector_evaluator, variables):
+        self.calculation = calculation
+        self.variables = variables
+        self._evaluator = evaluator
+        self._vector_evaluator = vector_evaluator
+
+    def evaluate(self, values):
+        """
+        Returns None if a value used in the calculation is not a number or
+        the result is not finite, as evaluate_many does
+        """
+        try:
+            result = self._evaluator(values)
+            # Complex results, e.g. from roots of negative numbers, are not
+            # finite numbers either
+            finite = math.isfinite(result)
+        except (ArithmeticError, TypeError, ValueError):
+            return None
+        return result if finite else None
+
+    def _to_column(self, name, rows, invalid):
+        """
+        Gather a single named value from every row into an array
+        """
+        try:
+            return numpy.array([row.get(name, 0) for row in rows], dtype=float)
+        except (TypeError, ValueError):
+            column = numpy.empty(len(rows))
+            for i, row in enumerate(rows):
+                try:
+                    column[i] = float(row.get(name, 0))
+                except (TypeError, ValueError):
+                    column[i] = numpy.nan
+                    invalid[i] = True
+            return column
+
+    def evaluate_many(self, rows):
+        """
+        Evaluate against a list of value dicts in a single vectorised pass
+
+        Returns a list of results in the same order as rows. A result is
+        None where a value is not a number or the result is not finite.
+        """
+        invalid = numpy.zeros(len(rows), dtype=bool)
+        columns = {name: self._to_column(name, rows, invalid) for name in self.variables}
+        with numpy.errstate(all='ignore'):
+            try:
+                result = numpy.broadcast_to(self._vector_evaluator(columns), (len(rows),))
+            except ArithmeticError:
+                # Only parts without values are plain floats that can raise,
+                # so every row would raise as evaluate does
+                return [None] * len(rows)
+        invalid |= ~numpy.isfinite(result)
+        return [None if bad else value for value, bad in zip(result.tolist(), invalid)]
+
+
+_parser = None
+_parser_lock = threading.Lock()
+
+
+@lru_cache(maxsize=CALCULATION_CACHE_SIZE)
+def compile_calculation(calculation):
+    """
+    Get a compiled version of a calculation, parsing it only on first use
+
+    The cache is keyed on the calculation text so editing a
+    CalculationFieldTemplate naturally produces a new entry. Returns None
+    if the calculation cannot be parsed.
+    """
+    global _parser
+    # The parser keeps state while parsing so only use it one at a time
+    with _parser_lock:
+        if _parser is None:
+            _parser = NumericStringParser()
+        try:
+            return _parser.compile(calculation)
+        except ParseException:
+            return None
+
+
+def calculate(calculation, values):
+    """
+    Perform a calculation using a dict of field names to values
+
+    Returns None if the calculation cannot be performed.
+    """
+    compiled = compile_calculation(calculation)
+    if compiled is None:
+        return None
+    return compiled.evaluate(values)
+
+
+def calculate_many(calculation, rows):
+    """
+    Perform a calculation once over a list of dicts of field names to values
+
+    Returns a list of results, one per row, or all None if the
+    calculation cannot be performed.
+    """
+    compiled = compile_calculation(calculation)
+    if compiled is None:
+        return [None] * len(rows)
+    return compiled.evaluate_many(rows)
+
+
+class CalculationCycleError(ValueError):
+    """
+    Raised when calculations refer to each other in a loop
+    """
+
+    def __init__(self, labels):
+        self.labels = labels
+        super(CalculationCycleError, self).__init__(
+            'Calculations refer to each other in a loop: {}'.format(', '.join(labels)))
+
+
+class CalculationGraph(object):
+    """
+    Calculations ordered so any calculation referenced by {label} in another
+    is evaluated first.
+
+    Takes an iterable of (key, label, calculation) triples, e.g. keyed by
+    calculation ID as labels need not be unique, and the names of any plain
+    values supplied at evaluation. References to those names are treated as
+    values rather than calculations. Results are keyed the same way.
+    """
+
+    def __init__(self, calculations, values=frozenset()):
+        calculations = list(calculations)
+        self.calculations = {key: calculation for key, label, calculation in calculations}
+        self.labels = {key: label for key, label, calculation in calculations}
+        self.values = values
+        # The keys of every calculation with a label
+        self.keys = {}
+        for key, label, calculation in calculations:
+            self.keys.setdefault(label, []).append(key)
+        self.dependencies = {}
+        for key, calculation in self.calculations.items():
+            compiled = compile_calculation(calculation)
+            variables = compiled.variables if compiled is not None else frozenset()
+            self.dependencies[key] = variables
+        self.order = self._sort([key for key, label, calculation in calculations])
+
+    def _calculation_dependencies(self, key):
+        return set(k for v in self.dependencies[key] if v not in self.values
+                   for k in self.keys.get(v, []))
+
+    def _sort(self, keys):
+        """
+        Topologically sort the calculations, raising an error on cycles
+        """
+        remaining = {key: self._calculation_dependencies(key) for key in keys}
+        order = []
+        while remaining:
+            ready = [key for key in keys if key in remaining and not remaining[key]]
+            if not ready:
+                raise CalculationCycleError(sorted(set(self.labels[k] for k in remaining)))
+            for key in ready:
+                order.append(key)
+                del remaining[key]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
+    def downstream(self, changed):
+        """
+        Get the keys of the calculations affected when the named values change
+        """
+        affected = set()
+        changed = set(changed)
+        for key in self.order:
+            label = self.labels[key]
+            if label in changed or self.dependencies[key] & changed:
+                affected.add(key)
+                if label not in self.values:
+                    changed.add(label)
+        return affected
+
+    def evaluate(self, values, changed=None, previous=None):
+        """
+        Evaluate every calculation in order against a dict of values
+
+        Each result is available to later calculations by label. If
+        changed names and previous results are given only calculations
+        downstream of the changes are evaluated again.
+        """
+        values = dict(values)
+        previous = previous or {}
+        to_update = None
+        if changed is not None:
+            to_update = self.downstream(changed)
+        results = {}
+        for key in self.order:
+            if to_update is not None and key not in to_update and key in previous:
+                results[key] = previous[key]
+            else:
+                results[key] = calculate(self.calculations[key], values)
+            if self.labels[key] not in self.values:
+                values[self.labels[key]] = results[key]
+        return results
+
+    def evaluate_many(self, rows):
+        """
+        Evaluate every calculation in order across a list of value dicts
+
+        Returns a dict of key to a list of results, one per row.
+        """
+        rows = [dict(row) for row in rows]
+        results = {}
+        for key in self.order:
+            results[key] = calculate_many(self.calculations[key], rows)
+            if self.labels[key] not in self.values:
+                for row, result in zip(rows, results[key]):
+                    row[self.labels[key]] = result
+        return results
+
+
+@lru_cache(maxsize=CALCULATION_CACHE_SIZE)
+def calculation_graph(calculations, values=frozenset()):
+    """
+    Get a cached CalculationGraph for a tuple of (key, label, calculation) triples
+    """
+    return CalculationGraph(calculations, values)
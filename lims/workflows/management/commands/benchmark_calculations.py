@@ -0,0 +1,87 @@
+import copy
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from lims.workflows.calculation import calculate
+from lims.workflows.views import RunViewSet
+
+
+FIELD_TYPES = ['input_fields', 'step_fields', 'variable_fields', 'output_fields']
+
+
+class Command(BaseCommand):
+    help = 'Compares per-product and vectorised evaluation of task calculations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, nargs='+', default=[96, 384])
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def _task_data(self, products):
+        """
+        Generate task data in the same shape as RunViewSet._generate_data_dict
+        """
+        calculations = [
+            {'id': 1, 'label': 'Volume', 'calculation': '{concentration} * {product_input_amount}'},
+            {'id': 2, 'label': 'Water', 'calculation': '({total} - {concentration}) / 2'},
+            {'id': 3, 'label': 'Buffer', 'calculation': 'round({total} * 0.1 + {enzyme}^2)'},
+        ]
+        task_data = {}
+        for i in range(products):
+            task_data['P{}'.format(i)] = {
+                'product_input_amount': random.uniform(1, 10),
+                'calculation_fields': copy.deepcopy(calculations),
+                'input_fields': [
+                    {'label': 'enzyme', 'amount': random.uniform(1, 5), 'calculation_used': 1},
+                    {'label': 'buffer', 'amount': 1, 'calculation_used': 3},
+                ],
+                'variable_fields': [
+                    {'label': 'concentration', 'amount': random.uniform(1, 5)},
+                    {'label': 'total', 'amount': random.uniform(10, 50)},
+                ],
+                'step_fields': [
+                    {'label': 'mix', 'properties': [{'label': 'water', 'amount': 1}]},
+                ],
+                'output_fields': [
+                    {'label': 'product', 'amount': 1, 'calculation_used': 1},
+                    {'label': 'waste', 'amount': 1, 'calculation_used': 2},
+                ],
+            }
+        return task_data
+
+    def _per_product(self, view, task_data):
+        """
+        Evaluate one field of one product at a time
+        """
+        for pid, product_data in task_data.items():
+            calculations = {c['id']: c for c in product_data['calculation_fields']}
+            to_values = view._flatten_values(product_data)
+            for field_type in FIELD_TYPES:
+                for field in product_data[field_type]:
+                    if 'calculation_used' in field and field['calculation_used'] is not None:
+                        calc = calculations[field['calculation_used']]['calculation']
+                        field['amount'] = calculate(calc, to_values)
+        return task_data
+
+    def _time(self, fn, task_data, repeat):
+        """
+        Best time of several runs, each on a fresh copy of the data
+        """
+        timings = []
+        for _ in range(repeat):
+            data = copy.deepcopy(task_data)
+            start = time.perf_counter()
+            fn(data)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def handle(self, *args, **options):
+        view = RunViewSet()
+        for products in options['products']:
+            task_data = self._task_data(products)
+            loop = self._time(lambda data: self._per_product(view, data),
+                              task_data, options['repeat'])
+            batch = self._time(view._perform_calculations, task_data, options['repeat'])
+            self.stdout.write('{} products: per-product {:.2f}ms, vectorised {:.2f}ms'.format(
+                products, loop * 1000, batch * 1000))
@@ -0,0 +1,78 @@
+import io
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from lims.filetemplate.models import FileTemplate, ReadPlan
+from lims.workflows.views import RunViewSet
+
+
+class Command(BaseCommand):
+    help = 'Compares line by line and columnar reading of task input files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wells', type=int, nargs='+', default=[384, 1536])
+        parser.add_argument('--columns', type=int, default=36)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def _template(self, columns):
+        """
+        A file template for plate reader style files, not saved to the DB
+        """
+        plan = ReadPlan(
+            columns=tuple(('Read{}'.format(c), 'read_{}'.format(c), c % 4 == 0)
+                          for c in range(columns)) + (('Well', 'coordinates', False),),
+            identifiers=('Product',),
+            required=('Product', 'Well'))
+        template = FileTemplate(name='Benchmark')
+        template.read_plan = lambda: plan
+        return template
+
+    def _file(self, wells, columns):
+        """
+        Generate a file with a line for each well and its readings
+        """
+        output = io.StringIO()
+        output.write(','.join(['Product', 'Well'] +
+                              ['Read{}'.format(c) for c in range(columns)]) + '\n')
+        for w in range(wells):
+            readings = ['{:.4f}'.format(random.uniform(0, 4)) for c in range(columns)]
+            output.write(','.join(['P{}'.format(w), 'W{}'.format(w)] + readings) + '\n')
+        return output.getvalue()
+
+    def _data_items(self, wells):
+        """
+        Data items as generated for a task, only those keys the files touch
+        """
+        return {'P{}'.format(w): {'product_input_amount': 1} for w in range(wells)}
+
+    def _time(self, fn, repeat):
+        """
+        Best time of several runs
+        """
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def handle(self, *args, **options):
+        view = RunViewSet()
+        template = self._template(options['columns'])
+        for wells in options['wells']:
+            content = self._file(wells, options['columns'])
+
+            def by_line():
+                lines = template.read(io.StringIO(content))
+                view._merge_file_lines(lines.items(), self._data_items(wells))
+
+            def by_column():
+                columns = template.read_columns(io.StringIO(content))
+                view._merge_file_columns(columns, self._data_items(wells))
+
+            lines = self._time(by_line, options['repeat'])
+            columns = self._time(by_column, options['repeat'])
+            self.stdout.write('{} wells: by line {:.2f}ms, columnar {:.2f}ms'.format(
+                wells, lines * 1000, columns * 1000))
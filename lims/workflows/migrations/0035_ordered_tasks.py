@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_task_order(apps, schema_editor):
+    """
+    Create the ordered task tables from the comma seperated task IDs
+    """
+    for model_name, ids_field, fk_name in [('Workflow', 'order', 'workflow'),
+                                           ('Run', 'tasks', 'run')]:
+        Model = apps.get_model('workflows', model_name)
+        Row = apps.get_model('workflows', '{}Task'.format(model_name))
+        rows = []
+        for obj_id, task_ids in Model.objects.values_list('id', ids_field):
+            if task_ids:
+                for position, task_id in enumerate(task_ids.split(',')):
+                    rows.append(Row(**{'{}_id'.format(fk_name): obj_id,
+                                       'task_id': int(task_id),
+                                       'position': position}))
+        Row.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0034_auto_20180420_1045'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='task_order', to='workflows.Run')),
+                ('task', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='workflows.TaskTemplate')),
+            ],
+            options={
+                'ordering': ['position'],
+            },
+        ),
+        migrations.CreateModel(
+            name='WorkflowTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('task', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='workflows.TaskTemplate')),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='task_order', to='workflows.Workflow')),
+            ],
+            options={
+                'ordering': ['position'],
+            },
+        ),
+        migrations.RunPython(copy_task_order, migrations.RunPython.noop),
+    ]
@@ -1,15 +1,102 @@
+from collections import ChainMap
+
 from django.db import models
+from django.db.models import Prefetch, prefetch_related_objects
 import reversion
 from django.contrib.auth.models import User
 
 from lims.projects.models import Product
 from lims.equipment.models import Equipment
 from lims.inventory.models import Item, ItemType, ItemTransfer, AmountMeasure
+from lims.inventory.itemtypes import get_descendants, Descendants
 from lims.filetemplate.models import FileTemplate
+from lims.permissions.permissions import prefetch_group_permissions
+
+
+class OrderedTasksMixin():
+    """
+    Keeps an ordered table of tasks in step with a comma seperated list of IDs
+
+    The list of IDs is what is read and written through the API. The table
+    lets the ordered tasks be loaded in one query, which is then cached on
+    the instance.
+    """
+    # The field holding the comma seperated IDs and the related name of the table
+    task_ids_field = None
+    task_rows_name = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_task_ids = instance.__dict__.get(cls.task_ids_field, None)
+        return instance
+
+    def _parse_task_ids(self):
+        task_ids = getattr(self, self.task_ids_field)
+        if task_ids:
+            return [int(v) for v in task_ids.split(',')]
+        return []
+
+    def _set_task_rows(self, rows):
+        """
+        Cache a list of (task ID, task) for the current task IDs
+        """
+        self._task_rows = (getattr(self, self.task_ids_field), rows)
+
+    def _get_task_rows(self):
+        task_ids = getattr(self, self.task_ids_field)
+        cached = getattr(self, '_task_rows', None)
+        if cached is None or cached[0] != task_ids:
+            if task_ids == getattr(self, '_saved_task_ids', None):
+                rows = getattr(self, self.task_rows_name).select_related('task')
+                self._set_task_rows([(r.task_id, r.task) for r in rows])
+            else:
+                # Not yet saved so the table is out of date
+                task_list = self._parse_task_ids()
+                tasks = TaskTemplate.objects.in_bulk(task_list)
+                self._set_task_rows([(t, tasks.get(t, None)) for t in task_list])
+        return self._task_rows[1]
+
+    def get_task_list(self):
+        """
+        Get list of task IDs
+        """
+        return [task_id for task_id, task in self._get_task_rows()]
+
+    def get_tasks(self):
+        """
+        Get an ordered list of tasks
+        """
+        return [task for task_id, task in self._get_task_rows()]
+
+    def get_task_at_index(self, index):
+        """
+        Get a single task at the provided index
+        """
+        rows = self._get_task_rows()
+        if len(rows) > 0:
+            return rows[index][1]
+        return None
+
+    def save_task_order(self):
+        """
+        Update the table of tasks if the task IDs have changed since loaded
+
+        Called on post_save so it also happens for raw saves, e.g. when a
+        version is reverted.
+        """
+        task_ids = getattr(self, self.task_ids_field)
+        if task_ids != getattr(self, '_saved_task_ids', None):
+            rows = getattr(self, self.task_rows_name)
+            rows.all().delete()
+            rows.model.objects.bulk_create([
+                rows.model(**{rows.field.name: self, 'task_id': task_id, 'position': i})
+                for i, task_id in enumerate(self._parse_task_ids())])
+            self._saved_task_ids = task_ids
 
 
 @reversion.register()
-class Workflow(models.Model):
+class Workflow(OrderedTasksMixin, models.Model):
     name = models.CharField(max_length=50)
     order = models.CharField(max_length=200, blank=True)
     created_by = models.ForeignKey(User)
@@ -21,24 +108,8 @@ class Workflow(models.Model):
             ('view_workflow', 'View workflow',),
         )
 
-    def get_tasks(self):
-        if self.order:
-            order = [int(v) for v in self.order.split(',')]
-            tasks = list(TaskTemplate.objects.filter(pk__in=order))
-            ordered_tasks = []
-            for o in order:
-                ordered_tasks.append(next((obj for obj in tasks if obj.id == o), None))
-            return ordered_tasks
-        return []
-
-    def get_task_at_index(self, index):
-        if self.order:
-            order = [int(v) for v in self.order.split(',')]
-            try:
-                return TaskTemplate.objects.get(pk=order[index])
-            except TaskTemplate.DoesNotExist:
-                return None
-        return None
+    task_ids_field = 'order'
+    task_rows_name = 'task_order'
 
     def __str__(self):
         return self.name
@@ -61,7 +132,7 @@ class RunLabware(models.Model):
 
 
 @reversion.register()
-class Run(models.Model):
+class Run(OrderedTasksMixin, models.Model):
     """
     Takes a series of tasks (e.g. from a workflow) and runs products through them
 
@@ -96,48 +167,18 @@ class Run(models.Model):
     date_finished = models.DateTimeField(blank=True, null=True)
     started_by = models.ForeignKey(User)
 
-    def get_task_list(self):
-        """
-        Get list of task IDs
-        """
-        return [int(v) for v in self.tasks.split(',')]
-
-    def get_tasks(self):
-        """
-        Get an ordered list of tasks for this run
-        """
-        if self.tasks:
-            task_list = [int(v) for v in self.tasks.split(',')]
-            tasks = list(TaskTemplate.objects.filter(pk__in=task_list))
-            ordered_tasks = []
-            for t in task_list:
-                ordered_tasks.append(next((obj for obj in tasks if obj.id == t), None))
-            return ordered_tasks
-        return []
-
-    def get_task_at_index(self, index):
-        """
-        Get a single task at the provided index
-        """
-        if self.tasks:
-            task_list = [int(v) for v in self.tasks.split(',')]
-            try:
-                return TaskTemplate.objects.get(pk=task_list[index])
-            except TaskTemplate.DoesNotExist:
-                return None
-        return None
+    task_ids_field = 'tasks'
+    task_rows_name = 'task_order'
 
     def has_valid_inputs(self):
         task = self.get_task_at_index(self.current_task)
         valid = {}
         if task:
+            input_types = task.product_input_types().ids
             for p in self.products.all():
-                if task.product_input:
-                    input_types = task.product_input.get_descendants(include_self=True)
-                    if p.linked_inventory.filter(item_type__in=input_types).count() > 0:
-                        valid[p.id] = True
-                    else:
-                        valid[p.id] = False
+                if task.product_input_id is not None:
+                    valid[p.id] = any(i.item_type_id in input_types
+                                      for i in p.linked_inventory.all())
                 else:
                     valid[p.id] = True
             return valid
@@ -198,10 +239,26 @@ class TaskTemplate(models.Model):
     def store_labware_as(self):
         return 'labware_identifier'
 
+    def product_input_types(self):
+        """
+        The ids and names of the product input item type and its descendants
+        """
+        if self.product_input_id is not None:
+            return get_descendants(self.product_input_id)
+        return Descendants(frozenset(), ())
+
     def valid_product_input_types(self):
-        if self.product_input is not None:
-            return [v.name for v in self.product_input.get_descendants(include_self=True)]
-        return []
+        return list(self.product_input_types().names)
+
+    def value_labels(self):
+        """
+        Labels of fields that provide plain values to calculations
+        """
+        labels = set(['product_input_amount'])
+        for field_type in ['input_fields', 'variable_fields', 'output_fields']:
+            labels.update(f.label for f in getattr(self, field_type).all())
+        labels.update(p.label for p in StepFieldProperty.objects.filter(step__template=self))
+        return labels
 
     def _flatten_to_values(self, the_dict):
         flat = {}
@@ -210,62 +267,53 @@ class TaskTemplate(models.Model):
                 flat[label] = value
         return flat
 
-    def data_to_output_file(self, file_template,
-                            task_data_dict, transfer_data_dict):
-        """
-        Convert validated task data to output file data.
-        """
-        # Take in dict of data
-        # Map fields to field in dict
-        # Raise validation error if not possible???
-        fields = file_template.fields.all()
-
-        # Flatten out fields into a single level with
-        # the rest of the task data.
-        flat_products = {}
-        for product in task_data_dict:
-            # Get non-nested values
-            product_data = self._flatten_to_values(product)
-            product_data.update(self._flatten_to_values(product['data']))
-
-            for fieldset in ['input_fields', 'output_fields', 'step_fields',
-                             'variable_fields', 'calculation_fields']:
-                for field in product['data'][fieldset]:
-                    product_data[field['label']] = field
-            flat_products[product['product_name']] = product_data
-
-        lines = []
+    def _output_data(self, file_template, task_data, transfer_data):
         if file_template.use_inputs:
             # Associate the data with each individual input for the task
             # If there are 4 products with 5 inputs each the result will
-            # be 4*5 lines (20).
-            for product in task_data_dict:
+            # be 4*5 lines (20). The product's data is shared by its lines.
+            for product in task_data:
+                product_data = self._flatten_product(product)
                 for task_input in product['data']['product_input_amounts']:
-                    p = flat_products[product['product_name']].copy()
-                    p['task_input'] = task_input
-                    lines.append(p)
+                    yield ChainMap({'task_input': task_input}, product_data)
         elif file_template.total_inputs_only:
             # TODO This code looks broken - it is just cut-and-paste from above
             # and the transfer variable is never used within the loop
-            for transfer in transfer_data_dict:
-                lines.append(transfer)
+            for transfer in transfer_data:
+                yield transfer
         else:
             # List by products so 4 products = 4 lines
-            for product in flat_products.values():
-                lines.append(product)
-
-        output = []
-        for l in lines:
-            line_dict = {}
-            for f in fields:
-                key_path = f.key_to_path()
-                field_value = l
-                for key in key_path:
-                    # TODO Handle things better when key does not exist
-                    field_value = field_value.get(key, None)
-                line_dict[f.name] = field_value
-            output.append(line_dict)
-        return output
+            for product in task_data:
+                yield self._flatten_product(product)
+
+    def _flatten_product(self, product):
+        # Flatten out fields into a single level with
+        # the rest of the task data.
+        product_data = self._flatten_to_values(product)
+        product_data.update(self._flatten_to_values(product['data']))
+        for fieldset in ['input_fields', 'output_fields', 'step_fields',
+                         'variable_fields', 'calculation_fields']:
+            for field in product['data'][fieldset]:
+                product_data[field['label']] = field
+        return product_data
+
+    def output_lines(self, file_template, task_data, transfer_data):
+        """
+        Generate the lines of an output file from task data
+
+        The task and transfer data can be any iterables of serialized data
+        entries and transfers, they are only read as lines are made.
+        """
+        getters = [(f.name, f.value_getter()) for f in file_template.fields.all()]
+        for line in self._output_data(file_template, task_data, transfer_data):
+            yield {name: get_value(line) for name, get_value in getters}
+
+    def data_to_output_file(self, file_template,
+                            task_data_dict, transfer_data_dict):
+        """
+        Convert validated task data to output file data.
+        """
+        return list(self.output_lines(file_template, task_data_dict, transfer_data_dict))
 
     def __str__(self):
         return self.name
@@ -419,3 +467,74 @@ class StepFieldProperty(models.Model):
 
     def __str__(self):
         return self.label
+
+
+def prefetch_runs(runs):
+    """
+    Load the tasks and products of many runs at once
+
+    Serializing the runs afterwards takes a fixed number of queries no
+    matter how many runs or products there are.
+    """
+    runs = list(runs)
+    prefetch_related_objects(
+        runs,
+        'started_by',
+        'labware',
+        Prefetch('transfers', queryset=ItemTransfer.objects.only('id')),
+        Prefetch('products',
+                 queryset=Product.objects.select_related('product_type', 'location')),
+        'products__runs',
+        Prefetch('products__linked_inventory',
+                 queryset=Item.objects.select_related('item_type')),
+    )
+    prefetch_group_permissions(runs)
+    return prefetch_run_tasks(runs)
+
+
+def prefetch_run_tasks(runs):
+    """
+    Load the tasks of many runs at once
+
+    Runs with unsaved task changes load their own tasks when needed, but
+    are still in the list returned.
+    """
+    runs = list(runs)
+    saved = [r for r in runs if r.tasks == getattr(r, '_saved_task_ids', None)]
+    rows = {}
+    for row in RunTask.objects.filter(run__in=saved) \
+            .select_related('task__product_input', 'task__created_by'):
+        rows.setdefault(row.run_id, []).append(row)
+    prefetch_related_objects([row.task for run_rows in rows.values() for row in run_rows
+                              if row.task is not None], 'capable_equipment')
+    for r in saved:
+        r._set_task_rows([(row.task_id, row.task) for row in rows.get(r.id, [])])
+    return runs
+
+
+class WorkflowTask(models.Model):
+    """
+    The position of a task in a workflow
+    """
+    workflow = models.ForeignKey(Workflow, related_name='task_order')
+    # Not constrained so IDs of deleted tasks are kept, as in Workflow.order
+    task = models.ForeignKey(TaskTemplate, null=True, related_name='+',
+                             on_delete=models.DO_NOTHING, db_constraint=False)
+    position = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['position']
+
+
+class RunTask(models.Model):
+    """
+    The position of a task in a run
+    """
+    run = models.ForeignKey(Run, related_name='task_order')
+    # Not constrained so IDs of deleted tasks are kept, as in Run.tasks
+    task = models.ForeignKey(TaskTemplate, null=True, related_name='+',
+                             on_delete=models.DO_NOTHING, db_constraint=False)
+    position = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['position']
@@ -1,7 +1,5 @@
-import re
-
+from django.db.models import Manager
 from rest_framework import serializers
-from pyparsing import ParseException
 
 from lims.permissions.permissions import SerializerPermissionsMixin
 
@@ -14,8 +12,8 @@ from .models import (Workflow,
                      Run,
                      TaskTemplate, InputFieldTemplate, VariableFieldTemplate,
                      OutputFieldTemplate, CalculationFieldTemplate, StepFieldTemplate,
-                     StepFieldProperty)
-from .calculation import NumericStringParser
+                     StepFieldProperty, prefetch_runs, prefetch_run_tasks)
+from .calculation import calculation_graph, CalculationGraph, CalculationCycleError
 
 
 class WorkflowSerializer(SerializerPermissionsMixin, serializers.ModelSerializer):
@@ -148,6 +146,25 @@ class CalculationFieldTemplateSerializer(serializers.ModelSerializer):
         model = CalculationFieldTemplate
         fields = '__all__'
 
+    def validate(self, data):
+        """
+        Check the calculation does not create a loop with others on the task
+        """
+        template = data.get('template', getattr(self.instance, 'template', None))
+        if template is not None:
+            label = data.get('label', getattr(self.instance, 'label', None))
+            calculation = data.get('calculation', getattr(self.instance, 'calculation', ''))
+            others = template.calculation_fields.all()
+            if self.instance is not None:
+                others = others.exclude(pk=self.instance.pk)
+            calculations = [(c.pk, c.label, c.calculation) for c in others]
+            calculations.append((getattr(self.instance, 'pk', None), label, calculation))
+            try:
+                CalculationGraph(calculations, frozenset(template.value_labels()))
+            except CalculationCycleError as e:
+                raise serializers.ValidationError({'calculation': str(e)})
+        return data
+
 
 class CalculationFieldImportSerializer(CalculationFieldTemplateSerializer):
     class Meta:
@@ -319,33 +336,6 @@ class TaskTemplateSerializer(SerializerPermissionsMixin, serializers.ModelSerial
         self.handle_calculation(rep)
         return rep
 
-    def _replace_fields(self, match):
-        """
-        Replace field names with their correct values
-        """
-        mtch = match.group(1)
-        if mtch in self.flat:
-            return str(self.flat[mtch])
-        return str(0)
-
-    def _perform_calculation(self, calculation):
-        """
-        Parse and perform a calculation using a dict of fields
-
-        Using either a dict of values to field names
-
-        Returns a NaN if the calculation cannot be performed, e.g.
-        incorrect field names.
-        """
-        nsp = NumericStringParser()
-        field_regex = r'\{(.+?)\}'
-        interpolated_calculation = re.sub(field_regex, self._replace_fields, calculation)
-        try:
-            result = nsp.eval(interpolated_calculation)
-        except ParseException:
-            return None
-        return result
-
     def _flatten_values(self, rep):
         flat_values = {}
         for field_type in ['input_fields', 'step_fields', 'variable_fields']:
@@ -365,15 +355,27 @@ class TaskTemplateSerializer(SerializerPermissionsMixin, serializers.ModelSerial
         Perform calculations on all calculation fields on the task
 
         If any data is provided, use that as source for the calculations
-        rather than the defaults on the model.
+        rather than the defaults on the model. Calculations are evaluated in
+        dependency order so can refer to each other by label.
+
+        If a list of changed field labels is in the serializer context only
+        the calculations depending on them are evaluated again.
         """
         # Flatten fields into named dict/ordered dict
-        # Will need some sort of defer if not completed calculation dependent on other calculation
         if 'calculation_fields' in rep:
             self.flat = self._flatten_values(rep)
+            calculations = tuple((c['id'], c['label'], c['calculation'])
+                                 for c in rep['calculation_fields'])
+            try:
+                graph = calculation_graph(calculations, frozenset(self.flat))
+            except CalculationCycleError:
+                results = {}
+            else:
+                previous = {c['id']: c['result'] for c in rep['calculation_fields']
+                            if c.get('result', None) is not None}
+                results = graph.evaluate(self.flat, self.context.get('changed', None), previous)
             for calc in rep['calculation_fields']:
-                result = self._perform_calculation(calc['calculation'])
-                calc['result'] = result
+                calc['result'] = results.get(calc['id'], None)
         return rep
 
 
@@ -461,6 +463,17 @@ class WorkflowImportSerializer(SerializerPermissionsMixin, serializers.Serialize
     data = serializers.JSONField()
 
 
+class RunListSerializer(serializers.ListSerializer):
+    """
+    Prefetch everything for a page of runs before serializing them
+    """
+
+    def to_representation(self, data):
+        if isinstance(data, Manager):
+            data = data.all()
+        return super().to_representation(prefetch_runs(data))
+
+
 class RunSerializer(SerializerPermissionsMixin, serializers.ModelSerializer):
     """
     Provides basic serialisation of workflow run
@@ -477,6 +490,7 @@ class RunSerializer(SerializerPermissionsMixin, serializers.ModelSerializer):
     class Meta:
         model = Run
         fields = '__all__'
+        list_serializer_class = RunListSerializer
 
 
 class DetailedRunSerializer(serializers.ModelSerializer):
@@ -486,6 +500,10 @@ class DetailedRunSerializer(serializers.ModelSerializer):
                                          source='get_tasks')
     transfers = ItemTransferPreviewSerializer(read_only=True, many=True)
 
+    def to_representation(self, instance):
+        prefetch_run_tasks([instance])
+        return super().to_representation(instance)
+
     class Meta:
         model = Run
         fields = '__all__'
@@ -1,10 +1,19 @@
+from django.db.models.signals import post_save
 from django.dispatch import receiver
 
-from .models import TaskTemplate
+from .models import TaskTemplate, Workflow, Run
 from lims.permissions.signals import permissions_removed, permissions_changed
 from lims.permissions.permissions import ViewPermissionsMixin
 
 
+def task_fields(task):
+    """
+    Get all fields of all types associated with a task
+    """
+    field_types = ('input', 'variable', 'step', 'output', 'calculation',)
+    return [f for ft in field_types for f in getattr(task, ft + '_fields').all()]
+
+
 @receiver(permissions_changed, sender=TaskTemplate)
 def change_field_permissions(sender, **kwargs):
     """
@@ -14,11 +23,7 @@ def change_field_permissions(sender, **kwargs):
         task = TaskTemplate.objects.get(pk=kwargs['id'])
     except:
         return
-    field_types = ('input', 'variable', 'step', 'output', 'calculation',)
-    for ft in field_types:
-        fields = getattr(task, ft + '_fields').all()
-        for f in fields:
-            ViewPermissionsMixin().assign_permissions(f, kwargs['permissions'])
+    ViewPermissionsMixin().bulk_assign_permissions(task_fields(task), kwargs['permissions'])
 
 
 @receiver(permissions_removed, sender=TaskTemplate)
@@ -30,8 +35,13 @@ def remove_field_permissions(sender, **kwargs):
         task = TaskTemplate.objects.get(pk=kwargs['id'])
     except:
         return
-    field_types = ('input', 'variable', 'step', 'output', 'calculation',)
-    for ft in field_types:
-        fields = getattr(task, ft + '_fields').all()
-        for f in fields:
-            ViewPermissionsMixin().unassign_permissions(f, kwargs['groups'])
+    ViewPermissionsMixin().bulk_unassign_permissions(task_fields(task), kwargs['groups'])
+
+
+@receiver(post_save, sender=Workflow)
+@receiver(post_save, sender=Run)
+def save_task_order(sender, instance, **kwargs):
+    """
+    Keep the ordered table of tasks in step with the task IDs
+    """
+    instance.save_task_order()
@@ -1,4 +1,7 @@
 from django.contrib.auth.models import Permission, Group
+from django.db import connection
+from django.test import SimpleTestCase
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from lims.shared.loggedintestcase import LoggedInTestCase
 from .models import Workflow, Run, RunLabware, TaskTemplate, \
@@ -9,9 +12,12 @@ from lims.filetemplate.models import FileTemplate, FileTemplateField
 from lims.inventory.models import (Location, Item, ItemType, AmountMeasure, ItemTransfer,
                                    ItemProperty)
 from lims.equipment.models import Equipment
+from .serializers import RunSerializer
 from .views import ViewPermissionsMixin
 from lims.projects.models import Project, Product, ProductStatus
 from lims.shared.models import Organism
+import csv
+import io
 import json
 from lims.inventory.serializers import ItemTransferPreviewSerializer
 from lims.datastore.serializers import DataEntrySerializer
@@ -19,6 +25,8 @@ from lims.drivers.models import CopyFileDriver, CopyFilePath
 import os
 import filecmp
 import tempfile
+from .calculation import (calculate, calculate_many, compile_calculation,
+                          CalculationGraph, CalculationCycleError)
 
 
 class WorkflowTestCase(LoggedInTestCase):
@@ -1708,6 +1716,22 @@ class TaskTestCase(LoggedInTestCase):
         self.assertEqual(self._task3.step_fields.count(), 2)
         self.assertIs(self._task3.step_fields.filter(description="Step field 2").exists(), True)
 
+    def test_admin_create_calculation_taskfield_cycle(self):
+        self._setup_test_task_fields()
+        self._asAdmin()
+        new_taskfield = {"template": self._task3.id,
+                         "label": "calc2",
+                         "calculation": "{calc1} * 2"}
+        response = self._client.post('/taskfields/?type=%s' % "Calculation", new_taskfield)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        updated_taskfield = {"calculation": "{calc2} + 1"}
+        response = self._client.patch('/taskfields/%d/?type=%s' % (self._calcField.id,
+                                                                   "Calculation"),
+                                      updated_taskfield)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self._calcField.refresh_from_db()
+        self.assertNotEqual(self._calcField.calculation, "{calc2} + 1")
+
     def test_user_edit_taskfield_readonly(self):
         self._setup_test_task_fields()
         ViewPermissionsMixin().assign_permissions(instance=self._task3,
@@ -2164,6 +2188,21 @@ class RunTestCase(LoggedInTestCase):
         self.assertIs(Run.objects.filter(name="run1").exists(), True)
         self.assertIs(Run.objects.filter(name="run2").exists(), True)
 
+    def test_task_order(self):
+        run = Run.objects.get(pk=self._run1.id)
+        with self.assertNumQueries(1):
+            tasks = run.get_tasks()
+            self.assertEqual(run.get_task_at_index(1), self._task2)
+            self.assertEqual(run.get_task_list(),
+                             [self._task3.id, self._task2.id, self._task1.id])
+        self.assertEqual(tasks, [self._task3, self._task2, self._task1])
+        run.tasks = '%d,%d' % (self._task1.id, self._task4.id)
+        self.assertEqual(run.get_tasks(), [self._task1, self._task4])
+        run.save()
+        run = Run.objects.get(pk=self._run1.id)
+        self.assertEqual(run.get_tasks(), [self._task1, self._task4])
+        self.assertEqual(run.task_order.count(), 2)
+
     def test_access_anonymous(self):
         self._asAnonymous()
         response = self._client.get('/runs/')
@@ -2196,6 +2235,39 @@ class RunTestCase(LoggedInTestCase):
         runs = response.data
         self.assertEqual(len(runs["results"]), 3)
 
+    def _list_runs_queries(self, total):
+        while Run.objects.count() < total:
+            run = Run.objects.create(
+                name="bulk run",
+                tasks='%d,%d,%d' % (self._task3.id, self._task2.id, self._task1.id),
+                started_by=self._joeBloggs)
+            run.products.add(self._joeBloggsProduct, self._jimBeamProduct)
+            run.labware.add(self._runlabware)
+            ViewPermissionsMixin().assign_permissions(instance=run,
+                                                      permissions={"jane_group": "rw"})
+        with CaptureQueriesContext(connection) as queries:
+            response = self._client.get('/runs/?limit=%d' % total)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), total)
+        return len(queries)
+
+    def test_user_list_query_count(self):
+        # Listing runs takes the same number of queries however many are listed
+        self._asJaneDoe()
+        small = self._list_runs_queries(15)
+        large = self._list_runs_queries(200)
+        self.assertEqual(small, large)
+        self.assertLess(large, 30)
+
+    def test_list_unsaved_tasks(self):
+        runs = list(Run.objects.filter(id__in=[self._run1.id, self._run2.id]).order_by('id'))
+        runs[0].tasks = '%d' % self._task1.id
+        data = RunSerializer(runs, many=True).data
+        self.assertEqual(len(data), 2)
+        self.assertEqual([t['id'] for t in data[0]['tasks_list']], [self._task1.id])
+        self.assertEqual([t['id'] for t in data[1]['tasks_list']],
+                         [self._task4.id, self._task1.id])
+
     def test_user_view_own(self):
         self._asJoeBloggs()
         response = self._client.get('/runs/%d/' % self._run1.id)
@@ -2990,6 +3062,27 @@ class RunTestCase(LoggedInTestCase):
                           "task_input.name": "Item_2",
                           "task_input.amount": 1.0})
 
+    def test_get_file_stream(self):
+        start_task = self._prepare_start_task()
+        self._asJoeBloggs()
+        response = self._client.post(
+            "/runs/%d/start_task/" % self._run1.id, data=start_task)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self._client.get(
+            "/runs/%d/get_file/?file_id=%d" % (self._run1.id, self._equipTempl1.id))
+        expected = response.data
+        response = self._client.get(
+            "/runs/%d/get_file/?file_id=%d&stream=True" % (self._run1.id, self._equipTempl1.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        content = b''.join(response.streaming_content).decode()
+        lines = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(list(lines[0].keys()),
+                         sorted(self._equipTempl1.fields.values_list('name', flat=True)))
+        self.assertEqual([(line["product_name"], line["task_input.name"]) for line in lines],
+                         [(line["product_name"], line["task_input.name"]) for line in expected])
+
     def test_get_file_total_inputs(self):
         # Start a task to get status on
         start_task = self._prepare_start_task()
@@ -3144,6 +3237,7 @@ class RunTestCase(LoggedInTestCase):
         self.assertEqual(output.item_type, self._prodinput)
         self.assertEqual(output.location, Location.objects.get(name="Lab"))
         self.assertEqual(output.amount_available, 5.0)
+        self.assertIs(output.in_inventory, True)
         self.assertEqual(output.added_by, self._joeBloggs)
         self.assertEqual(output.created_from.count(), 1)
         self.assertEqual(output.created_from.all()[0], self._item3)
@@ -3177,3 +3271,69 @@ class RunTestCase(LoggedInTestCase):
         self.assertEqual(runresp["products"][0], self._jimBeamProduct.id)
         self.assertEqual(runresp["tasks"],
                          "%d,%d,%d" % (self._task3.id, self._task2.id, self._task1.id))
+
+
+class CalculationTestCase(SimpleTestCase):
+
+    def test_calculate_values(self):
+        self.assertEqual(calculate('({a} + {b}) / {c}', {'a': 1, 'b': 2, 'c': 4}), 0.75)
+        self.assertEqual(calculate('2 - {a}', {'a': -3}), 5)
+        self.assertEqual(calculate('{a}^2', {'a': -3}), 9)
+
+    def test_calculate_missing_value(self):
+        self.assertEqual(calculate('{missing} + 1', {}), 1)
+
+    def test_calculate_invalid(self):
+        self.assertIsNone(calculate('{a} +', {'a': 1}))
+        self.assertIsNone(calculate('{a} + 1', {'a': None}))
+
+    def test_compiled_once(self):
+        compiled = compile_calculation('{x} * {y}')
+        self.assertIs(compile_calculation('{x} * {y}'), compiled)
+        self.assertEqual(compiled.variables, frozenset(['x', 'y']))
+        self.assertEqual(compiled.evaluate({'x': 2, 'y': 3}), 6)
+        self.assertEqual(compiled.evaluate({'x': 4, 'y': 3}), 12)
+
+    def test_calculate_many(self):
+        rows = [{'a': 1, 'b': 2}, {'a': 3}, {'a': None, 'b': 1}, {'a': 1, 'b': 0}]
+        self.assertEqual(calculate_many('{a} / {b}', rows), [0.5, None, None, None])
+        self.assertEqual(calculate_many('{a} * 2', rows), [2, 6, None, 2])
+        self.assertEqual(calculate_many('{a} +', rows), [None] * 4)
+
+    def test_calculate_divide_by_zero(self):
+        compiled = compile_calculation('{a} / {b}')
+        rows = [{'a': 1, 'b': 0}, {'a': 0, 'b': 0}, {'a': 1, 'b': 2}]
+        # Both ways of evaluating give the same results
+        self.assertEqual([compiled.evaluate(row) for row in rows], [None, None, 0.5])
+        self.assertEqual(compiled.evaluate_many(rows), [None, None, 0.5])
+        # Including by a constant
+        compiled = compile_calculation('{a} + 1 / 0')
+        self.assertEqual([compiled.evaluate(row) for row in rows], [None, None, None])
+        self.assertEqual(compiled.evaluate_many(rows), [None, None, None])
+
+    def test_calculation_graph_order(self):
+        graph = CalculationGraph([(1, 'c', '{b} * 2'), (2, 'b', '{a} + 1'), (3, 'a', '{x} * 3')],
+                                 frozenset(['x']))
+        self.assertEqual(graph.order, [3, 2, 1])
+        self.assertEqual(graph.evaluate({'x': 1}), {3: 3, 2: 4, 1: 8})
+        self.assertEqual(graph.evaluate_many([{'x': 1}, {'x': 2}]),
+                         {3: [3, 6], 2: [4, 7], 1: [8, 14]})
+
+    def test_calculation_graph_downstream(self):
+        graph = CalculationGraph([(1, 'a', '{x}'), (2, 'b', '{a} + {y}'), (3, 'c', '{y}')],
+                                 frozenset(['x', 'y']))
+        self.assertEqual(graph.downstream(['x']), set([1, 2]))
+        previous = {1: 1, 2: 2, 3: 100}
+        self.assertEqual(graph.evaluate({'x': 5, 'y': 1}, ['x'], previous),
+                         {1: 5, 2: 6, 3: 100})
+
+    def test_calculation_graph_duplicate_labels(self):
+        graph = CalculationGraph([(1, 'a', '{x} + 1'), (2, 'a', '{x} * 10')],
+                                 frozenset(['x']))
+        self.assertEqual(graph.evaluate({'x': 2}), {1: 3, 2: 20})
+        self.assertEqual(graph.evaluate_many([{'x': 1}, {'x': 2}]),
+                         {1: [2, 3], 2: [10, 20]})
+
+    def test_calculation_graph_cycle(self):
+        with self.assertRaises(CalculationCycleError):
+            CalculationGraph([(1, 'a', '{b}'), (2, 'b', '{a} + 1')])
@@ -1,16 +1,17 @@
 from io import TextIOWrapper
 import json
 import copy
+import logging
+import time
 import uuid
-import re
 
-from pint import UnitRegistry, UndefinedUnitError
-from pyparsing import ParseException
 
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import StreamingHttpResponse
+from django.db import transaction
+from django.db.models import Q, F, Case, When, Value, FloatField
 
 from django.utils import timezone
-from guardian.shortcuts import get_group_perms
 
 import django_filters
 
@@ -34,8 +35,11 @@ from lims.permissions.permissions import (ViewPermissionsMixin,
                                           ExtendedObjectPermissionsFilter)
 
 from lims.shared.mixins import StatsViewMixin, AuditTrailViewMixin
+from lims.shared.signals import updated_in_bulk
 from lims.inventory.models import (Item, ItemTransfer, AmountMeasure, Location,
-                                   ItemType)
+                                   ItemType, ItemProperty)
+from lims.inventory.units import as_measured_value
+from lims.inventory.itemtypes import get_descendants_by_name
 from lims.filetemplate.models import FileTemplate
 from lims.filetemplate.serializers import FileTemplateSerializer  # noqa
 from lims.inventory.serializers import (ItemTransferPreviewSerializer,  # noqa
@@ -77,7 +81,9 @@ from .serializers import (  # noqa
 from lims.datastore.models import DataEntry
 from lims.datastore.serializers import DataEntrySerializer
 from lims.equipment.models import Equipment
-from .calculation import NumericStringParser
+from .calculation import calculation_graph, CalculationCycleError
+
+logger = logging.getLogger(__name__)
 
 
 class WorkflowViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelViewSet):
@@ -105,7 +111,7 @@ class WorkflowViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelV
         obj = self.get_object()
         serialized_workflow = WorkflowSerializer(obj)
         # TODO: Strip user and perms data
-        tasks = TaskTemplate.objects.filter(id__in=obj.order.split(','))
+        tasks = TaskTemplate.objects.filter(id__in=obj.get_task_list())
         serialized_tasks = TaskTemplateSerializer(tasks, many=True)
         export_data = {}
         # file templates, locations, measures, item types, equipment
@@ -146,8 +152,9 @@ class WorkflowViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelV
         position = request.query_params.get('position', None)
         if position:
             try:
-                taskId = workflow.order.split(',')[int(position)]
-                task = TaskTemplate.objects.get(pk=taskId)
+                task = workflow.get_task_at_index(int(position))
+                if task is None:
+                    raise ObjectDoesNotExist
                 serializer = TaskTemplateSerializer(task)
                 result = serializer.data
             except IndexError:
@@ -266,6 +273,8 @@ class WorkflowImportView(ViewPermissionsMixin, APIView):
             order = workflow.validated_data['order'].split(',')
             # Store a list of tasks and their original ID
             task_mapping = {}
+            task_instances = []
+            task_permissions = {}
             for task_data in serializer.validated_data['data'].get('tasks', []):
                 task_id = task_data.pop('id', None)
                 task_data['assign_groups'] = self.request.data.get('assign_groups', None)
@@ -284,7 +293,8 @@ class WorkflowImportView(ViewPermissionsMixin, APIView):
                         serialized_task, permissions = \
                                 self.clean_serializer_of_permissions(serialized_task)
                         task_instance = serialized_task.save(created_by=self.request.user)
-                        self.assign_permissions(task_instance, permissions)
+                        task_permissions = permissions
+                        task_instances.append(task_instance)
                         task_mapping[task_id] = task_instance.id
                         # Handle saving + ID's of calculations
                         calcs = {}
@@ -305,6 +315,9 @@ class WorkflowImportView(ViewPermissionsMixin, APIView):
                                 field.validated_data.pop('old_calculation_used', None)
                             field.validated_data['template'] = task_instance
                             field.save()
+            # Every task has the same permissions so assign them together, this
+            # is done once fields are saved so they are given them too
+            self.bulk_assign_permissions(task_instances, task_permissions)
             if is_check:
                 issues = [{'field': k, 'issues': i} for k, i in errors.items()
                           if 'items' not in i]
@@ -378,12 +391,9 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         task_input_items = {}
         for p in run.products.all():
             if input_type:
-                input_type_mdl = ItemType.objects.get(name=input_type)
                 # Get all decendents of the item type
-                with_children = input_type_mdl.get_descendants(include_self=True)
-                # Get list of names of types
-                itn = [t.name for t in with_children]
-                items_picked = p.linked_inventory.filter(item_type__name__in=itn) \
+                with_children = get_descendants_by_name(input_type)
+                items_picked = p.linked_inventory.filter(item_type_id__in=with_children.ids) \
                     .exclude(id__in=excludes)
                 task_input_items[p] = list(items_picked)
             else:
@@ -414,35 +424,6 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
                 data_items[key]['product_inputs'][itm.id] = itm_data
         return data_items
 
-    def _replace_fields(self, values):
-        """
-        Replace field names with their correct values
-        """
-        def match_value(match):
-            mtch = match.group(1)
-            if mtch in values:
-                return str(values[mtch])
-            return str(0)
-        return match_value
-
-    def _calculate_value(self, calculation, values):
-        """
-        Parse and perform a calculation using a dict of fields
-
-        Using either a dict of values to field names
-
-        Returns a NaN if the calculation cannot be performed, e.g.
-        incorrect field names.
-        """
-        nsp = NumericStringParser()
-        field_regex = r'\{(.+?)\}'
-        interpolated_calculation = re.sub(field_regex, self._replace_fields(values), calculation)
-        try:
-            result = nsp.eval(interpolated_calculation)
-        except ParseException:
-            return None
-        return result
-
     def _flatten_values(self, rep):
         """
         Take a dict of task data and reduce to field label: value
@@ -463,28 +444,40 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
     def _perform_calculations(self, task_data):
         """
         Alter fields based on calculations.
+
+        Calculations are evaluated in dependency order, each once across
+        all products in a single vectorised pass.
         """
-        # Operate on each product entry and values for the fields
-        for pid, product_data in task_data.items():
-            # First, index any calculations to refer to later
-            calculations = {c['id']: c for c in product_data['calculation_fields']}
-            # Flatten data to a dict
-            to_values = self._flatten_values(product_data)
+        products = list(task_data.values())
+        if len(products) == 0:
+            return task_data
+        # Flatten data for each product to a dict
+        to_values = [self._flatten_values(product_data) for product_data in products]
+        value_labels = frozenset(label for values in to_values for label in values)
+        # Calculations are identical across products as they come from the task
+        calculation_fields = products[0]['calculation_fields']
+        calculations = tuple((c['id'], c['label'], c['calculation'])
+                             for c in calculation_fields)
+        try:
+            graph = calculation_graph(calculations, value_labels)
+        except CalculationCycleError as e:
+            raise ValidationError({'message': str(e)})
+        results = graph.evaluate_many(to_values)
+        for index, product_data in enumerate(products):
             # Look through each field for calculations
             for field_type in ['input_fields', 'step_fields', 'variable_fields', 'output_fields']:
                 if field_type in product_data:
                     for field in product_data[field_type]:
                         if 'calculation_used' in field and field['calculation_used'] is not None:
-                            # Look up calculations from list
-                            calc = calculations[field['calculation_used']]['calculation']
-                            # Return the calculated value
-                            result = self._calculate_value(calc, to_values)
-                            field['amount'] = result
+                            field['amount'] = results[field['calculation_used']][index]
         return task_data
 
-    def _update_data_items_from_file(self, file_data, data_items):
+    def _update_data_items_from_file(self, file_data, data_items, columnar=False):
         """
         Process input file data in update data dict with new values
+
+        With columnar the files are read into typed columns, so amounts
+        are given as floats rather than strings.
         """
         # TODO: Process file to allow product/item updates easily
         for f in file_data:
@@ -493,39 +486,99 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             except:
                 pass
             else:
-                parsed_file = ft.read(TextIOWrapper(f.file, encoding=f.charset))
-                if parsed_file:
-                    for key, row in parsed_file.items():
-                        data_items[key].update(row)
+                input_file = TextIOWrapper(f.file, encoding=f.charset)
+                if columnar:
+                    parsed_file = ft.read_columns(input_file)
+                    if parsed_file:
+                        self._merge_file_columns(parsed_file, data_items)
                 else:
+                    parsed_file = ft.read(input_file)
+                    if parsed_file:
+                        self._merge_file_lines(parsed_file.items(), data_items)
+                if not parsed_file:
                     message = {
                         'message':
                             'Input file "{}" has incorrect headers/format'.format(f.name)}
                     raise ValidationError(message)
         return data_items
 
+    def _merge_file_lines(self, lines, data_items):
+        """
+        Update each data item with the lines of a file that identify it
+
+        A line identifies a data item if any of its identifier values are
+        the key of the data item. Lines for anything else are ignored.
+        """
+        for identifier, line in lines:
+            for value in identifier:
+                if value in data_items:
+                    data_items[value].update(line)
+
+    def _merge_file_columns(self, columns, data_items):
+        """
+        As _merge_file_lines for a ColumnarFile
+
+        Joins on an index of the file so only lines for the data items
+        are made.
+        """
+        index = columns.index()
+        for key, data_item in data_items.items():
+            for i in index.get(key, []):
+                data_item.update(columns.line(i))
+
     def _as_measured_value(self, amount, measure):
         """
         Convert if possible to a value with units
         """
-        if type(amount) is not float:
-            amount = float(amount)
-        try:
-            value = amount * self.ureg(measure)
-        except UndefinedUnitError:
-            value = amount * self.ureg.count
-        return value
+        return as_measured_value(amount, measure)
 
-    def _get_from_inventory(self, identifier):
+    def _get_inventory(self, identifiers):
         """
-        Get an item from the inventory based on identifier
+        Get items from the inventory in bulk based on identifier
+
+        Returns a dict of identifier to Item.
         """
-        try:
-            item = Item.objects.get(id=identifier)
-        except Item.DoesNotExist:
-            message = {'message': 'Item {} does not exist !'.format(identifier)}
-            raise serializers.ValidationError(message)
-        return item
+        ids = {}
+        for identifier in identifiers:
+            try:
+                ids[identifier] = int(identifier)
+            except (TypeError, ValueError):
+                message = {'message': 'Item {} does not exist !'.format(identifier)}
+                raise serializers.ValidationError(message)
+        items = Item.objects.select_related('amount_measure').in_bulk(set(ids.values()))
+        inventory = {}
+        for identifier, item_id in ids.items():
+            if item_id not in items:
+                message = {'message': 'Item {} does not exist !'.format(identifier)}
+                raise serializers.ValidationError(message)
+            inventory[identifier] = items[item_id]
+        return inventory
+
+    def _find_task_inputs(self, data_items):
+        """
+        Fill in inventory identifiers for input fields that auto find items
+
+        Looks for items with a task_input property of
+        <product_identifier>/<field label> in a single query.
+        """
+        to_find = {}
+        for key, item in data_items.items():
+            for field in item['input_fields']:
+                if field['auto_find_in_inventory']:
+                    identifier = '{}/{}'.format(key, field['label'])
+                    to_find.setdefault(identifier, []).append(field)
+        if len(to_find) > 0:
+            found = {}
+            properties = ItemProperty.objects.filter(name='task_input',
+                                                     value__in=to_find.keys())
+            # Use the most recent item if more than one matches
+            for value, item_id in properties.values_list('value', 'item_id'):
+                found[value] = max(item_id, found.get(value, item_id))
+            for identifier, fields in to_find.items():
+                if identifier not in found:
+                    raise serializers.ValidationError({'message': 'Item does not exist!'})
+                for field in fields:
+                    field['inventory_identifier'] = found[identifier]
 
     def _update_amounts(self, item, amount, store, field):
         """
@@ -538,26 +591,43 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         else:
             store[item]['amount'] += amount
 
-    def _update_item_amounts(self, field, key, data_item_amounts, sum_item_amounts):
+    def _update_item_amounts(self, field, key, inventory, data_item_amounts, sum_item_amounts):
         """
         Referenced update of item amounts + sum item amounts
         """
         amount = self._as_measured_value(field['amount'], field['measure'])
-        item = self._get_from_inventory(field['inventory_identifier'])
+        item = inventory[field['inventory_identifier']]
         data_item_amounts[key][item] = amount
         self._update_amounts(item, amount, sum_item_amounts, field)
 
     def _get_item_amounts(self, data_items, task_data):
         """
         Get the per-product and total sum of items needed for task
+
+        All items are fetched from the inventory up front rather than
+        one query per field per product.
         """
         sum_item_amounts = {}
         data_item_amounts = {}
 
+        uses_labware = task_data.validated_data.get('labware_not_required', False) is not True
+
+        # Gather every item identifier used by the task
+        self._find_task_inputs(data_items)
+        identifiers = set()
+        if uses_labware:
+            identifiers.add(task_data.validated_data['labware_identifier'])
+        for key, item in data_items.items():
+            for field in item['input_fields']:
+                identifiers.add(field.get('inventory_identifier', None))
+            for identifier, field in item['product_inputs'].items():
+                field['inventory_identifier'] = identifier
+                identifiers.add(identifier)
+        inventory = self._get_inventory(identifiers)
+
         # Get labware amounts
-        if task_data.validated_data.get('labware_not_required', False) is not True:
-            labware_identifier = task_data.validated_data['labware_identifier']
-            labware_item = self._get_from_inventory(labware_identifier)
+        if uses_labware:
+            labware_item = inventory[task_data.validated_data['labware_identifier']]
             labware_required = task_data.validated_data['labware_amount']
             labware_barcode = task_data.validated_data.get('labware_barcode', None)
             labware_symbol = None
@@ -572,27 +642,61 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         for key, item in data_items.items():
             data_item_amounts[key] = {}
             for field in item['input_fields']:
-                if field['auto_find_in_inventory']:
-                    identifier = '{}/{}'.format(key, field['label'])
-                    try:
-                        lookup_item = Item.objects.filter(properties__name='task_input',
-                                                          properties__value=identifier)[0]
-                    except:
-                        raise serializers.ValidationError({'message':
-                                                          'Item does not exist!'})
-                    else:
-                        field['inventory_identifier'] = lookup_item.id
-                self._update_item_amounts(field, key, data_item_amounts, sum_item_amounts)
+                self._update_item_amounts(field, key, inventory,
+                                          data_item_amounts, sum_item_amounts)
 
             for identifier, field in item['product_inputs'].items():
-                field['inventory_identifier'] = identifier
-                self._update_item_amounts(field, key, data_item_amounts, sum_item_amounts)
+                self._update_item_amounts(field, key, inventory,
+                                          data_item_amounts, sum_item_amounts)
         return (data_item_amounts, sum_item_amounts)
 
-    def _check_input_amounts(self, sum_item_amounts):
+    def _get_existing_transfers(self, sum_item_amounts):
+        """
+        Get existing transfers matching the item/barcode/coordinates needed
+
+        Returns a dict of (item ID, barcode, coordinates) to a list of
+        matching transfers, fetched in a single query.
+        """
+        if len(sum_item_amounts) == 0:
+            return {}
+        query = Q()
+        for item, amount in sum_item_amounts.items():
+            # Only the transfers of the combinations needed, not all history
+            combination = Q(item_id=item.id)
+            for field in ('barcode', 'coordinates'):
+                value = amount.get(field, None)
+                if value is None:
+                    combination &= Q(**{'{}__isnull'.format(field): True})
+                else:
+                    combination &= Q(**{field: value})
+            query |= combination
+        candidates = ItemTransfer.objects.filter(query).select_related('amount_measure')
+        existing = {}
+        for transfer in candidates:
+            key = (transfer.item_id, transfer.barcode, transfer.coordinates)
+            existing.setdefault(key, []).append(transfer)
+        return existing
+
+    def _matching_transfer(self, existing_transfers, item, amount):
+        """
+        Get the single existing transfer for an item/barcode/coordinates
+
+        Returns None if there is not exactly one match.
+        """
+        key = (item.id, amount.get('barcode', None), amount.get('coordinates', None))
+        matches = existing_transfers.get(key, [])
+        if len(matches) == 1:
+            # Avoid looking the item up again
+            matches[0].item = item
+            return matches[0]
+        return None
+
+    def _check_input_amounts(self, sum_item_amounts, existing_transfers=None):
         """
         Check there is enough for each item available
         """
+        if existing_transfers is None:
+            existing_transfers = self._get_existing_transfers(sum_item_amounts)
         errors = []
         error_items = []
         valid_amounts = True
@@ -602,15 +706,10 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             # Lookup transfers to see if one make sense for this
             # Only if a barcode is supplied, as this inidcates a plate may already exist
             if required.get('barcode', None):
-                try:
-                    transfer = ItemTransfer.objects.get(item=item,
-                                                        barcode=required.get('barcode', None),
-                                                        coordinates=required.get('coordinates',
-                                                                                 None))
+                transfer = self._matching_transfer(existing_transfers, item, required)
+                if transfer is not None:
                     available = self._as_measured_value(transfer.amount_taken,
                                                         transfer.amount_measure.symbol)
-                except ItemTransfer.DoesNotExist:
-                    pass
             if available < required['amount']:
                 missing = (available - required['amount']) * -1
                 # Needs changing to reflext identifier is no longer a required field
@@ -622,30 +721,31 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
                 valid_amounts = False
         return (valid_amounts, errors, error_items)
 
-    def _create_item_transfers(self, sum_item_amounts, error_items=[]):
+    def _create_item_transfers(self, sum_item_amounts, error_items=[], existing_transfers=None):
         """
         Create ItemTransfers to alter inventory amounts
         """
+        if existing_transfers is None:
+            existing_transfers = self._get_existing_transfers(sum_item_amounts)
+        measures = {m.symbol: m for m in AmountMeasure.objects.all()}
         transfers = []
         for item, amount in sum_item_amounts.items():
             try:
                 amount_symbol = '{:~}'.format(amount['amount']).split(' ')[1]
-                measure = AmountMeasure.objects.get(symbol=amount_symbol)
+                measure = measures[amount_symbol]
                 amount['amount'] = amount['amount'].magnitude
             except:
-                measure = AmountMeasure.objects.get(symbol='item')
+                measure = measures['item']
 
             # Look up to see if there is a matching ItemTransfer already and then
             # use this instead
-            try:
-                transfer = ItemTransfer.objects.get(item=item,
-                                                    barcode=amount.get('barcode', None),
-                                                    coordinates=amount.get('coordinates', None))
+            transfer = self._matching_transfer(existing_transfers, item, amount)
+            if transfer is not None:
                 # At this point need to subtract amount from available in existing
                 # transfer! Need to mark in some way not completed though so can put
                 # back if the trasnfer is cancelled
                 transfer.amount_to_take = amount['amount']
-            except (ObjectDoesNotExist, MultipleObjectsReturned):
+            else:
                 transfer = ItemTransfer(
                     item=item,
                     barcode=amount.get('barcode', None),
@@ -657,6 +757,85 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             transfers.append(transfer)
         return transfers
 
+    def _link_transfers(self, transfers):
+        """
+        Link new transfers to any existing transfer with the same barcode
+
+        If there is a single incomplete transfer with the barcode (e.g. a
+        plate) all new transfers link to it. Otherwise new transfers link
+        to the first new transfer with that barcode once it is saved.
+        Returns a dict of barcode to the first new transfer.
+        """
+        barcodes = set(t.barcode for t in transfers if t.barcode)
+        existing = {}
+        for transfer in ItemTransfer.objects.filter(barcode__in=barcodes,
+                                                    transfer_complete=False):
+            existing.setdefault(transfer.barcode, []).append(transfer)
+        first_new = {}
+        for t in transfers:
+            if t.barcode:
+                if len(existing.get(t.barcode, [])) == 1:
+                    t.linked_transfer = existing[t.barcode][0]
+                elif t.barcode not in existing:
+                    first_new.setdefault(t.barcode, t)
+        return first_new
+
+    def _commit_transfers(self, run, transfers, task_run_identifier):
+        """
+        Save transfers and take the amounts from the inventory in bulk
+
+        The items are locked until the end of the transaction so concurrent
+        runs cannot take the same amount twice.
+        """
+        item_ids = set(t.item_id for t in transfers)
+        available = dict(Item.objects.select_for_update().filter(id__in=item_ids)
+                                     .values_list('id', 'amount_available'))
+        before = dict(available)
+        new_transfers = []
+        taken = {}
+        for t in transfers:
+            t.item.amount_available = available[t.item_id]
+            t.run_identifier = task_run_identifier
+            if t.pk is not None:
+                # Existing transfers (e.g. a plate already in use) are few
+                # so can be updated one by one
+                t.do_transfer()
+                t.save()
+                available[t.item_id] = t.item.amount_available
+                continue
+            # As ItemTransfer.save/do_transfer would for a new transfer
+            t.amount_available = t.amount_taken
+            t.amount_to_take = t.amount_taken
+            to_take = t._amount_in_item_measure(t.amount_taken)
+            if t.is_addition:
+                to_take = -to_take
+            elif available[t.item_id] <= to_take:
+                to_take = 0
+            available[t.item_id] -= to_take
+            t.item.amount_available = available[t.item_id]
+            taken[t.item_id] = taken.get(t.item_id, 0) + to_take
+            new_transfers.append(t)
+
+        first_new = self._link_transfers(new_transfers)
+        ItemTransfer.objects.bulk_create(new_transfers)
+        for barcode, first in first_new.items():
+            to_link = [t.id for t in new_transfers if t.barcode == barcode and t is not first]
+            if len(to_link) > 0:
+                ItemTransfer.objects.filter(id__in=to_link).update(linked_transfer=first)
+
+        taken = {item_id: amount for item_id, amount in taken.items() if amount != 0}
+        if len(taken) > 0:
+            amount_taken = Case(*[When(id=item_id, then=Value(amount))
+                                  for item_id, amount in taken.items()],
+                                output_field=FloatField())
+            Item.objects.filter(id__in=taken.keys()).update(
+                amount_available=F('amount_available') - amount_taken,
+                last_updated_on=timezone.now())
+            # The update skips save so send what changed for triggers to fire
+            updated_in_bulk.send(sender=Item, old={item_id: {'amount_available': before[item_id]}
+                                                   for item_id in taken})
+        run.transfers.add(*transfers)
+
     def _serialize_item_amounts(self, dict_of_amounts):
         output = []
         for item, amount in dict_of_amounts.items():
@@ -695,13 +874,12 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         # Perform checks on the validity of the data before the
         # task is run, return inventory requirements.
         is_check = request.query_params.get('is_check', False)
+        # Read input files as typed columns
+        columnar = request.query_params.get('columnar', None) == 'True'
         # Is this a repeat of a failed task
         # is_repeat = request.query_params.get('is_repeat', False)
 
         if serialized_task.is_valid(raise_exception=True):
-            # Init a unit registry for later use
-            self.ureg = UnitRegistry()
-
             run = self.get_object()
             task = run.get_task_at_index(run.current_task)
 
@@ -714,16 +892,20 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
                                                   serialized_task)
             # Process input files against task data
             data_items = self._update_data_items_from_file(file_data,
-                                                           data_items)
+                                                           data_items,
+                                                           columnar)
             # Perform calculations here!
             data_items = self._perform_calculations(data_items)
 
             product_item_amounts, sum_item_amounts = self._get_item_amounts(data_items,
                                                                             serialized_task)
-            valid_amounts, errors, error_items = self._check_input_amounts(sum_item_amounts)
+            existing_transfers = self._get_existing_transfers(sum_item_amounts)
+            valid_amounts, errors, error_items = self._check_input_amounts(sum_item_amounts,
+                                                                           existing_transfers)
 
             # Check if a transfer already exists with given barcode/well??
-            transfers = self._create_item_transfers(sum_item_amounts, error_items)
+            transfers = self._create_item_transfers(sum_item_amounts, error_items,
+                                                    existing_transfers)
 
             # Check if you can actually use the equipment
             if task.capable_equipment.count() > 0:
@@ -749,48 +931,48 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
                     check_output['requirements'].append(st.data)
                 return Response(check_output)
             else:
-                if task.capable_equipment.count() > 0:
-                    if equipment.status != 'idle':
-                        raise serializers.ValidationError({'message':
-                                                          'Equipment is currently in use'})
-                    equipment.status = 'active'
-                    equipment.save()
-                    run.equipment_used = equipment
-
                 if not valid_amounts:
                     raise ValidationError({'message': '\n'.join(errors)})
-                task_run_identifier = uuid.uuid4()
-                # driver_output = self._do_driver_actions(data_items)
-                # Generate DataItem for inputs
-                for product in run.products.all():
-                    prod_amounts = product_item_amounts[product.product_identifier]
-                    data_items[product.product_identifier]['product_input_amounts'] = \
-                        self._serialize_item_amounts(prod_amounts)
-                    entry = DataEntry(
-                        run=run,
-                        task_run_identifier=task_run_identifier,
-                        product=product,
-                        created_by=self.request.user,
-                        state='active',
-                        data=data_items[product.product_identifier],
-                        task=task)
-                    entry.save()
-
-                # TODO: RunLabware creation
-                # Link labeware barcode -> transfer
-                # At this point transfers have the amount taken but are not complete
-                # until task finished
-                for t in transfers:
-                    t.run_identifier = task_run_identifier
-                    t.do_transfer(self.ureg)
-                    t.save()
-                    run.transfers.add(t)
-
-                # Update run with new details
-                run.task_in_progress = True
-                run.has_started = True
-                run.task_run_identifier = task_run_identifier
-                run.save()
+                # Either everything for starting the task is saved or nothing is
+                with transaction.atomic():
+                    if task.capable_equipment.count() > 0:
+                        equipment = Equipment.objects.select_for_update().get(pk=equipment.pk)
+                        if equipment.status != 'idle':
+                            raise serializers.ValidationError({'message':
+                                                              'Equipment is currently in use'})
+                        equipment.status = 'active'
+                        equipment.save()
+                        run.equipment_used = equipment
+
+                    task_run_identifier = uuid.uuid4()
+                    # driver_output = self._do_driver_actions(data_items)
+                    # Generate DataItem for inputs
+                    entries = []
+                    for product in run.products.all():
+                        prod_amounts = product_item_amounts[product.product_identifier]
+                        data_items[product.product_identifier]['product_input_amounts'] = \
+                            self._serialize_item_amounts(prod_amounts)
+                        entries.append(DataEntry(
+                            run=run,
+                            task_run_identifier=task_run_identifier,
+                            product=product,
+                            created_by=self.request.user,
+                            state='active',
+                            data=data_items[product.product_identifier],
+                            task=task))
+                    DataEntry.objects.bulk_create(entries)
+
+                    # TODO: RunLabware creation
+                    # Link labeware barcode -> transfer
+                    # At this point transfers have the amount taken but are not complete
+                    # until task finished
+                    self._commit_transfers(run, transfers, task_run_identifier)
+
+                    # Update run with new details
+                    run.task_in_progress = True
+                    run.has_started = True
+                    run.task_run_identifier = task_run_identifier
+                    run.save()
                 return Response({'message': 'Task started successfully'})
 
     @detail_route(methods=["POST"])
@@ -801,7 +983,6 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         run = self.get_object()
 
         if run.task_in_progress:
-            ureg = UnitRegistry()
             # Get any transfers for this task
             transfers_for_this_task = run.transfers.filter(run_identifier=run.task_run_identifier)
             data_entries = DataEntry.objects.filter(task_run_identifier=run.task_run_identifier)
@@ -815,7 +996,7 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             # Transfer all the things taken back into the inventory
             for t in transfers_for_this_task:
                 t.is_addition = True
-                t.do_transfer(ureg)
+                t.do_transfer()
             # Once transfers made delete them
             # TODO: DO NOT delete transfers marked as has_taken!!
             transfers_for_this_task.delete()
@@ -832,11 +1013,20 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
     def recalculate(self, request, pk=None):
         """
         Given task data recalculate and return task.
+
+        ### query_params
+
+        - _changed_: A comma seperated list of changed field labels, only
+          calculations depending on these will be recalculated
         """
         obj = self.get_object()
         task_data = request.data
         if task_data:
-            serializer = RecalculateTaskTemplateSerializer(data=task_data)
+            context = self.get_serializer_context()
+            changed = request.query_params.get('changed', None)
+            if changed:
+                context['changed'] = [c for c in changed.split(',') if c != '']
+            serializer = RecalculateTaskTemplateSerializer(data=task_data, context=context)
             if serializer.is_valid(raise_exception=True):
                 return Response(serializer.data)  # Raw data, not objects
         serializer = TaskTemplateSerializer(obj)
@@ -881,6 +1071,11 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
 
     @detail_route(methods=['GET'], renderer_classes=(CSVRenderer,))
     def get_file(self, request, pk=None):
+        """
+        Get the file for equipment from a template for the task in progress
+
+        Pass stream=True to stream the file as it is made.
+        """
         file_id = request.query_params.get('file_id', None)
 
         run = self.get_object()
@@ -892,14 +1087,24 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             raise ValidationError({'message': 'Template does not exist'})
 
         if run.task_in_progress and run.is_active:
-            transfers = run.transfers.filter(run_identifier=run.task_run_identifier)
-            serialized_transfers = ItemTransferPreviewSerializer(transfers, many=True)
-            data_entries = DataEntry.objects.filter(task_run_identifier=run.task_run_identifier)
-            serialized_data_entries = DataEntrySerializer(data_entries, many=True)
-            output_data = task.data_to_output_file(file_template,
-                                                   serialized_data_entries.data,
-                                                   serialized_transfers.data)
-            return Response(output_data)
+            transfers = run.transfers.filter(run_identifier=run.task_run_identifier) \
+                .select_related('amount_measure', 'item__item_type', 'item__amount_measure',
+                                'item__concentration_measure', 'item__location')
+            data_entries = DataEntry.objects.filter(task_run_identifier=run.task_run_identifier) \
+                .select_related('run', 'created_by', 'task', 'product') \
+                .prefetch_related('data_files')
+            # Serialize as lines are made rather than all up front
+            output_data = task.output_lines(
+                file_template,
+                (DataEntrySerializer(e).data for e in data_entries),
+                (ItemTransferPreviewSerializer(t).data for t in transfers))
+            if request.query_params.get('stream', None) == 'True':
+                response = StreamingHttpResponse(file_template.write_chunks(output_data),
+                                                 content_type='text/csv')
+                response['Content-Disposition'] = \
+                    'attachment; filename="{}.csv"'.format(file_template.name)
+                return response
+            return Response(list(output_data))
         # Return a 204 as there is no task to get files for
         return Response(status=204)
 
@@ -924,6 +1129,83 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
                         d.data_files.add(file_store)
                         d.save()
 
+    def _create_outputs(self, entries):
+        """
+        Create the inventory items output by a task for each data entry
+
+        Measures, item types and the location are looked up once and all
+        items, permissions and links are saved in bulk.
+        """
+        timings = []
+        stage_start = time.perf_counter()
+
+        def stage(name):
+            nonlocal stage_start
+            now = time.perf_counter()
+            timings.append('{} {:.1f}ms'.format(name, (now - stage_start) * 1000))
+            stage_start = now
+
+        entries = list(entries.select_related('product', 'product__project', 'run'))
+        outputs = [(e, output) for e in entries for output in e.data['output_fields']]
+        if len(outputs) == 0:
+            return
+        measures = {m.symbol: m for m in AmountMeasure.objects.filter(
+            symbol__in=set(output['measure'] for e, output in outputs))}
+        item_types = {t.name: t for t in ItemType.objects.filter(
+            name__in=set(output['lookup_type'] for e, output in outputs))}
+        location = Location.objects.get(name='Lab')
+        stage('lookup')
+
+        new_items = []
+        for e, output in outputs:
+            output_name = '{} {} {}'.format(e.product.product_identifier,
+                                            e.product.name,
+                                            output['label'])
+            identifier = '{}/{}/{}'.format(e.product.product_identifier,
+                                           e.run.id, e.run.name)
+            item = Item(
+                name=output_name,
+                identifier=identifier,
+                item_type=item_types[output['lookup_type']],
+                location=location,
+                amount_available=output['amount'],
+                amount_measure=measures[output['measure']],
+                added_by=self.request.user,
+            )
+            # As Item.save does
+            item.in_inventory = item.amount_available > 0
+            new_items.append(item)
+        Item.objects.bulk_create(new_items)
+        stage('items')
+
+        # Get permissions from project for item
+        self.bulk_clone_group_permissions(
+            [(e.product.project, item) for (e, output), item in zip(outputs, new_items)])
+        stage('permissions')
+
+        created_from = Item.created_from.through
+        linked_inventory = Item.products.through
+        input_ids = set(int(i) for e in entries for i in e.data['product_inputs'])
+        input_ids = set(Item.objects.filter(id__in=input_ids).values_list('id', flat=True))
+        created_from_links = []
+        linked_inventory_links = []
+        for (e, output), item in zip(outputs, new_items):
+            for input_id in set(int(i) for i in e.data['product_inputs']):
+                if input_id in input_ids:
+                    created_from_links.append(created_from(from_item_id=item.id,
+                                                           to_item_id=input_id))
+            linked_inventory_links.append(linked_inventory(product_id=e.product_id,
+                                                           item_id=item.id))
+        created_from.objects.bulk_create(created_from_links)
+        linked_inventory.objects.bulk_create(linked_inventory_links)
+        stage('links')
+
+        for e in entries:
+            if len(e.data['output_fields']) > 0:
+                e.save()
+        stage('entries')
+        logger.debug('Created %d outputs: %s', len(new_items), ', '.join(timings))
+
     @detail_route(methods=['POST'])
     def finish_task(self, request, pk=None):
         """
@@ -1001,37 +1283,7 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             active_labware.update(is_active=False)
 
             # Create ouputs from the task
-            runindex = 0
-            for e in entries:
-                for index, output in enumerate(e.data['output_fields']):
-                    output_name = '{} {} {}'.format(e.product.product_identifier,
-                                                    e.product.name,
-                                                    output['label'])
-                    measure = AmountMeasure.objects.get(symbol=output['measure'])
-                    identifier = '{}/{}/{}'.format(e.product.product_identifier,
-                                                   e.run.id, e.run.name)
-                    runindex += 1
-                    location = Location.objects.get(name='Lab')
-                    item_type = ItemType.objects.get(name=output['lookup_type'])
-                    new_item = Item(
-                        name=output_name,
-                        identifier=identifier,
-                        item_type=item_type,
-                        location=location,
-                        amount_available=output['amount'],
-                        amount_measure=measure,
-                        added_by=request.user,
-                    )
-                    new_item.save()
-                    # Get permissions from project for item
-                    self.clone_group_permissions(e.product.project, new_item)
-
-                    product_input_ids = [p for p in e.data['product_inputs']]
-                    product_items = Item.objects.filter(id__in=product_input_ids)
-                    new_item.created_from.add(*product_items)
-
-                    e.product.linked_inventory.add(new_item)
-                    e.save()
+            self._create_outputs(entries)
 
             run.task_in_progress = False
             if run.equipment_used:
@@ -1113,11 +1365,20 @@ class TaskViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelViewS
     def recalculate(self, request, pk=None):
         """
         Given task data recalculate and return task.
+
+        ### query_params
+
+        - _changed_: A comma seperated list of changed field labels, only
+          calculations depending on these will be recalculated
         """
         obj = self.get_object()
         task_data = request.data
         if task_data:
-            serializer = RecalculateTaskTemplateSerializer(data=task_data)
+            context = self.get_serializer_context()
+            changed = request.query_params.get('changed', None)
+            if changed:
+                context['changed'] = [c for c in changed.split(',') if c != '']
+            serializer = RecalculateTaskTemplateSerializer(data=task_data, context=context)
             if serializer.is_valid(raise_exception=True):
                 return Response(serializer.data)  # Raw data, not objects
         serializer = TaskTemplateSerializer(obj)
@@ -1158,10 +1419,10 @@ class TaskFieldViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.Model
 
     def perform_create(self, serializer):
         task_template = serializer.validated_data['template']
-        if ('view_tasktemplate' in get_group_perms(self.request.user, task_template)
-                or self.request.user.groups.filter(name='admin').exists()):
-            if ('change_tasktemplate' in get_group_perms(self.request.user, task_template)
-                    or self.request.user.groups.filter(name='admin').exists()):
+        if ('view_tasktemplate' in self.capabilities.group_perms(task_template)
+                or self.capabilities.is_admin):
+            if ('change_tasktemplate' in self.capabilities.group_perms(task_template)
+                    or self.capabilities.is_admin):
                 instance = serializer.save()
                 self.clone_group_permissions(instance.template, instance)
             else: